@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""Benchmarks for the vCD extension proxy.
+"""
+import json
+import logging
+import sys
+import click
+
+from benchmarks import compression, harness, memory, micro, offload, replay, startup
+from fake_rest_server import fast
+
+
+logger = logging.getLogger(__name__)
+
+
+@click.group()
+def main():
+    """Run the benchmarks of vcdextproxy.
+    """
+
+
+@main.command()
+@click.option('-n', '--requests', 'count', default=2000, help="Number of messages to inject")
+@click.option('-r', '--rate', default=0.0, help="Messages per second to inject (0: as fast as possible)")
+@click.option('-e', '--extensions', default=1, help="Number of extensions to declare")
+@click.option('-t', '--max-threads', default=10, help="Value of the global.max_threads setting")
+@click.option('-s', '--body-size', default=0, help="Size of the request bodies (bytes)")
+@click.option('-m', '--method', default="GET", help="HTTP method of the injected requests")
+@click.option('-b', '--broker', default="memory://", help="kombu URL of the broker to use")
+@click.option('--backend', default=None, help="URL of an already running backend (e.g. fake_rest_server)")
+@click.option('--backend-size', default=0, help="Size of the built-in backend responses (bytes)")
+@click.option('--backend-latency', default="none", help="Latency distribution of the built-in backend")
+@click.option('--backend-errors', default=0.0, help="Error rate of the built-in backend")
+@click.option('--backend-capacity', default=0, help="Concurrent requests processed by the built-in backend")
+@click.option('--backend-transport', type=click.Choice(['tcp', 'unix', 'h2c']), default='tcp',
+              help="Transport of the built-in backend: HTTP/1.1 over TCP or a Unix socket, or HTTP/2")
+@click.option('--consumers', default=1, help="Consumers (channels and drain loops) per extension queue")
+@click.option('--prefetch', default=0, help="Prefetch count of each consumer (0: unlimited)")
+@click.option('--queue-size', default=0, help="Value of the global.fair_queuing.queue_size setting (0: default)")
+@click.option('--prefill', is_flag=True, help="Publish all the messages before starting the proxy")
+@click.option('--retries', default=1, help="Attempts of the idempotent requests (backend.retries.max_attempts)")
+@click.option('--hedging', is_flag=True, help="Hedge the GET requests after the p95 backend latency")
+@click.option('--shedding', 'shedding_ms', default=0,
+              help="Shed the requests queued for longer than this (ms) during a second (0: no shedding)")
+@click.option('--concurrency', type=click.Choice(['none', 'fixed', 'aimd', 'gradient']), default='none',
+              help="Concurrency limit algorithm of the extensions")
+@click.option('--vcd', type=click.Choice(['stub', 'fake']), default='stub',
+              help="Stub the vCD calls or use a local fake vCD API")
+@click.option('--vcd-latency', default="none", help="Latency distribution of the fake vCD API calls")
+@click.option('--token-validation', type=click.Choice(['remote', 'cached', 'local']), default='remote',
+              help="Token validation mode (with --vcd fake)")
+@click.option('--trust-vcd-context', is_flag=True, help="Check the rights of the vCD context of the messages")
+@click.option('--orgs', default=1, help="Number of organizations sending the messages")
+@click.option('--noisy-share', default=0.0, help="Share of the messages sent by the first organization")
+@click.option('--org-rate-limit', default=0.0, help="Requests per second allowed per organization (0: no limit)")
+@click.option('--bulk-ratio', default=0.0, help="Share of slow POST requests mixed with the others")
+@click.option('--bulk-latency-ms', default=200, help="Backend latency of the slow POST requests")
+@click.option('--bulk-size', default=0, help="Request and response body size of the slow POST requests (bytes)")
+@click.option('--offload', 'offload_kb', default=0,
+              help="Encode and decode the bodies of at least this size (KB) in a process pool")
+@click.option('--lanes', is_flag=True, help="Serve the slow POST requests in a low priority lane")
+@click.option('--reference-right', default=None, help="Reference right to check for each request")
+@click.option('--capture', type=click.Path(dir_okay=False), help="Capture the injected messages (for `replay`)")
+@click.option('--timeout', default=60, help="Maximum time to wait for the replies (seconds)")
+def load(count, rate, extensions, max_threads, body_size, method, broker, backend,
+         backend_size, backend_latency, backend_errors, backend_capacity, backend_transport, consumers, prefetch,
+         queue_size, prefill, retries, hedging, shedding_ms, concurrency, vcd, vcd_latency, token_validation,
+         trust_vcd_context, orgs, noisy_share, org_rate_limit, bulk_ratio, bulk_latency_ms, bulk_size, offload_kb,
+         lanes, reference_right, capture, timeout):
+    """Drive the proxy end to end and report throughput, latency and RSS.
+    """
+    if not backend:
+        backend = harness.start_backend(
+            fast.BackendProfile(backend_size, backend_latency, backend_errors, capacity=backend_capacity),
+            backend_transport
+        )
+    fake_vcd = vcd_url = None
+    if vcd == 'fake':
+        fake_vcd, vcd_url = harness.start_fake_vcd(vcd_latency)
+    overrides = {'vcloud': {
+        'validate_org_membership': True,
+        'reference_right': reference_right or False,
+        'trust_vcd_context': trust_vcd_context,
+    }}
+    configuration = harness.build_configuration(backend, extensions, max_threads, overrides, vcd_url)
+    for extension in configuration['extensions'].values():
+        if retries > 1:
+            extension['backend']['retries'] = {'max_attempts': retries}
+        if hedging:
+            extension['backend']['hedging'] = {'percentile': 95}
+        if shedding_ms:
+            extension['backend']['shedding'] = {'target': shedding_ms / 1000, 'interval': 1.0}
+    if queue_size:
+        configuration['global']['fair_queuing'] = {'queue_size': queue_size}
+    for extension in configuration['extensions'].values():
+        extension['amqp']['consumers'] = consumers
+        extension['amqp']['prefetch_count'] = prefetch or None
+    if concurrency != 'none':
+        for extension in configuration['extensions'].values():
+            extension['backend']['concurrency'] = {'algorithm': concurrency, 'min': 1, 'max': max_threads}
+    configuration['global']['vcloud']['token_validation'] = {'mode': token_validation}
+    if lanes:
+        configuration['global']['priorities'] = {
+            'lanes': {'interactive': {'share': 4}, 'bulk': {'share': 1}},
+            'rules': [{'lane': 'bulk', 'methods': ['POST']}, {'lane': 'interactive', 'methods': ['GET']}],
+        }
+    if capture:
+        configuration['global']['capture'] = {'enabled': True, 'path': capture}
+    if offload_kb:
+        configuration['global']['offload'] = {'enabled': True, 'min_size': offload_kb * 1024}
+    if org_rate_limit:
+        configuration['global']['rate_limits'] = {'org': {'rate': org_rate_limit, 'burst': org_rate_limit}}
+    harness.prepare_proxy(configuration, stub=vcd == 'stub')
+    rights = []
+    if fake_vcd and reference_right:
+        rights.append(f"urn:vcloud:right:{fake_vcd.right_id(reference_right)}")
+    run = harness.LoadRun(broker, list(configuration['extensions']), rate, body_size, method, rights,
+                          orgs, noisy_share, bulk_ratio, bulk_latency_ms, prefill, bulk_size)
+    results = run.run(count, timeout)
+    if fake_vcd:
+        results['vcd_calls'] = dict(fake_vcd.stats)
+    click.echo(json.dumps(results, indent=2))
+
+
+@main.command(name='replay')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--speed', default=1.0, help="Replay speed factor (1: original pace, 0: as fast as possible)")
+@click.option('-n', '--limit', default=0, help="Number of messages to replay (0: all)")
+@click.option('-t', '--max-threads', default=10, help="Value of the global.max_threads setting")
+@click.option('-b', '--broker', default="memory://", help="kombu URL of the broker to use")
+@click.option('--backend', default=None, help="URL of an already running backend (e.g. fake_rest_server)")
+@click.option('--backend-latency', default="none", help="Latency distribution of the built-in backend")
+@click.option('--timeout', default=60, help="Maximum time to wait for the replies after the replay (seconds)")
+def replay_capture(path, speed, limit, max_threads, broker, backend, backend_latency, timeout):
+    """Replay a capture of vCD messages through the local proxy.
+    """
+    count, routing_keys, duration = replay.scan(path)
+    count = min(count, limit) if limit else count
+    if not backend:
+        backend = harness.start_backend(fast.BackendProfile(latency=backend_latency))
+    overrides = {'vcloud': {'validate_org_membership': True, 'reference_right': False}}
+    configuration = harness.build_configuration(backend, max_threads=max_threads, overrides=overrides,
+                                                names=routing_keys)
+    harness.prepare_proxy(configuration)
+    run = replay.ReplayRun(broker, path, routing_keys, speed)
+    results = run.run(count, duration / speed + timeout if speed else timeout)
+    results['replay'] = {
+        'speed': speed,
+        'capture_duration_s': round(duration, 3),
+        'max_lag_ms': round(run.max_lag * 1000, 2),
+    }
+    click.echo(json.dumps(results, indent=2))
+
+
+@main.command(name='startup')
+@click.option('--repeat', default=5, help="Number of cold starts (the median is kept)")
+def startup_benchmark(repeat):
+    """Time the cold start: imports, configuration and first consumer.
+    """
+    harness.write_configuration(harness.build_configuration("http://127.0.0.1:8881"))
+    click.echo(json.dumps(startup.run(repeat), indent=2))
+
+
+@main.command(name='memory')
+@click.option('-n', '--requests', 'count', default=10000, help="Number of requests in flight")
+@click.option('-s', '--body-size', default=0, help="Size of the request bodies (bytes)")
+def memory_benchmark(count, body_size):
+    """Measure the memory held by the requests in flight.
+    """
+    harness.write_configuration(harness.build_configuration("http://127.0.0.1:8881"))
+    click.echo(json.dumps(memory.run(count, body_size), indent=2))
+
+
+@main.command(name='offload')
+@click.option('-s', '--large-size', default=4096, help="Size of the large bodies (KB)")
+@click.option('-t', '--large-threads', default=2, help="Threads processing large bodies")
+@click.option('-n', '--samples', default=1000, help="Number of small requests to time")
+@click.option('-p', '--processes', default=2, help="Processes of the offload pool")
+def offload_benchmark(large_size, large_threads, samples, processes):
+    """Latency of small requests with large bodies processed alongside, with and without offload.
+    """
+    results = [
+        offload.run(enabled, large_size * 1024, large_threads, samples, processes=processes)
+        for enabled in (False, True)
+    ]
+    click.echo(json.dumps(results, indent=2))
+
+
+@main.command(name='micro')
+@click.option('-k', '--select', multiple=True, help="Only run the cases containing this string")
+@click.option('--repeat', default=5, help="Number of repeats per case (best is kept)")
+@click.option('--save', type=click.Path(dir_okay=False), help="Save the results as a JSON baseline")
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help="Compare with a JSON baseline")
+@click.option('--tolerance', default=0.1, help="Slowdown ratio reported as a regression")
+def micro_benchmarks(select, repeat, save, compare, tolerance):
+    """Time each stage of the per-message hot path.
+    """
+    harness.prepare_proxy(harness.build_configuration("http://127.0.0.1:8881"))
+    results = micro.run(select, repeat)
+    if save:
+        with open(save, 'w') as fd:
+            json.dump(results, fd, indent=2)
+    if not compare:
+        click.echo(json.dumps(results, indent=2))
+        return
+    with open(compare) as fd:
+        baseline = json.load(fd)
+    rows, regression = micro.compare(baseline, results, tolerance)
+    click.echo(f"{'case':<24}{'baseline (us)':>16}{'current (us)':>16}{'change':>10}")
+    for row in rows:
+        change = "n/a" if row['change'] is None else f"{row['change']:+.1f}%"
+        flag = " !" if row.get('regression') else ""
+        click.echo(f"{row['case']:<24}{str(row['baseline']):>16}{row['current']:>16}{change:>10}{flag}")
+    if regression:
+        sys.exit(1)
+
+
+@main.command(name='compression')
+@click.option('-s', '--size', 'sizes', multiple=True, type=int, help="Payload sizes to test (bytes)")
+@click.option('--repeat', default=3, help="Number of repeats per case (best is kept)")
+def compression_benchmarks(sizes, repeat):
+    """Compare the CPU cost and the bytes saved by the reply compression.
+    """
+    harness.write_configuration(harness.build_configuration("http://127.0.0.1:8881"))
+    rows = compression.run(sizes, repeat)
+    click.echo(f"{'size':>9}{'codec':>7}{'level':>6}{'ratio':>8}{'compress (us)':>15}"
+               f"{'decompress (us)':>17}{'message':>10}{'saved':>10}")
+    for row in rows:
+        click.echo(f"{row['size']:>9}{row['codec']:>7}{str(row['level'] or '-'):>6}{row['ratio']:>8}"
+                   f"{row['compress_us']:>15}{row['decompress_us']:>17}{row['message_bytes']:>10}"
+                   f"{row['saved_bytes']:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""CPU cost vs bytes saved by the compression of the replies.
+
+For each payload size and codec/level, the reply message is built as it is
+published to the broker (base64 body in a JSON message) to report the bytes
+really saved on the broker. The configuration must already be written (see
+``harness.write_configuration``).
+"""
+import json
+import timeit
+
+
+PAYLOAD_SIZES = [1024, 64 * 1024, 1024 * 1024]
+LEVELS = {'gzip': [1, 6, 9], 'zstd': [1, 3, 9]}
+
+
+def json_payload(size):
+    """Build a verbose JSON payload (list of records) of about ``size`` bytes.
+    """
+    records = []
+    encoded_size = 2
+    index = 0
+    while encoded_size < size:
+        record = {
+            'id': f"urn:vcloud:vm:{index:08d}-4b1c-4c5a-9f0e-2d3c4b5a6978",
+            'name': f"vm-{index}",
+            'status': "POWERED_ON" if index % 3 else "POWERED_OFF",
+            'cpu': index % 16 + 1,
+            'memoryMB': (index % 8 + 1) * 1024,
+            'href': f"https://vcd.example.com/api/vApp/vm-{index:08d}",
+        }
+        records.append(record)
+        encoded_size += len(json.dumps(record)) + 2
+        index += 1
+    return json.dumps({'values': records}).encode('utf-8')[:max(size, 2)]
+
+
+def message_size(data, encoding=None):
+    """Size of the reply message published to the broker.
+    """
+    from vcdextproxy import AMQPWorker
+    properties = {'id': 'bench', 'statusCode': 200, 'encode': False}
+    if encoding:
+        properties['Content-Encoding'] = encoding
+    return len(json.dumps(AMQPWorker.format_reply(data, properties)))
+
+
+def best_time(func, repeat=3):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run(sizes=None, repeat=3):
+    """Measure the codecs.
+
+    Returns:
+        [dict]: One row per payload size and codec/level.
+    """
+    from vcdextproxy.compression import CODECS, available_encodings, compress, decompress
+
+    rows = []
+    for size in sizes or PAYLOAD_SIZES:
+        data = json_payload(size)
+        raw_message = message_size(data)
+        rows.append({
+            'size': len(data), 'codec': 'none', 'level': None, 'ratio': 1.0,
+            'compress_us': 0, 'decompress_us': 0, 'message_bytes': raw_message, 'saved_bytes': 0,
+        })
+        for encoding in available_encodings(CODECS):
+            for level in LEVELS[encoding]:
+                compressed = compress(data, encoding, level)
+                message = message_size(compressed, encoding)
+                rows.append({
+                    'size': len(data),
+                    'codec': encoding,
+                    'level': level,
+                    'ratio': round(len(data) / len(compressed), 2),
+                    'compress_us': round(best_time(lambda: compress(data, encoding, level), repeat) * 1e6, 1),
+                    'decompress_us': round(best_time(lambda: decompress(compressed, encoding), repeat) * 1e6, 1),
+                    'message_bytes': message,
+                    'saved_bytes': raw_message - message,
+                })
+    return rows
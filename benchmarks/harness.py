@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+"""Tools to run the proxy end to end on a single machine.
+
+The harness builds a temporary configuration, starts a local REST backend
+(``fake_rest_server.fast``),
+runs an ``AMQPWorker`` against an in-memory kombu transport (or any broker
+URL) and injects vCD-shaped messages in the extension queues.
+"""
+import base64
+import json
+import logging
+import math
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import uuid
+
+import yaml
+from kombu import Connection, Exchange, Queue
+
+from fake_rest_server import fast
+from fake_vcd_server.server import FakeVcd, start_in_thread as start_fake_vcd_server
+
+
+logger = logging.getLogger(__name__)
+
+REPLY_EXCHANGE = "vcdextproxy-bench-replies"
+REPLY_QUEUE = "vcdextproxy-bench-replies"
+EXTENSION_EXCHANGE = "vcdextproxy-bench"
+ORG_ID = "a93c9db9-7471-3192-8d09-a8f7eeda85f9"
+USER_ID = "d2d2a0ce-5e0b-4cd2-9b5f-a6c0e4a1b2c3"
+
+
+def start_backend(profile=None, transport="tcp"):
+    """Start the fast fake REST backend in a daemon thread.
+
+    Args:
+        profile (fake_rest_server.fast.BackendProfile): Behavior of the backend.
+        transport (str): ``tcp``, ``unix`` (HTTP/1.1 over a Unix domain socket) or ``h2c`` (HTTP/2).
+
+    Returns:
+        str: The endpoint of the backend.
+    """
+    unix_path = os.path.join(tempfile.mkdtemp(), "backend.sock") if transport == "unix" else None
+    return fast.start_in_thread(profile or fast.BackendProfile(), unix_path=unix_path, http2=transport == "h2c")
+
+
+def start_fake_vcd(latency="none", rights_count=300):
+    """Start a fake vCD API accepting the tokens of the injected messages.
+
+    Returns:
+        (fake_vcd_server.server.FakeVcd, str): The fake vCD and its base URL.
+    """
+    vcd = FakeVcd(tenant_org_id=ORG_ID, rights_count=rights_count, accept_any_token=True, latency=latency)
+    return vcd, start_fake_vcd_server(vcd)
+
+
+def build_configuration(backend_url, extensions=1, max_threads=10, overrides=None, vcd_url=None, names=None):
+    """Build a proxy configuration for the benchmark.
+
+    Args:
+        backend_url (str): Base URL of the REST backend.
+        extensions (int): Number of extensions to declare.
+        max_threads (int): Value for ``global.max_threads``.
+        overrides (dict): Extra settings merged in every extension settings.
+        vcd_url (str): Base URL of a (fake) vCD API.
+        names ([str]): Names (and routing keys) of the extensions (default: ``bench0``, ``bench1``...).
+
+    Returns:
+        dict: The configuration content.
+    """
+    configuration = {
+        'global': {
+            'vcloud': {
+                'hostname': vcd_url or '127.0.0.1',
+                'username': 'admin',
+                'password': 'admin',
+                'system_org': 'System',
+                'api_version': '33.0',
+                'ssl_verify': False,
+                'cache_timeout': 300,
+            },
+            'log': {'config_file': 'logging.json'},
+            'max_threads': max_threads,
+            'pyvcloud': {
+                'log_file': os.devnull,
+                'log_requests': False,
+                'log_headers': False,
+                'log_bodies': False,
+            },
+        },
+        'extensions': {},
+    }
+    for name in names or [f"bench{index}" for index in range(extensions)]:
+        configuration['extensions'][name] = {
+            'backend': {
+                'endpoint': backend_url,
+                'uri_replace': {'pattern': f"/api/{name}/", 'by': '/'},
+                'ssl_verify': False,
+                'forward_rights': False,
+                'timeout': 30,
+            },
+            'amqp': {
+                'routing_key': name,
+                'exchange': {'name': EXTENSION_EXCHANGE, 'type': 'direct', 'durable': False},
+                'queue': {'name': name, 'message_ttl': 40000},
+            },
+            'vcloud': {
+                'validate_org_membership': True,
+                'reference_right': False,
+            },
+        }
+        configuration['extensions'][name].update(overrides or {})
+    return configuration
+
+
+def write_configuration(configuration, log_level="WARNING"):
+    """Write the configuration in a new directory and point the proxy to it.
+
+    Must be called before the configuration is first read (the first ``conf()`` call).
+
+    Returns:
+        str: Path to the configuration directory.
+    """
+    conf_path = tempfile.mkdtemp(prefix="vcdextproxy-bench-")
+    with open(os.path.join(conf_path, 'config.yml'), 'w') as fd:
+        yaml.safe_dump(configuration, fd)
+    logging_conf = {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'handlers': {'console': {'class': 'logging.StreamHandler', 'level': log_level}},
+        'root': {'handlers': ['console'], 'level': log_level},
+    }
+    with open(os.path.join(conf_path, 'logging.json'), 'w') as fd:
+        json.dump(logging_conf, fd)
+    os.environ['VCDEXTPROXY_CONFIGURATION_PATH'] = conf_path
+    return conf_path
+
+
+def stub_vcloud():
+    """Replace the vCD calls made by the proxy with local stand-ins.
+    """
+    from vcdextproxy import rest_worker
+    from vcdextproxy.tokens import TokenIdentity
+
+    def validate_token(token, is_jwt_token=False, vcd_data=None):
+        # the user is always member of the organization of the message
+        org_id = vcd_data['org'].split(':')[-1] if vcd_data else ORG_ID
+        return TokenIdentity(org_id, USER_ID, ('bench',), None, 'stub')
+
+    rest_worker.validate_token = validate_token
+    rest_worker.get_user_rights = lambda org_id, roles: frozenset()
+
+
+def prepare_proxy(configuration, stub=True):
+    """Write the configuration, configure the logger and stub the vCD calls.
+
+    Args:
+        configuration (dict): The configuration content.
+        stub (bool): Replace the vCD calls by local stand-ins (no vCD API at all).
+    """
+    write_configuration(configuration)
+    from vcdextproxy.configuration import configure_logger
+    configure_logger()
+    if stub:
+        stub_vcloud()
+
+
+def vcd_message(extension_name, method="GET", body=b"", request_id=None, rights=(), org_id=ORG_ID,
+                query_string=None):
+    """Forge a message as sent by vCD to an API extension.
+
+    Args:
+        query_string (str): Query string of the request.
+        rights ([str]): URNs of the user's rights in the vCD context.
+        org_id (str): ID of the organization of the user.
+
+    Returns:
+        str: The JSON content of the message.
+    """
+    request = {
+        'id': request_id or str(uuid.uuid4()),
+        'method': method,
+        'requestUri': f"/api/{extension_name}/test/bench",
+        'queryString': query_string,
+        'protocol': 'HTTP/1.1',
+        'headers': {
+            'Accept': 'application/*+json;version=33.0',
+            'Content-Type': 'application/json',
+            'x-vcloud-authorization': 'bench-token',
+        },
+        'body': base64.b64encode(body).decode(),
+    }
+    context = {
+        'org': f"urn:vcloud:org:{org_id}",
+        'user': f"urn:vcloud:user:{USER_ID}",
+        'rights': list(rights),
+        'roles': ['bench'],
+    }
+    return json.dumps([request, context])
+
+
+def current_rss():
+    """Return the current and the peak resident set size of the process (in KB).
+    """
+    rss = None
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, pct):
+    """Return the ``pct`` percentile of a sorted list of values.
+    """
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+class LoadRun:
+    """Drive a local proxy with a steady flow of vCD messages and collect stats.
+    """
+
+    def __init__(self, broker_url, extension_names, rate=0, body_size=0, method="GET", rights=(),
+                 orgs=1, noisy_share=0.0, bulk_ratio=0.0, bulk_latency_ms=200, prefill=False, bulk_size=0):
+        """Prepare a new run.
+
+        Args:
+            broker_url (str): kombu URL of the broker (``memory://`` for in-process).
+            extension_names ([str]): Extensions to target (round-robin).
+            rate (float): Messages per second to inject (0 for as fast as possible).
+            body_size (int): Size of the request body in bytes.
+            method (str): HTTP method of the injected requests.
+            rights ([str]): URNs of the user's rights in the vCD context of the messages.
+            orgs (int): Number of organizations sending the messages.
+            noisy_share (float): Share of the messages sent by the first organization
+                (0: messages evenly spread).
+            bulk_ratio (float): Share of slow ``POST`` requests mixed with the others.
+            bulk_latency_ms (int): Backend latency of the slow requests (milliseconds).
+            prefill (bool): Publish all the messages before starting the proxy (to measure its intake).
+            bulk_size (int): Size of the request and response bodies of the slow requests (0: same as the others).
+        """
+        self.broker_url = broker_url
+        self.extension_names = extension_names
+        self.rate = rate
+        self.body = b"x" * body_size
+        self.method = method
+        self.rights = rights
+        self.org_ids = [ORG_ID] + [str(uuid.uuid5(uuid.NAMESPACE_OID, f"bench-org-{i}")) for i in range(1, orgs)]
+        self.noisy_share = noisy_share
+        self.bulk_ratio = bulk_ratio
+        self.bulk_latency_ms = bulk_latency_ms
+        self.bulk_body = b"x" * bulk_size if bulk_size else self.body
+        self.bulk_query = f"latency_ms={bulk_latency_ms}" + (f"&size={bulk_size}" if bulk_size else "")
+        self.prefill = prefill
+        self.intake_elapsed = None
+        self.sent = {}  # correlation_id -> (publish time, org index, kind of request)
+        self.latencies = []
+        self.org_latencies = [[] for _ in self.org_ids]
+        self.kind_latencies = {'bulk': [], 'other': []}
+        self.accepted_latencies = []
+        self.status_codes = {}
+        self.lock = threading.Lock()
+        self.all_replied = threading.Event()
+        self.expected = 0
+
+    def connection(self):
+        return Connection(self.broker_url, transport_options={'polling_interval': 0.001})
+
+    def declare(self, conn):
+        """Declare the extension queues and the reply queue.
+        """
+        exchange = Exchange(EXTENSION_EXCHANGE, 'direct', durable=False)
+        for name in self.extension_names:
+            Queue(name, exchange, routing_key=name, durable=False)(conn.default_channel).declare()
+        reply_exchange = Exchange(REPLY_EXCHANGE, 'direct', durable=True)
+        Queue(REPLY_QUEUE, reply_exchange, routing_key=REPLY_QUEUE)(conn.default_channel).declare()
+
+    def on_reply(self, body, message):
+        now = time.perf_counter()
+        with self.lock:
+            sent = self.sent.pop(message.properties.get('correlation_id'), None)
+            if sent is not None:
+                self.latencies.append(now - sent[0])
+                self.org_latencies[sent[1]].append(now - sent[0])
+                self.kind_latencies[sent[2]].append(now - sent[0])
+            status_code = str(body.get('statusCode'))
+            if sent is not None and status_code != '503':
+                self.accepted_latencies.append(now - sent[0])
+            self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+            if len(self.latencies) >= self.expected:
+                self.all_replied.set()
+        message.ack()
+
+    def collect_replies(self, stop):
+        with self.connection() as conn:
+            reply_queue = Queue(REPLY_QUEUE, Exchange(REPLY_EXCHANGE, 'direct'), routing_key=REPLY_QUEUE)
+            with conn.Consumer([reply_queue], callbacks=[self.on_reply], accept=['json']):
+                while not stop.is_set():
+                    try:
+                        conn.drain_events(timeout=0.1)
+                    except Exception:  # socket.timeout and friends
+                        pass
+
+    def watch_intake(self, start, stop):
+        """Record the time taken by the proxy to empty the extension queues.
+        """
+        exchange = Exchange(EXTENSION_EXCHANGE, 'direct', durable=False)
+        with self.connection() as conn:
+            queues = [Queue(name, exchange, routing_key=name, durable=False)(conn.default_channel)
+                      for name in self.extension_names]
+            while not stop.is_set():
+                if all(queue.queue_declare(passive=True).message_count == 0 for queue in queues):
+                    self.intake_elapsed = time.perf_counter() - start
+                    return
+                time.sleep(0.005)
+
+    def pick_org(self, index):
+        """Return the index of the organization sending the ``index``-th message.
+        """
+        if len(self.org_ids) == 1:
+            return 0
+        if not self.noisy_share:
+            return index % len(self.org_ids)
+        if random.random() < self.noisy_share:
+            return 0
+        return random.randrange(1, len(self.org_ids))
+
+    def inject(self, count):
+        """Publish ``count`` messages at the configured rate.
+        """
+        exchange = Exchange(EXTENSION_EXCHANGE, 'direct', durable=False)
+        interval = 1.0 / self.rate if self.rate else 0
+        with self.connection() as conn:
+            producer = conn.Producer()
+            start = time.perf_counter()
+            for index in range(count):
+                if interval:
+                    delay = start + index * interval - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                name = self.extension_names[index % len(self.extension_names)]
+                org = self.pick_org(index)
+                bulk = self.bulk_ratio and random.random() < self.bulk_ratio
+                correlation_id = str(uuid.uuid4())
+                with self.lock:
+                    self.sent[correlation_id] = (time.perf_counter(), org, 'bulk' if bulk else 'other')
+                producer.publish(
+                    vcd_message(
+                        name,
+                        "POST" if bulk else self.method,
+                        self.bulk_body if bulk else self.body,
+                        rights=self.rights,
+                        org_id=self.org_ids[org],
+                        query_string=self.bulk_query if bulk else None
+                    ),
+                    exchange=exchange,
+                    routing_key=name,
+                    correlation_id=correlation_id,
+                    reply_to=REPLY_QUEUE,
+                    headers={'replyToExchange': REPLY_EXCHANGE},
+                    content_type='text/plain',
+                    content_encoding='utf-8',
+                )
+
+    def run(self, count, timeout=60):
+        """Run the proxy, inject ``count`` messages and wait for the replies.
+
+        Returns:
+            dict: Benchmark results.
+        """
+        from vcdextproxy import AMQPWorker
+        from vcdextproxy.offload import get_offloader
+
+        self.expected = count
+        offloader = get_offloader()
+        if offloader is not None:
+            offloader.start()  # as the proxy does at startup
+        stop = threading.Event()
+        with self.connection() as conn:
+            self.declare(conn)
+            worker = AMQPWorker(conn)
+            if self.prefill:
+                self.inject(count)
+            collector = threading.Thread(target=self.collect_replies, args=(stop,), daemon=True)
+            collector.start()
+            rss_before, _ = current_rss()
+            start = time.perf_counter()
+            proxy = threading.Thread(target=worker.run, name="bench-proxy", daemon=True)
+            proxy.start()
+            if self.prefill:
+                threading.Thread(target=self.watch_intake, args=(start, stop), daemon=True).start()
+            else:
+                self.inject(count)
+            self.all_replied.wait(timeout)
+            elapsed = time.perf_counter() - start
+            rss_after, rss_peak = current_rss()
+            worker.should_stop = True
+            stop.set()
+            proxy.join(5)
+            collector.join(5)
+            if worker.capture is not None:
+                worker.capture.close()
+            if offloader is not None:
+                offloader.shutdown()
+        latencies = sorted(self.latencies)
+        results = {
+            'requests': count,
+            'replies': len(latencies),
+            'lost': count - len(latencies),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'latency_ms': {
+                'p50': _ms(percentile(latencies, 50)),
+                'p95': _ms(percentile(latencies, 95)),
+                'p99': _ms(percentile(latencies, 99)),
+                'max': _ms(latencies[-1] if latencies else None),
+            },
+            'status_codes': self.status_codes,
+            'consumers': 1 + len(worker.shards) // max(1, len(self.extension_names)),
+            'rss_kb': {'before': rss_before, 'after': rss_after, 'peak': rss_peak},
+        }
+        if self.intake_elapsed:
+            results['intake_rps'] = round(count / self.intake_elapsed, 1)
+        if len(self.org_ids) > 1:
+            results['per_org'] = {}
+            for org_id, org_latencies in zip(self.org_ids, self.org_latencies):
+                org_latencies.sort()
+                results['per_org'][org_id] = {
+                    'replies': len(org_latencies),
+                    'p50_ms': _ms(percentile(org_latencies, 50)),
+                    'p99_ms': _ms(percentile(org_latencies, 99)),
+                }
+        if len(self.accepted_latencies) < len(latencies):  # requests were shed
+            accepted = sorted(self.accepted_latencies)
+            results['accepted'] = {
+                'replies': len(accepted),
+                'p50_ms': _ms(percentile(accepted, 50)),
+                'p99_ms': _ms(percentile(accepted, 99)),
+            }
+        if worker.scheduler and worker.scheduler.get_metrics().get('shedding'):
+            results['shedding'] = worker.scheduler.get_metrics()['shedding']
+        if worker.scheduler and worker.scheduler.queue.limiters:
+            results['concurrency'] = worker.scheduler.get_metrics()['concurrency']
+        if self.bulk_ratio:
+            results['per_kind'] = {}
+            for kind, kind_latencies in self.kind_latencies.items():
+                kind_latencies.sort()
+                results['per_kind'][kind] = {
+                    'replies': len(kind_latencies),
+                    'p50_ms': _ms(percentile(kind_latencies, 50)),
+                    'p99_ms': _ms(percentile(kind_latencies, 99)),
+                }
+        return results
+
+
+def _ms(value):
+    return None if value is None else round(value * 1000, 2)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Memory held by the requests in flight.
+
+``count`` vCD messages are received and turned into ``RESTWorker`` objects,
+as when the workers are all busy and the requests wait in the scheduler
+queue. Only the workers are kept: the memory still allocated (``tracemalloc``)
+is what the proxy holds per request in flight, including the parts of the
+message that the workers keep alive.
+"""
+import gc
+import json
+import sys
+import tracemalloc
+import uuid
+
+from benchmarks import harness
+
+
+class FakeAMQPMessage:
+    """Received message, with its raw body and its own properties.
+    """
+
+    def __init__(self, routing_key, body):
+        self.body = body
+        self.delivery_info = {'routing_key': routing_key, 'exchange': 'vcdext'}
+        self.properties = {'correlation_id': str(uuid.uuid4()), 'reply_to': harness.REPLY_QUEUE}
+        self.headers = {'replyToExchange': harness.REPLY_EXCHANGE}
+
+
+def run(count=10000, body_size=0):
+    """Measure the memory of ``count`` requests in flight.
+
+    The configuration must already be written (see ``harness.write_configuration``).
+
+    Returns:
+        dict: Total and per request memory (bytes).
+    """
+    from vcdextproxy import RESTWorker, RestApiExtension
+    from vcdextproxy.configuration import configure_logger
+
+    configure_logger()
+    extension = RestApiExtension('bench0')
+    raw_message = harness.vcd_message('bench0', 'POST', b"x" * body_size)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        workers = []
+        for _ in range(count):
+            message = FakeAMQPMessage('bench0', raw_message.encode())
+            payload = json.loads(message.body)
+            workers.append(RESTWorker(extension, None, payload, message))
+        del message, payload
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'requests': count,
+        'body_size': body_size,
+        'retained_bytes': retained,
+        'per_request': round(retained / count),
+        'peak_bytes': peak,
+        'worker_size': sys.getsizeof(workers[0]) + sys.getsizeof(getattr(workers[0], '__dict__', None)),
+    }
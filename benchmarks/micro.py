@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for each stage of the per-message hot path.
+
+Each case is timed with ``timeit``: the best of several repeats is kept to
+reduce the noise. Results can be saved as a JSON baseline and compared with
+a later run.
+"""
+import base64
+import json
+import platform
+import timeit
+
+from benchmarks import harness
+
+
+BODY_SIZES = [1024, 64 * 1024, 1024 * 1024]
+
+
+class FakeAMQPMessage:
+    """Minimal stand-in for a received ``kombu.Message``.
+    """
+    delivery_info = {'routing_key': 'bench0'}
+    properties = {'correlation_id': 'bench', 'reply_to': harness.REPLY_QUEUE}
+    headers = {'replyToExchange': harness.REPLY_EXCHANGE}
+
+
+def get_cases():
+    """Build the benchmark cases.
+
+    The configuration must already be written (see ``harness.write_configuration``).
+
+    Returns:
+        dict: case name -> callable without arguments.
+    """
+    from vcdextproxy import AMQPWorker, RESTWorker, RestApiExtension
+    from vcdextproxy.configuration import get_configuration_item
+
+    extension = RestApiExtension('bench0')
+    raw_message = harness.vcd_message('bench0', 'POST', b'{"hello": "world"}')
+    payload = json.loads(raw_message)
+    worker = RESTWorker(extension, None, payload, FakeAMQPMessage())
+    reply_properties = {
+        'routing_key': 'bench0',
+        'id': worker.id,
+        'correlation_id': 'bench',
+        'reply_to': harness.REPLY_QUEUE,
+        'replyToExchange': harness.REPLY_EXCHANGE,
+        'statusCode': 200,
+    }
+    reply_body = json.dumps({'hello': 'world', 'items': list(range(100))})
+
+    cases = {
+        'json_loads_message': lambda: json.loads(raw_message),
+        'forge_headers': worker.forge_headers,
+        'get_url': lambda: extension.get_url('/api/bench0/test/bench', 'page=1&pageSize=25'),
+        'conf_cached': lambda: get_configuration_item('extensions.bench0.backend.endpoint'),
+        'conf_uncached': lambda: get_configuration_item.__wrapped__('extensions.bench0.backend.endpoint'),
+        'conf_default': lambda: get_configuration_item('extensions.bench0.backend.missing', None),
+        'format_reply': lambda: AMQPWorker.format_reply(reply_body, reply_properties),
+    }
+    for size in BODY_SIZES:
+        body = b"x" * size
+        encoded = base64.b64encode(body)
+        cases[f'b64encode_{size // 1024}k'] = lambda body=body: base64.b64encode(body)
+        cases[f'b64decode_{size // 1024}k'] = lambda encoded=encoded: base64.b64decode(encoded)
+    return cases
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """Time a callable.
+
+    Returns:
+        dict: Best time per call (in microseconds) and the matching rate.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    best = min(timer.repeat(repeat=repeat, number=number)) / number
+    return {'us_per_call': round(best * 1e6, 3), 'calls_per_s': round(1 / best, 1), 'loops': number}
+
+
+def run(selected=None, repeat=5):
+    """Run the micro-benchmarks.
+
+    Args:
+        selected ([str]): Only run the cases containing one of these strings.
+        repeat (int): Number of repeats per case.
+
+    Returns:
+        dict: The results with some context about the environment.
+    """
+    results = {}
+    for name, func in get_cases().items():
+        if selected and not any(s in name for s in selected):
+            continue
+        results[name] = measure(func, repeat=repeat)
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def compare(baseline, current, tolerance=0.1):
+    """Compare two runs.
+
+    Args:
+        baseline (dict): Reference results.
+        current (dict): New results.
+        tolerance (float): Slowdown ratio above which a case is a regression.
+
+    Returns:
+        ([dict], bool): The comparison rows and whether a regression was found.
+    """
+    rows = []
+    regression = False
+    for name, result in current['results'].items():
+        reference = baseline['results'].get(name)
+        if not reference:
+            rows.append({'case': name, 'current': result['us_per_call'], 'baseline': None, 'change': None})
+            continue
+        change = result['us_per_call'] / reference['us_per_call'] - 1
+        slower = change > tolerance
+        regression = regression or slower
+        rows.append({
+            'case': name,
+            'current': result['us_per_call'],
+            'baseline': reference['us_per_call'],
+            'change': round(change * 100, 1),
+            'regression': slower,
+        })
+    return rows, regression
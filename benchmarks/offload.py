@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Latency of small requests while large bodies are encoded and decoded.
+
+Background threads encode and decode large bodies in a loop (as the workers
+do for large requests and replies) while the main thread times the
+processing of small bodies. With the offload pool, the codecs of the large
+bodies run in other processes: the small ones do not wait for the GIL.
+"""
+import base64
+import json
+import threading
+import time
+
+from benchmarks import harness
+
+
+def large_body_loop(offloader, size, stop, counter):
+    """Encode and decode a large message until ``stop`` is set.
+    """
+    message = harness.vcd_message('bench0', 'POST', b"x" * size)
+    while not stop.is_set():
+        payload = offloader.json_loads(message)
+        body = offloader.b64decode(payload[0]['body'])
+        offloader.b64encode(body)
+        counter.append(1)
+
+
+def run(offload=False, large_size=4 * 1024 * 1024, large_threads=2, samples=1000, interval=0.002,
+        min_size=256 * 1024, processes=2):
+    """Time the small requests with large bodies processed alongside.
+
+    Returns:
+        dict: Latency percentiles of the small requests (microseconds) and rate of the large bodies.
+    """
+    from vcdextproxy.offload import Offloader
+
+    offloader = Offloader(processes, min_size if offload else float('inf'))
+    if offload:
+        offloader.start()
+    small = harness.vcd_message('bench0', 'POST', b"x" * 1024)
+    stop = threading.Event()
+    counter = []
+    threads = [
+        threading.Thread(target=large_body_loop, args=(offloader, large_size, stop, counter), daemon=True)
+        for _ in range(large_threads)
+    ]
+    for thread in threads:
+        thread.start()
+    latencies = []
+    started = time.perf_counter()
+    try:
+        for _ in range(samples):
+            # a small request arrives: the time to get the GIL back is part of its latency
+            arrival = time.perf_counter() + interval
+            time.sleep(interval)
+            payload = json.loads(small)
+            base64.b64encode(base64.b64decode(payload[0]['body']))
+            latencies.append(time.perf_counter() - arrival)
+    finally:
+        elapsed = time.perf_counter() - started
+        stop.set()
+        for thread in threads:
+            thread.join()
+        offloader.shutdown()
+    latencies.sort()
+    return {
+        'offload': offload,
+        'large_bodies_per_s': round(len(counter) / elapsed, 1),
+        'small_us': {
+            'p50': round(harness.percentile(latencies, 50) * 1e6, 1),
+            'p99': round(harness.percentile(latencies, 99) * 1e6, 1),
+            'p999': round(harness.percentile(latencies, 99.9) * 1e6, 1),
+            'max': round(latencies[-1] * 1e6, 1),
+        },
+    }
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Replay of a capture of vCD messages (see ``vcdextproxy.capture``).
+
+The messages are published at their original pace (``speed=1``), N times
+faster or as fast as possible (``speed=0``) to the local proxy of the
+harness. The replies are collected as in a load run.
+"""
+import time
+import uuid
+
+from kombu import Exchange
+
+from benchmarks import harness
+from vcdextproxy.capture import read_capture
+
+
+def scan(path):
+    """Return the number of records, the routing keys and the duration of a capture.
+    """
+    count = 0
+    routing_keys = set()
+    first = last = None
+    for record in read_capture(path):
+        count += 1
+        routing_keys.add(record['routing_key'])
+        first = record['t'] if first is None else first
+        last = record['t']
+    return count, sorted(routing_keys), (last - first) if count else 0
+
+
+class ReplayRun(harness.LoadRun):
+    """Drive the local proxy with the messages of a capture.
+    """
+
+    def __init__(self, broker_url, path, routing_keys, speed=1.0):
+        """Prepare a replay.
+
+        Args:
+            broker_url (str): kombu URL of the broker (``memory://`` for in-process).
+            path (str): Path of the capture.
+            routing_keys ([str]): Routing keys of the captured messages (one extension each).
+            speed (float): Replay speed factor (0: as fast as possible).
+        """
+        harness.LoadRun.__init__(self, broker_url, routing_keys)
+        self.path = path
+        self.speed = speed
+        self.max_lag = 0.0
+
+    def inject(self, count):
+        """Publish the first ``count`` messages of the capture on schedule.
+        """
+        exchange = Exchange(harness.EXTENSION_EXCHANGE, 'direct', durable=False)
+        with self.connection() as conn:
+            producer = conn.Producer()
+            start = first = None
+            for index, record in enumerate(read_capture(self.path)):
+                if index >= count:
+                    break
+                if first is None:
+                    first, start = record['t'], time.perf_counter()
+                if self.speed:
+                    delay = start + (record['t'] - first) / self.speed - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        self.max_lag = max(self.max_lag, -delay)
+                correlation_id = str(uuid.uuid4())
+                with self.lock:
+                    self.sent[correlation_id] = (time.perf_counter(), 0, 'other')
+                producer.publish(
+                    record['body'],
+                    exchange=exchange,
+                    routing_key=record['routing_key'],
+                    correlation_id=correlation_id,
+                    reply_to=harness.REPLY_QUEUE,
+                    headers={'replyToExchange': harness.REPLY_EXCHANGE},
+                    content_type='text/plain',
+                    content_encoding='utf-8',
+                )
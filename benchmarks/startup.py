@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Cold start of the proxy: import time and time to the first consumer.
+
+Each run is a new Python process (the configuration must already be
+written, see ``harness.write_configuration``): it imports the proxy, reads
+the configuration and starts consuming on the in-memory transport.
+"""
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+from vcdextproxy import AMQPWorker
+from kombu import Connection
+imported = time.perf_counter()
+from vcdextproxy.configuration import configure_logger, read_configuration
+read_configuration()
+configure_logger()
+configured = time.perf_counter()
+
+
+class Probe(AMQPWorker):
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        now = time.perf_counter()
+        print(json.dumps({
+            'import_ms': (imported - started) * 1000,
+            'configuration_ms': (configured - imported) * 1000,
+            'first_consumer_ms': (now - started) * 1000,
+            'modules': len(sys.modules),
+            'pyvcloud_loaded': 'pyvcloud.vcd.client' in sys.modules,
+        }), flush=True)
+        self.should_stop = True
+
+
+with Connection("memory://") as connection:
+    Probe(connection).run()
+"""
+
+
+def run_once():
+    """Start a proxy process and return its startup timings.
+    """
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", CHILD], stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    elapsed = time.perf_counter() - started
+    process.wait(30)
+    if not line:
+        raise RuntimeError("The proxy process did not start consuming")
+    result = json.loads(line)
+    result['process_ms'] = elapsed * 1000  # including the interpreter startup
+    return result
+
+
+def run(repeat=5):
+    """Run ``repeat`` cold starts.
+
+    Returns:
+        dict: Median of each timing, and the other measures of the last run.
+    """
+    runs = [run_once() for _ in range(repeat)]
+    results = dict(runs[-1])
+    for key in ('import_ms', 'configuration_ms', 'first_consumer_ms', 'process_ms'):
+        results[key] = round(statistics.median(run[key] for run in runs), 1)
+    results['runs'] = repeat
+    return results
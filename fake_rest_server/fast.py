@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+"""Fast fake REST backend for load tests.
+
+An asyncio HTTP/1.1 server (keep-alive, no framework) that can run in
+several processes sharing the same listening socket (TCP or Unix domain
+socket). With ``--http2``, it serves clear text HTTP/2 (prior knowledge,
+needs the ``h2`` package) instead. Response sizes,
+latency distributions, error rates and streamed (chunked) responses are
+configurable globally and can be overridden per request with query
+parameters: ``size``, ``latency_ms``, ``status`` and ``chunks``.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import signal
+import socket
+import threading
+from urllib.parse import parse_qsl
+import click
+
+
+logger = logging.getLogger(__name__)
+
+REASONS = {
+    200: "OK", 201: "Created", 202: "Accepted", 204: "No Content",
+    400: "Bad Request", 404: "Not Found", 429: "Too Many Requests",
+    500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+METHOD_STATUS = {'GET': 200, 'POST': 201, 'PUT': 202, 'DELETE': 201}
+
+
+def parse_latency(spec):
+    """Build a latency generator from a textual specification.
+
+    Supported specifications (values in seconds):
+
+    * ``none``
+    * ``fixed:<delay>``
+    * ``uniform:<min>,<max>``
+    * ``exp:<mean>``
+    * ``lognormal:<median>,<sigma>``
+
+    Args:
+        spec (str): The specification.
+
+    Raises:
+        ValueError: Unknown or invalid specification.
+
+    Returns:
+        function: Callable without arguments returning a delay in seconds.
+    """
+    name, _, args = (spec or "none").partition(':')
+    values = [float(v) for v in args.split(',') if v]
+    if name == "none":
+        return lambda: 0
+    if name == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if name == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if name == "exp" and len(values) == 1:
+        return lambda: random.expovariate(1 / values[0]) if values[0] else 0
+    if name == "lognormal" and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError(f"Invalid latency specification: {spec}")
+
+
+class BackendProfile:
+    """Behavior of the fake backend.
+    """
+
+    def __init__(self, size=0, latency="none", error_rate=0.0, error_status=503,
+                 chunks=0, chunk_interval=0.0, capacity=0):
+        """Define a new backend profile.
+
+        Args:
+            size (int): Minimal size of the response bodies (bytes).
+            latency (str): Latency specification (see ``parse_latency``).
+            error_rate (float): Ratio of requests answered with ``error_status``.
+            error_status (int): HTTP status code of the injected errors.
+            chunks (int): Stream the response in this number of chunks (0: no streaming).
+            chunk_interval (float): Delay between two chunks (seconds).
+            capacity (int): Requests processed concurrently (the others wait: the
+                latency grows with the load), 0 for no limit.
+        """
+        self.size = size
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.chunks = chunks
+        self.chunk_interval = chunk_interval
+        self.capacity = capacity
+        self._slots = None
+        self._padding = {}
+
+    def slots(self):
+        """Return the semaphore of the processing slots (of the current event loop).
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.capacity)
+        return self._slots
+
+    def padding(self, size):
+        """Return (and cache) a padding string of the requested size.
+        """
+        if size not in self._padding:
+            self._padding[size] = "x" * size
+        return self._padding[size]
+
+    def body(self, method, path, headers, size):
+        """Build a JSON response body echoing the request.
+        """
+        content = {'hello': 'world', 'method': method, 'path': path, 'headers': headers}
+        encoded = json.dumps(content)
+        missing = size - len(encoded) - len(', "padding": ""')
+        if missing > 0:
+            content['padding'] = self.padding(missing)
+            encoded = json.dumps(content)
+        return encoded.encode('utf-8')
+
+
+async def read_body(reader, headers):
+    """Read the request body (Content-Length or chunked).
+    """
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()
+                return body
+            body += await reader.readexactly(size)
+            await reader.readline()
+    length = int(headers.get('content-length', 0) or 0)
+    return await reader.readexactly(length) if length else b""
+
+
+async def process(profile, method, target, headers):
+    """Simulate the processing of a request.
+
+    Returns:
+        (int, str, bytes, int): Status code, path, response body and number of chunks.
+    """
+    path, _, query = target.partition("?")
+    params = dict(parse_qsl(query))
+    # simulated latency
+    delay = float(params['latency_ms']) / 1000 if 'latency_ms' in params else profile.latency()
+    if profile.capacity:
+        async with profile.slots():
+            await asyncio.sleep(delay)
+    elif delay > 0:
+        await asyncio.sleep(delay)
+    # status code: forced, injected error or default one for the method
+    if 'status' in params:
+        status = int(params['status'])
+    elif profile.error_rate and random.random() < profile.error_rate:
+        status = profile.error_status
+    else:
+        status = METHOD_STATUS.get(method, 200)
+    body = profile.body(method, path, headers, int(params.get('size', profile.size)))
+    return status, path, body, int(params.get('chunks', profile.chunks))
+
+
+async def handle_request(profile, reader, writer):
+    """Serve the requests of a single (keep-alive) connection.
+    """
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            lines = head.decode('latin-1').split("\r\n")
+            method, target, version = lines[0].split(" ", 2)
+            headers = {}
+            for line in lines[1:]:
+                if line:
+                    key, _, value = line.partition(":")
+                    headers[key.strip().lower()] = value.strip()
+            await read_body(reader, headers)
+            status, path, body, chunks = await process(profile, method, target, headers)
+            keep_alive = version == "HTTP/1.1" and headers.get('connection', '').lower() != "close"
+            response = [
+                f"HTTP/1.1 {status} {REASONS.get(status, 'Unknown')}",
+                "Content-Type: application/json",
+                f"X-FAKE-DATA: {method} request on {path}",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}",
+            ]
+            if chunks > 0:
+                response.append("Transfer-Encoding: chunked")
+                writer.write(("\r\n".join(response) + "\r\n\r\n").encode('latin-1'))
+                step = max(1, -(-len(body) // chunks))
+                for start in range(0, len(body), step):
+                    chunk = body[start:start + step]
+                    writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                    await writer.drain()
+                    if profile.chunk_interval:
+                        await asyncio.sleep(profile.chunk_interval)
+                writer.write(b"0\r\n\r\n")
+            else:
+                response.append(f"Content-Length: {len(body)}")
+                writer.write(("\r\n".join(response) + "\r\n\r\n").encode('latin-1') + body)
+            await writer.drain()
+            if not keep_alive:
+                return
+    except (ConnectionError, ValueError) as e:
+        logger.debug(f"Connection closed: {str(e)}")
+    finally:
+        writer.close()
+
+
+class HTTP2Protocol(asyncio.Protocol):
+    """Serve the requests of a clear text HTTP/2 connection (prior knowledge).
+    """
+
+    def __init__(self, profile):
+        import h2.config
+        import h2.connection
+        import h2.events
+        import h2.exceptions
+        self.h2 = h2
+        self.profile = profile
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding='utf-8'))
+        self.requests = {}  # stream ID -> headers
+        self.window_updated = asyncio.Event()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        events = self.h2.events
+        try:
+            received = self.conn.receive_data(data)
+        except self.h2.exceptions.ProtocolError as e:
+            logger.debug(f"Connection closed: {str(e)}")
+            self.transport.write(self.conn.data_to_send())
+            self.transport.close()
+            return
+        for event in received:
+            if isinstance(event, events.RequestReceived):
+                self.requests[event.stream_id] = dict(event.headers)
+            elif isinstance(event, events.DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, events.StreamEnded):
+                asyncio.ensure_future(self.respond(event.stream_id, self.requests.pop(event.stream_id)))
+            elif isinstance(event, events.WindowUpdated):
+                self.window_updated.set()
+                self.window_updated = asyncio.Event()
+            elif isinstance(event, events.ConnectionTerminated):
+                self.transport.close()
+        self.transport.write(self.conn.data_to_send())
+
+    async def respond(self, stream_id, headers):
+        """Answer the request of a stream.
+        """
+        method, target = headers.pop(':method'), headers.pop(':path')
+        headers = {key: value for key, value in headers.items() if not key.startswith(':')}
+        status, path, body, _ = await process(self.profile, method, target, headers)
+        try:
+            self.conn.send_headers(stream_id, [
+                (':status', str(status)),
+                ('content-type', "application/json"),
+                ('x-fake-data', f"{method} request on {path}"),
+                ('content-length', str(len(body))),
+            ])
+            while body:
+                window = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size)
+                if window <= 0:
+                    self.transport.write(self.conn.data_to_send())
+                    await self.window_updated.wait()
+                    continue
+                self.conn.send_data(stream_id, body[:window])
+                body = body[window:]
+            self.conn.end_stream(stream_id)
+        except self.h2.exceptions.StreamClosedError:
+            pass  # cancelled by the client
+        self.transport.write(self.conn.data_to_send())
+
+
+def create_socket(host, port, unix_path=None):
+    """Create the listening socket shared by all the workers.
+
+    Args:
+        unix_path (str): Path of a Unix domain socket to listen on (instead of ``host`` and ``port``).
+    """
+    if unix_path:
+        if os.path.exists(unix_path):
+            os.unlink(unix_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(unix_path)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+async def serve_socket(sock, profile, started=None, http2=False):
+    """Serve requests on an already bound socket until cancelled.
+    """
+    if http2:
+        server = await asyncio.get_running_loop().create_server(lambda: HTTP2Protocol(profile), sock=sock)
+    else:
+        server = await asyncio.start_server(
+            lambda r, w: handle_request(profile, r, w),
+            sock=sock,
+            limit=1024 * 1024,
+        )
+    if started:
+        started()
+    async with server:
+        await server.serve_forever()
+
+
+def serve(host, port, profile, workers=1, unix_path=None, http2=False):
+    """Run the server with ``workers`` processes (blocking).
+    """
+    sock = create_socket(host, port, unix_path)
+    children = []
+    for _ in range(workers - 1):
+        pid = os.fork()
+        if pid == 0:  # child process
+            asyncio.run(serve_socket(sock, profile, http2=http2))
+            os._exit(0)
+        children.append(pid)
+    try:
+        asyncio.run(serve_socket(sock, profile, http2=http2))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+
+def start_in_thread(profile, host="127.0.0.1", port=0, unix_path=None, http2=False):
+    """Start the server in a daemon thread of the current process.
+
+    Args:
+        unix_path (str): Listen on this Unix domain socket.
+        http2 (bool): Serve clear text HTTP/2 (prior knowledge).
+
+    Returns:
+        str: The endpoint of the server (``http://``, ``h2c://`` or ``unix://``).
+    """
+    sock = create_socket(host, port, unix_path)
+    ready = threading.Event()
+    threading.Thread(
+        target=lambda: asyncio.run(serve_socket(sock, profile, ready.set, http2)),
+        name="fake-rest-server",
+        daemon=True
+    ).start()
+    ready.wait(5)
+    if unix_path:
+        return f"unix://{unix_path}"
+    return f"{'h2c' if http2 else 'http'}://{host}:{sock.getsockname()[1]}"
+
+
+@click.command()
+@click.option('-h', '--host', default="127.0.0.1", help="Bind server to a specific interface")
+@click.option('-p', '--port', default=5000, help='Bind server to a specific port')
+@click.option('-w', '--workers', default=1, help="Number of worker processes")
+@click.option('-s', '--size', default=0, help="Minimal size of the response bodies (bytes)")
+@click.option('-l', '--latency', default="none",
+              help="Latency distribution: none, fixed:S, uniform:MIN,MAX, exp:MEAN or lognormal:MEDIAN,SIGMA")
+@click.option('-e', '--error-rate', default=0.0, help="Ratio of requests answered with an error")
+@click.option('--error-status', default=503, help="HTTP status code of the injected errors")
+@click.option('-c', '--chunks', default=0, help="Stream responses in this number of chunks")
+@click.option('--chunk-interval', default=0.0, help="Delay between two streamed chunks (seconds)")
+@click.option('--capacity', default=0, help="Requests processed concurrently per worker (0: no limit)")
+@click.option('-u', '--unix', 'unix_path', default=None, help="Listen on a Unix domain socket (path)")
+@click.option('--http2', is_flag=True, help="Serve clear text HTTP/2 (prior knowledge) instead of HTTP/1.1")
+def main(host, port, workers, size, latency, error_rate, error_status, chunks, chunk_interval, capacity,
+         unix_path, http2):
+    """Execute the fast fake REST API.
+    """
+    try:
+        profile = BackendProfile(size, latency, error_rate, error_status, chunks, chunk_interval, capacity)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    logger.info(f"Starting the fast REST API on {unix_path or f'{host}:{port}'} with {workers} worker(s)...")
+    serve(host, port, profile, workers, unix_path, http2)
+
+
+if __name__ == '__main__':
+    main()
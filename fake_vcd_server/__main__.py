@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""Run a fake vCloud Director API for offline tests of the proxy.
+"""
+import logging
+import click
+
+from fake_vcd_server.server import CALL_CATEGORIES, FakeVcd, make_server
+
+
+logger = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option('-h', '--host', default="127.0.0.1", help="Bind server to a specific interface")
+@click.option('-p', '--port', default=8443, help='Bind server to a specific port')
+@click.option('--tenant-org-id', default=None, help="UUID of the tenant organization")
+@click.option('--rights', default=300, help="Number of fake rights in the catalog")
+@click.option('--admin-password', default="admin", help="Password of admin@System")
+@click.option('--user-password', default="user", help="Password of user@tenant1 and vappuser@tenant1")
+@click.option('--accept-any-token', is_flag=True, help="Map unknown tokens to a user@tenant1 session")
+@click.option('-l', '--latency', default="none", help="Latency distribution of each call (see fake_rest_server.fast)")
+@click.option('--call-latency', multiple=True,
+              help=f"Latency for a call category: CATEGORY=SPEC ({', '.join(CALL_CATEGORIES)})")
+def main(host, port, tenant_org_id, rights, admin_password, user_password, accept_any_token, latency,
+         call_latency):
+    """Execute the fake vCD API.
+    """
+    call_latencies = dict(item.split('=', 1) for item in call_latency)
+    try:
+        vcd = FakeVcd(tenant_org_id, rights, admin_password, user_password, accept_any_token,
+                      latency, call_latencies)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    logger.info(f"Starting the fake vCD API on http://{host}:{port}...")
+    make_server(vcd, host, port).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+"""Fake vCloud Director API for offline tests of the proxy.
+
+Only the subset of the vCD API used by the proxy (through pyvcloud) is
+implemented: sessions (legacy and cloudapi), organizations, the typed query
+service (rights, roles, API extensions and filters), roles with their rights
+and the API extension services. Each call can be slowed down by a latency
+distribution (per call category) and every call is counted (``/fake/stats``).
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+from fake_rest_server.fast import parse_latency
+
+
+logger = logging.getLogger(__name__)
+
+NS_VCLOUD = "http://www.vmware.com/vcloud/v1.5"
+NS_VMEXT = "http://www.vmware.com/vcloud/extension/v1.5"
+API_VERSIONS = ["31.0", "32.0", "33.0", "34.0", "35.0"]
+CALL_CATEGORIES = ["versions", "login", "session", "org", "query", "role", "extension"]
+WELL_KNOWN_RIGHTS = [
+    "UI Plugins: View",
+    "Organization: View",
+    "vApp: Create / Reconfigure a vApp",
+    "vApp: View VM metrics",
+    "Catalog: View Private and Shared Catalogs",
+    "General: Administrator View",
+]
+QUERY_FORMATS = {
+    'records': "application/vnd.vmware.vcloud.query.records+xml",
+    'idrecords': "application/vnd.vmware.vcloud.query.idrecords+xml",
+    'references': "application/vnd.vmware.vcloud.query.references+xml",
+}
+QUERY_TYPES = {  # query type -> (record element, URN type)
+    'right': ('RightRecord', 'right'),
+    'role': ('RoleRecord', 'role'),
+    'adminRole': ('AdminRoleRecord', 'role'),
+    'adminService': ('AdminServiceRecord', 'service'),
+    'apiFilter': ('ApiFilterRecord', 'apifilter'),
+}
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+class FakeVcd:
+    """In-memory state of the fake vCD: orgs, users, rights, roles, extensions and sessions.
+    """
+
+    def __init__(self, tenant_org_id=None, rights_count=300, admin_password="admin",
+                 user_password="user", accept_any_token=False, latency="none",
+                 call_latencies=None, token_ttl=3600, jwt_secret=None):
+        """Build a new fake vCD.
+
+        Args:
+            tenant_org_id (str): UUID of the tenant organization (random if not set).
+            rights_count (int): Number of rights in the catalog (on top of the well known ones).
+            admin_password (str): Password of ``admin@System``.
+            user_password (str): Password of the tenant users.
+            accept_any_token (bool): Map unknown tokens to a tenant user session.
+            latency (str): Default latency specification of each call.
+            call_latencies (dict): Latency specification per call category.
+            token_ttl (int): Lifetime of the sessions (seconds).
+            jwt_secret (str): HS256 secret used to sign the access tokens.
+        """
+        self.lock = threading.Lock()
+        self.accept_any_token = accept_any_token
+        self.token_ttl = token_ttl
+        self.jwt_secret = (jwt_secret or uuid.uuid4().hex).encode()
+        self.latency = {'default': parse_latency(latency)}
+        for category, spec in (call_latencies or {}).items():
+            self.latency[category] = parse_latency(spec)
+        self.stats = {category: 0 for category in CALL_CATEGORIES}
+        self.sessions = {}  # token -> session
+        self.extensions = {}  # id -> extension
+        self.filters = {}  # id -> api filter
+        # rights catalog
+        self.rights = {}  # id -> name
+        for name in WELL_KNOWN_RIGHTS + [f"Fake Right {i:04d}" for i in range(rights_count)]:
+            self.rights[str(uuid.uuid4())] = name
+        all_rights = list(self.rights)
+        limited_rights = [r for r in all_rights if self.rights[r] != "UI Plugins: View"][::2]
+        # organizations, users and roles
+        self.orgs = {}  # id -> org
+        self.roles = {}  # id -> role
+        self.users = {}  # "user@org" -> user
+        for org_name, org_id in [("System", str(uuid.uuid4())), ("tenant1", tenant_org_id or str(uuid.uuid4()))]:
+            self.orgs[org_id] = {'id': org_id, 'name': org_name}
+            if org_name == "System":
+                role_id = self._add_role(org_id, "System Administrator", all_rights)
+                self._add_user("admin", org_id, role_id, admin_password)
+            else:
+                role_id = self._add_role(org_id, "Organization Administrator", all_rights)
+                self._add_user("user", org_id, role_id, user_password)
+                role_id = self._add_role(org_id, "vApp User", limited_rights)
+                self._add_user("vappuser", org_id, role_id, user_password)
+
+    def _add_role(self, org_id, name, rights):
+        role_id = str(uuid.uuid4())
+        self.roles[role_id] = {'id': role_id, 'name': name, 'org_id': org_id, 'rights': rights}
+        return role_id
+
+    def _add_user(self, name, org_id, role_id, password):
+        user_id = str(uuid.uuid4())
+        key = f"{name}@{self.orgs[org_id]['name']}"
+        self.users[key] = {'id': user_id, 'name': name, 'org_id': org_id, 'role_id': role_id, 'password': password}
+
+    def org_by_name(self, name):
+        for org in self.orgs.values():
+            if org['name'].lower() == name.lower():
+                return org
+        return None
+
+    def right_id(self, name):
+        """Return the ID of a right from its name (or None).
+        """
+        for right_id, right_name in self.rights.items():
+            if right_name == name:
+                return right_id
+        return None
+
+    def tenant_user(self):
+        return self.users["user@tenant1"]
+
+    def wait(self, category):
+        """Count the call and apply the configured latency.
+        """
+        with self.lock:
+            self.stats[category] += 1
+        delay = self.latency.get(category, self.latency['default'])()
+        if delay > 0:
+            time.sleep(delay)
+
+    def create_session(self, user, token=None):
+        """Open a new session for a user.
+
+        Returns:
+            (str, str): The legacy auth token and the JWT access token.
+        """
+        token = token or uuid.uuid4().hex
+        now = int(time.time())
+        org = self.orgs[user['org_id']]
+        claims = {
+            'sub': user['name'],
+            'iss': f"{org['id']}@{org['name']}",
+            'iat': now,
+            'exp': now + self.token_ttl,
+            'jti': str(uuid.uuid4()),
+            'org': f"urn:vcloud:org:{org['id']}",
+            'user': f"urn:vcloud:user:{user['id']}",
+            'roles': [self.roles[user['role_id']]['name']],
+        }
+        header = _b64url(json.dumps({'alg': 'HS256', 'typ': 'JWT'}).encode())
+        payload = _b64url(json.dumps(claims).encode())
+        signature = _b64url(hmac.new(self.jwt_secret, f"{header}.{payload}".encode(), hashlib.sha256).digest())
+        access_token = f"{header}.{payload}.{signature}"
+        session = {'user': user, 'expires': claims['exp'], 'token': token}
+        with self.lock:
+            self.sessions[token] = session
+            self.sessions[access_token] = session
+        return token, access_token
+
+    def session_from_token(self, token):
+        """Return the session matching a token (or None).
+        """
+        if not token:
+            return None
+        with self.lock:
+            session = self.sessions.get(token)
+        if session and session['expires'] < time.time():
+            return None
+        if not session and self.accept_any_token:
+            self.create_session(self.tenant_user(), token)
+            return self.sessions[token]
+        return session
+
+
+class FakeVcdHandler(BaseHTTPRequestHandler):
+    """HTTP handler emulating the vCD API endpoints used by the proxy.
+    """
+    protocol_version = "HTTP/1.1"
+    vcd = None  # set by ``make_server``
+
+    # ---- helpers ----
+    @property
+    def base(self):
+        return f"http://{self.headers.get('Host')}"
+
+    def send(self, status_code, content=b"", content_type="application/*+xml;version=33.0", headers=None):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_error_xml(self, status_code, message):
+        self.send(status_code, f'<Error xmlns="{NS_VCLOUD}" majorErrorCode="{status_code}" '
+                               f'message={quoteattr(message)} minorErrorCode="ERROR"/>')
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        return self.rfile.read(length) if length else b""
+
+    def current_session(self):
+        token = self.headers.get('x-vcloud-authorization')
+        authorization = self.headers.get('Authorization', '')
+        if not token and authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        return self.vcd.session_from_token(token)
+
+    def link(self, rel, media_type, href, name=None):
+        name_attr = f" name={quoteattr(name)}" if name else ""
+        return f'<Link rel="{rel}" type="{media_type}" href={quoteattr(self.base + href)}{name_attr}/>'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    # ---- routing ----
+    def route(self, method):
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if path == "/api/versions":
+            self.vcd.wait('versions')
+            return self.versions()
+        if path in ("/api/sessions", "/cloudapi/1.0.0/sessions", "/cloudapi/1.0.0/sessions/provider"):
+            self.vcd.wait('login')
+            return self.login(path)
+        session = self.current_session()
+        if not session:
+            return self.send_error_xml(401, "Unauthorized")
+        user = session['user']
+        if path == "/api/session":
+            self.vcd.wait('session')
+            if method == "DELETE":
+                return self.send(204)
+            return self.session(user, {'x-vcloud-authorization': session['token']})
+        if path == "/api/org":
+            self.vcd.wait('org')
+            return self.org_list(user)
+        if path.startswith("/api/org/"):
+            self.vcd.wait('org')
+            return self.org(user, path.split('/')[-1])
+        if path == "/api/query":
+            self.vcd.wait('query')
+            if 'type' not in params:
+                return self.query_list()
+            return self.query(user, params)
+        if path.startswith("/api/admin/role/"):
+            self.vcd.wait('role')
+            return self.role(path.split('/')[-1])
+        if path.startswith("/api/admin/extension"):
+            self.vcd.wait('extension')
+            if not self.is_sysadmin(user):
+                return self.send_error_xml(403, "Forbidden")
+            return self.extension(method, path)
+        return self.send_error_xml(404, f"Unknown resource: {path}")
+
+    def do_GET(self):  # noqa: N802
+        if self.path == "/fake/stats":
+            with self.vcd.lock:
+                content = json.dumps(self.vcd.stats)
+            return self.send(200, content, "application/json")
+        self.route("GET")
+
+    def do_POST(self):  # noqa: N802
+        self.route("POST")
+
+    def do_PUT(self):  # noqa: N802
+        self.route("PUT")
+
+    def do_DELETE(self):  # noqa: N802
+        self.route("DELETE")
+
+    def is_sysadmin(self, user):
+        return self.vcd.orgs[user['org_id']]['name'] == "System"
+
+    # ---- endpoints ----
+    def versions(self):
+        content = "".join(f"<VersionInfo deprecated=\"false\"><Version>{v}</Version></VersionInfo>"
+                          for v in API_VERSIONS)
+        self.send(200, f'<SupportedVersions xmlns="{NS_VCLOUD}">{content}</SupportedVersions>')
+
+    def login(self, path):
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('Basic '):
+            return self.send_error_xml(401, "Missing credentials")
+        username, _, password = base64.b64decode(authorization[6:]).decode().partition(':')
+        user = self.vcd.users.get(username)
+        if not user:  # case insensitive organization name
+            name, _, org_name = username.partition('@')
+            org = self.vcd.org_by_name(org_name)
+            user = self.vcd.users.get(f"{name}@{org['name']}") if org else None
+        if not user or user['password'] != password:
+            return self.send_error_xml(401, "Invalid credentials")
+        if path.endswith("/provider") != self.is_sysadmin(user) and path.startswith("/cloudapi"):
+            return self.send_error_xml(401, "Invalid login endpoint for this organization")
+        token, access_token = self.vcd.create_session(user)
+        headers = {'x-vcloud-authorization': token, 'X-VMWARE-VCLOUD-ACCESS-TOKEN': access_token,
+                   'X-VMWARE-VCLOUD-TOKEN-TYPE': 'Bearer'}
+        if path.startswith("/cloudapi"):
+            org = self.vcd.orgs[user['org_id']]
+            content = json.dumps({'id': f"urn:vcloud:session:{uuid.uuid4()}", 'user': {'name': user['name']},
+                                  'org': {'name': org['name'], 'id': f"urn:vcloud:org:{org['id']}"}})
+            return self.send(200, content, "application/json", headers)
+        self.session(user, headers)
+
+    def session(self, user, headers=None):
+        org = self.vcd.orgs[user['org_id']]
+        role = self.vcd.roles[user['role_id']]
+        links = [
+            self.link("down", "application/vnd.vmware.vcloud.org+xml", f"/api/org/{org['id']}", org['name']),
+            self.link("down", "application/vnd.vmware.vcloud.orgList+xml", "/api/org"),
+            self.link("down", "application/vnd.vmware.vcloud.query.queryList+xml", "/api/query"),
+        ]
+        if self.is_sysadmin(user):
+            links.append(self.link("down", "application/vnd.vmware.admin.vcloud+xml", "/api/admin"))
+            links.append(self.link("down", "application/vnd.vmware.admin.vmwExtension+xml", "/api/admin/extension"))
+        self.send(200, (
+            f'<Session xmlns="{NS_VCLOUD}" user={quoteattr(user["name"])} org={quoteattr(org["name"])} '
+            f'roles={quoteattr(role["name"])} userId="urn:vcloud:user:{user["id"]}" '
+            f'href="{self.base}/api/session" type="application/vnd.vmware.vcloud.session+xml">'
+            + "".join(links) + '</Session>'
+        ), headers=headers)
+
+    def org_xml(self, org):
+        return (f'<Org xmlns="{NS_VCLOUD}" name={quoteattr(org["name"])} id="urn:vcloud:org:{org["id"]}" '
+                f'href="{self.base}/api/org/{org["id"]}" type="application/vnd.vmware.vcloud.org+xml"/>')
+
+    def org_list(self, user):
+        orgs = self.vcd.orgs.values() if self.is_sysadmin(user) else [self.vcd.orgs[user['org_id']]]
+        content = "".join(self.org_xml(org) for org in orgs)
+        self.send(200, f'<OrgList xmlns="{NS_VCLOUD}">{content}</OrgList>')
+
+    def org(self, user, org_id):
+        org = self.vcd.orgs.get(org_id)
+        if not org or (org_id != user['org_id'] and not self.is_sysadmin(user)):
+            return self.send_error_xml(404, "Organization not found")
+        self.send(200, self.org_xml(org))
+
+    def query_list(self):
+        links = []
+        for query_type in QUERY_TYPES:
+            for query_format, media_type in QUERY_FORMATS.items():
+                links.append(self.link("down", media_type, f"/api/query?type={query_type}&format={query_format}",
+                                       query_type))
+        self.send(200, f'<QueryList xmlns="{NS_VCLOUD}">' + "".join(links) + '</QueryList>')
+
+    def records(self, user, query_type):
+        """Return the records (as attribute dicts) visible by the user for a query type.
+        """
+        vcd = self.vcd
+        if query_type == 'right':
+            return [{'name': name, 'href': f"{self.base}/api/admin/right/{right_id}", 'id': right_id,
+                     'category': "Fake", 'rightType': "MODIFY"} for right_id, name in vcd.rights.items()]
+        if query_type in ('role', 'adminRole'):
+            return [{'name': role['name'], 'href': f"{self.base}/api/admin/role/{role['id']}", 'id': role['id'],
+                     'isReadOnly': "false", 'org': f"{self.base}/api/org/{role['org_id']}",
+                     'orgName': vcd.orgs[role['org_id']]['name']}
+                    for role in vcd.roles.values()
+                    if query_type == 'adminRole' or role['org_id'] == user['org_id']]
+        if query_type == 'adminService':
+            return [{'name': ext['name'], 'namespace': ext['namespace'], 'enabled': ext['enabled'],
+                     'exchange': ext['exchange'], 'routingKey': ext['routingKey'], 'priority': "50",
+                     'isAuthorizationEnabled': "false", 'vendor': "fake",
+                     'href': f"{self.base}/api/admin/extension/service/{ext['id']}", 'id': ext['id']}
+                    for ext in vcd.extensions.values()]
+        if query_type == 'apiFilter':
+            return [{'urlPattern': f['urlPattern'], 'service': f['service'],
+                     'href': f"{self.base}/api/admin/extension/service/apifilter/{f['id']}", 'id': f['id']}
+                    for f in vcd.filters.values()]
+        return []
+
+    def query(self, user, params):
+        query_type = params['type']
+        if query_type not in QUERY_TYPES:
+            return self.send_error_xml(400, f"Unsupported query type: {query_type}")
+        if query_type.startswith('admin') and not self.is_sysadmin(user):
+            return self.send_error_xml(403, "Forbidden")
+        records = self.records(user, query_type)
+        # filters: "key==value;key==value"
+        for expression in filter(None, params.get('filter', '').split(';')):
+            key, _, value = expression.partition('==')
+            value = unquote(value)
+            if key == 'service':  # filter on the service ID
+                value = value.split(':')[-1]
+            records = [r for r in records if str(r.get(key)) == value]
+        page, page_size = int(params.get('page', 1)), int(params.get('pageSize', 25))
+        page_records = records[(page - 1) * page_size:page * page_size]
+        element, urn_type = QUERY_TYPES[query_type]
+        content = []
+        if page * page_size < len(records):
+            next_params = dict(params, page=str(page + 1))
+            next_query = "&amp;".join(f"{k}={escape(v)}" for k, v in next_params.items())
+            content.append(f'<Link rel="nextPage" type="{QUERY_FORMATS[params.get("format", "records")]}" '
+                           f'href="{self.base}/api/query?{next_query}"/>')
+        for record in page_records:
+            attributes = dict(record, id=f"urn:vcloud:{urn_type}:{record['id']}")
+            content.append(f"<{element} " + " ".join(
+                f"{k}={quoteattr(str(v))}" for k, v in attributes.items()) + "/>")
+        self.send(200, (
+            f'<QueryResultRecords xmlns="{NS_VCLOUD}" name="{query_type}" page="{page}" '
+            f'pageSize="{page_size}" total="{len(records)}">' + "".join(content) + '</QueryResultRecords>'
+        ))
+
+    def role(self, role_id):
+        role = self.vcd.roles.get(role_id)
+        if not role:
+            return self.send_error_xml(404, "Role not found")
+        references = "".join(
+            f'<RightReference name={quoteattr(self.vcd.rights[r])} href="{self.base}/api/admin/right/{r}" '
+            f'type="application/vnd.vmware.admin.right+xml"/>' for r in role['rights'])
+        self.send(200, (
+            f'<Role xmlns="{NS_VCLOUD}" name={quoteattr(role["name"])} id="urn:vcloud:role:{role["id"]}" '
+            f'href="{self.base}/api/admin/role/{role["id"]}" type="application/vnd.vmware.admin.role+xml">'
+            f'<RightReferences>{references}</RightReferences></Role>'
+        ))
+
+    def service_xml(self, ext):
+        filters = "".join(f"<vmext:ApiFilter><vmext:UrlPattern>{escape(f['urlPattern'])}</vmext:UrlPattern>"
+                          f"</vmext:ApiFilter>" for f in self.vcd.filters.values() if f['service'] == ext['id'])
+        return (
+            f'<vmext:Service xmlns="{NS_VCLOUD}" xmlns:vmext="{NS_VMEXT}" name={quoteattr(ext["name"])} '
+            f'id="urn:vcloud:service:{ext["id"]}" href="{self.base}/api/admin/extension/service/{ext["id"]}" '
+            f'type="application/vnd.vmware.admin.service+xml">'
+            f'<vmext:Namespace>{escape(ext["namespace"])}</vmext:Namespace>'
+            f'<vmext:Enabled>{ext["enabled"]}</vmext:Enabled>'
+            f'<vmext:RoutingKey>{escape(ext["routingKey"])}</vmext:RoutingKey>'
+            f'<vmext:Exchange>{escape(ext["exchange"])}</vmext:Exchange>'
+            f'<vmext:ApiFilters>{filters}</vmext:ApiFilters></vmext:Service>'
+        )
+
+    def extension(self, method, path):
+        parts = path.split('/')[3:]  # ['extension', 'service', <id>]
+        if parts == ['extension']:
+            return self.send(200, (
+                f'<vmext:VMWExtension xmlns="{NS_VCLOUD}" xmlns:vmext="{NS_VMEXT}" '
+                f'href="{self.base}/api/admin/extension">'
+                + self.link("down", "application/vnd.vmware.admin.extensionServices+xml",
+                            "/api/admin/extension/service")
+                + '</vmext:VMWExtension>'
+            ))
+        if parts == ['extension', 'service']:
+            if method == "POST":
+                return self.save_service(None)
+            return self.send(200, (
+                f'<vmext:ExtensionServices xmlns="{NS_VCLOUD}" xmlns:vmext="{NS_VMEXT}" '
+                f'href="{self.base}/api/admin/extension/service">'
+                + self.link("add", "application/vnd.vmware.admin.service+xml", "/api/admin/extension/service")
+                + '</vmext:ExtensionServices>'
+            ))
+        ext = self.vcd.extensions.get(parts[-1]) if len(parts) == 3 else None
+        if not ext:
+            return self.send_error_xml(404, "Extension service not found")
+        if method == "PUT":
+            return self.save_service(ext)
+        if method == "DELETE":
+            with self.vcd.lock:
+                self.vcd.extensions.pop(ext['id'])
+                for filter_id in [k for k, f in self.vcd.filters.items() if f['service'] == ext['id']]:
+                    self.vcd.filters.pop(filter_id)
+            return self.send(204)
+        self.send(200, self.service_xml(ext))
+
+    def save_service(self, ext):
+        """Create (``ext`` is None) or update an extension service from the request body.
+        """
+        try:
+            service = ElementTree.fromstring(self.read_body())
+        except ElementTree.ParseError:
+            return self.send_error_xml(400, "Invalid XML content")
+
+        def text(tag, default=None):
+            element = service.find(f"{{{NS_VMEXT}}}{tag}")
+            return element.text if element is not None else default
+
+        with self.vcd.lock:
+            created = ext is None
+            if created:
+                ext = {'id': str(uuid.uuid4())}
+                self.vcd.extensions[ext['id']] = ext
+            ext.update({
+                'name': service.get('name', ext.get('name')),
+                'namespace': text('Namespace', ext.get('namespace')),
+                'enabled': text('Enabled', ext.get('enabled', 'true')),
+                'routingKey': text('RoutingKey', ext.get('routingKey')),
+                'exchange': text('Exchange', ext.get('exchange')),
+            })
+            for pattern in service.iter(f"{{{NS_VMEXT}}}UrlPattern"):
+                filter_id = str(uuid.uuid4())
+                self.vcd.filters[filter_id] = {'id': filter_id, 'service': ext['id'], 'urlPattern': pattern.text}
+        self.send(201 if created else 200, self.service_xml(ext))
+
+
+def make_server(vcd, host="127.0.0.1", port=0):
+    """Create the HTTP server for a fake vCD.
+
+    Returns:
+        ThreadingHTTPServer: The server (not started).
+    """
+    handler = type("BoundFakeVcdHandler", (FakeVcdHandler,), {'vcd': vcd})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_thread(vcd, host="127.0.0.1", port=0):
+    """Start a fake vCD in a daemon thread.
+
+    Returns:
+        str: The base URL of the server.
+    """
+    server = make_server(vcd, host, port)
+    threading.Thread(target=server.serve_forever, name="fake-vcd-server", daemon=True).start()
+    return f"http://{host}:{server.server_address[1]}"
@@ -15,7 +15,7 @@ requirements = [
     "kombu",
     "coloredlogs",
     "requests",
-    "cachetools",
+    "cachetools>=5.4",
     "PyYAML",
     "pyvcloud"
 ]
@@ -34,18 +34,18 @@ description += "for incoming requests of VMware vCloud Director's API Extensions
 setup(
     author="Ludovic Rivallain",
     author_email='ludovic.rivallain@gmail.com',
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
     ],
     description=description,
     install_requires=requirements,
+    extras_require={'jwt': ['cryptography'], 'zstd': ['zstandard'], 'http2': ['httpx[http2]']},
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""Shared fixtures for the tests of `vcdextproxy`."""
+
+import os
+import pytest
+
+# vcdextproxy needs a configuration directory to be imported
+os.environ.setdefault(
+    'VCDEXTPROXY_CONFIGURATION_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), 'samples')
+)
+
+
+@pytest.fixture(scope='session')
+def fake_vcd():
+    """Start a fake vCD API server for the test session."""
+    from fake_vcd_server.server import FakeVcd, start_in_thread
+    vcd = FakeVcd(tenant_org_id="a93c9db9-7471-3192-8d09-a8f7eeda85f9", rights_count=50)
+    vcd.url = start_in_thread(vcd)
+    return vcd
+
+
+@pytest.fixture
+def vcd_conf(fake_vcd, monkeypatch):
+    """Point the vCD helpers to the fake vCD API server."""
+    from vcdextproxy import vcd_utils
+    settings = {
+        'global.vcloud.hostname': fake_vcd.url,
+        'global.vcloud.api_version': "33.0",
+        'global.vcloud.ssl_verify': False,
+        'global.vcloud.username': "admin",
+        'global.vcloud.password': "admin",
+        'global.vcloud.system_org': "System",
+        'global.pyvcloud.log_file': os.devnull,
+        'global.pyvcloud.log_requests': False,
+        'global.pyvcloud.log_headers': False,
+        'global.pyvcloud.log_bodies': False,
+    }
+    monkeypatch.setattr(vcd_utils, 'conf', lambda item, default=None: settings.get(item, default))
+    return settings
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the admin endpoint."""
+
+import json
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+
+from vcdextproxy import AMQPWorker
+from vcdextproxy.admin import start_admin_server
+
+
+def get(server, path):
+    url = f"http://127.0.0.1:{server.server_address[1]}{path}"
+    try:
+        with urllib.request.urlopen(url, timeout=5) as rsp:
+            return rsp.status, json.loads(rsp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_admin_views():
+    worker = AMQPWorker(None)
+    assert worker.load_extensions()
+    for age, correlation_id in [(1, "fast"), (5, "slow")]:
+        worker.inflight[correlation_id] = SimpleNamespace(
+            describe=lambda now, age=age, correlation_id=correlation_id: {'id': correlation_id, 'age_s': age}
+        )
+    server = start_admin_server(worker, "127.0.0.1", 0)
+    try:
+        assert get(server, "/healthz") == (200, {'alive': True})
+        assert get(server, "/readyz") == (503, {'ready': False})
+        status, extensions = get(server, "/extensions")
+        assert status == 200
+        assert {extension['name'] for extension in extensions} == {'example1', 'example2'}
+        assert get(server, "/inflight?slowest=1") == (200, [{'id': "slow", 'age_s': 5}])
+        status, workers = get(server, "/workers")
+        assert workers == {'started': False}
+        status, caches = get(server, "/caches")
+        assert set(caches) == {'configuration', 'role_rights', 'tokens', 'rights_index', 'replies'}
+        assert get(server, "/inflight?slowest=x")[0] == 400
+        assert get(server, "/unknown")[0] == 404
+        url = f"http://127.0.0.1:{server.server_address[1]}/profile?seconds=0.05"
+        with urllib.request.urlopen(url, timeout=5) as rsp:
+            assert b"admin-endpoint;" in rsp.read()
+        assert get(server, "/profile?seconds=0")[0] == 400
+    finally:
+        server.shutdown()
+        server.server_close()
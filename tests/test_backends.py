@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the backend transports."""
+
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import requests
+from fake_rest_server import fast
+from vcdextproxy.backends import Backend
+
+
+def send_all(backend, count=10):
+    with ThreadPoolExecutor(count) as executor:
+        return list(executor.map(
+            lambda i: backend.get_sender('post')(f"{backend.base_url}/test/{i}", data=b'{}', timeout=5), range(count)
+        ))
+
+
+def test_http():
+    backend = Backend(fast.start_in_thread(fast.BackendProfile()))
+    assert backend.transport == "http/1.1"
+    assert [r.status_code for r in send_all(backend)] == [201] * 10
+    with pytest.raises(AttributeError):
+        backend.get_sender('close')
+
+
+def test_unix_socket():
+    path = os.path.join(tempfile.mkdtemp(), "backend.sock")
+    endpoint = fast.start_in_thread(fast.BackendProfile(latency="fixed:0.05"), unix_path=path)
+    assert endpoint == f"unix://{path}"
+    backend = Backend(endpoint, pool_size=10)
+    assert backend.transport == "unix"
+    responses = send_all(backend)
+    assert [r.json()['path'] for r in responses] == [f"/test/{i}" for i in range(10)]
+    send_all(backend)
+    assert backend.session.get_adapter(backend.base_url).pool.num_connections == 10  # reused
+    with pytest.raises(requests.exceptions.ConnectionError):
+        Backend("unix:///nonexistent.sock").get_sender('get')("http://localhost/test", timeout=1)
+
+
+def test_http2():
+    pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+    endpoint = fast.start_in_thread(fast.BackendProfile(latency="fixed:0.05", size=100000), http2=True)
+    backend = Backend(endpoint)
+    assert backend.transport == "http2" and backend.base_url.startswith("http://")
+    responses = send_all(backend)
+    assert [r.status_code for r in responses] == [201] * 10
+    assert len(responses[0].content) >= 100000 and responses[0].headers['content-type'] == "application/json"
+    # all the requests are multiplexed on a single connection
+    assert len(backend.session.get_adapter(backend.base_url).client._transport._pool.connections) == 1
+    with pytest.raises(requests.exceptions.Timeout):
+        backend.get_sender('get')(f"{backend.base_url}/test/slow?latency_ms=500", timeout=0.1)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the capture of the received messages."""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from vcdextproxy.capture import CaptureWriter, read_capture, redact_tokens
+
+
+def vcd_message(token):
+    return json.dumps([
+        {'id': "request", 'headers': {'Accept': "application/json", 'x-vcloud-authorization': token}},
+        {'org': "urn:vcloud:org:org-id"},
+    ])
+
+
+def test_redact_tokens():
+    content = json.loads(redact_tokens(vcd_message("secret")))
+    assert content[0]['headers'] == {'Accept': "application/json", 'x-vcloud-authorization': "redacted"}
+    assert redact_tokens("not a vCD message") == "not a vCD message"
+
+
+@pytest.mark.parametrize('name', ["capture.jsonl", "capture.jsonl.gz"])
+def test_capture_and_read(tmp_path, name):
+    path = str(tmp_path / name)
+    message = SimpleNamespace(
+        delivery_info={'exchange': "exchange", 'routing_key': "example1"},
+        properties={'correlation_id': "correlation"}
+    )
+    writer = CaptureWriter(path)
+    writer.write(vcd_message("secret"), message)
+    writer.close()
+    # captures are appended
+    writer = CaptureWriter(path, redact=False)
+    writer.write(vcd_message("other-secret").encode(), message)
+    writer.close()
+    records = list(read_capture(path))
+    assert [record['routing_key'] for record in records] == ["example1", "example1"]
+    assert records[0]['t'] <= records[1]['t']
+    assert "secret" not in records[0]['body']
+    assert "other-secret" in records[1]['body']
+
+
+def test_drain_closes_the_capture(tmp_path, monkeypatch):
+    from vcdextproxy import AMQPWorker, capture
+    path = str(tmp_path / "capture.jsonl.gz")
+    settings = {'global.capture.enabled': True, 'global.capture.path': path}
+    monkeypatch.setattr(capture, 'conf', lambda item, default=None: settings.get(item, default))
+    worker = AMQPWorker(None)
+    message = SimpleNamespace(
+        delivery_info={'exchange': "exchange", 'routing_key': "example1"},
+        properties={'correlation_id': "correlation"}
+    )
+    for _ in range(3):
+        worker.capture.write(vcd_message("secret"), message)
+    assert worker.drain(1)
+    assert worker.capture.count == 3
+    assert len(list(read_capture(path))) == 3
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the compression of the backend traffic and of the replies."""
+
+import base64
+import gzip
+import json
+from vcdextproxy import AMQPWorker, RESTWorker, RestApiExtension
+from vcdextproxy.compression import accepted_encodings, compress, decompress, negotiate
+
+
+class FakeMessage:
+    delivery_info = {'routing_key': 'example1'}
+    properties = {'correlation_id': 'test', 'reply_to': 'reply'}
+    headers = {'replyToExchange': 'replies'}
+
+
+class FakePublisher:
+    def publish(self, data, properties):
+        self.reply = AMQPWorker.format_reply(data, properties)
+
+
+def make_worker(settings, accept_encoding="gzip, deflate"):
+    extension = RestApiExtension('example1')
+    extension.conf = lambda item, default=None: settings.get(item, default)
+    request = {'id': 'test', 'headers': {'Accept-Encoding': accept_encoding, 'Content-Length': '10'}}
+    context = {'org': 'urn:vcloud:org:org1', 'user': 'urn:vcloud:user:user1'}
+    return RESTWorker(extension, FakePublisher(), [request, context], FakeMessage())
+
+
+def test_negotiate():
+    assert accepted_encodings("gzip;q=1.0, br, zstd;q=0") == {'gzip', 'br'}
+    assert negotiate("gzip, deflate", ['zstd', 'gzip']) == 'gzip'
+    assert negotiate("*", ['gzip']) == 'gzip'
+    assert negotiate("deflate", ['gzip']) is None
+    assert negotiate(None, ['gzip']) is None
+    assert decompress(compress(b"x" * 1000, 'gzip'), 'gzip') == b"x" * 1000
+
+
+def test_reply_compression():
+    body = json.dumps({'items': list(range(1000))})
+    settings = {'vcloud.reply_compression': {'min_size': 100}}
+    worker = make_worker(settings)
+    worker.reply(body, 200)
+    reply = worker.message_worker.reply
+    assert reply['headers']['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(base64.b64decode(reply['body'])) == body.encode()
+    assert reply['headers']['Content-Length'] < len(body)
+    # small bodies and clients without gzip support get uncompressed replies
+    worker.reply({"small": "body"}, 200)
+    assert 'Content-Encoding' not in worker.message_worker.reply['headers']
+    worker = make_worker(settings, accept_encoding="identity")
+    worker.reply(body, 200)
+    assert base64.b64decode(worker.message_worker.reply['body']) == body.encode()
+
+
+def test_backend_request_compression():
+    worker = make_worker({})
+    assert worker.backend_request(b"x" * 2000) == (worker.forge_headers(), b"x" * 2000)
+    worker = make_worker({'backend.compression': {'accept': ['zstd', 'gzip'], 'request_encoding': 'gzip'}})
+    headers, body = worker.backend_request(b"x" * 2000)
+    assert headers['Accept-Encoding'] == "gzip"
+    assert headers['Content-Encoding'] == "gzip"
+    assert gzip.decompress(body) == b"x" * 2000
+    headers, body = worker.backend_request(b"small")
+    assert body == b"small" and 'Content-Encoding' not in headers
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the adaptive concurrency limits."""
+
+import pytest
+from vcdextproxy.concurrency import AIMDLimit, FixedLimit, GradientLimit, build_limiter
+from vcdextproxy.scheduler import FairQueue
+
+
+def run(limiter, latency, error=False, count=100):
+    for _ in range(count):
+        while limiter.available():
+            limiter.started()
+        limiter.finished(latency, error)
+
+
+def test_build_limiter():
+    assert isinstance(build_limiter(None, 10), FixedLimit)
+    assert build_limiter(None, 10).limit == 10
+    limiter = build_limiter({'algorithm': 'aimd', 'max': 40}, 10)
+    assert isinstance(limiter, AIMDLimit)
+    assert (limiter.limit, limiter.max) == (10, 40)
+    with pytest.raises(ValueError):
+        build_limiter({'algorithm': 'unknown'}, 10)
+
+
+def test_aimd_limit():
+    limiter = AIMDLimit(initial=10, min=2, max=20, latency_threshold=0.5)
+    run(limiter, 0.1, count=200)
+    assert limiter.limit == 20
+    run(limiter, 1.0, count=10)
+    assert limiter.limit < 10
+    run(limiter, 0.1, error=True, count=100)
+    assert limiter.limit == 2
+
+
+def test_gradient_limit():
+    limiter = GradientLimit(initial=10, min=2, max=100)
+    run(limiter, 0.1, count=100)
+    assert limiter.limit == 100
+    # latency rises with the load: the limit shrinks
+    run(limiter, 1.0, count=50)
+    assert limiter.limit < 50
+    assert limiter.get_metrics()['samples'] == 150
+
+
+def test_queue_respects_limiters():
+    queue = FairQueue()
+    queue.set_limiter('slow', FixedLimit(initial=1))
+    for index in range(3):
+        queue.put('org1', f"slow{index}", group='slow')
+        queue.put('org1', f"fast{index}", group='fast')
+    assert [queue.get() for _ in range(4)] == ["slow0", "fast0", "fast1", "fast2"]
+    assert queue.get(timeout=0.01) is None
+    queue.done('default', 'slow', 0.1)
+    assert queue.get(timeout=0.01) == "slow1"
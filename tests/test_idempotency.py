@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the store of the recent replies."""
+
+from unittest.mock import Mock
+
+from vcdextproxy import AMQPWorker
+from vcdextproxy.idempotency import ENTRY_OVERHEAD, ReplyStore
+
+
+def test_replies_are_bounded():
+    store = ReplyStore(ttl=60, max_bytes=3 * (100 + ENTRY_OVERHEAD))
+    for index in range(4):
+        store.put(f"request-{index}", "correlation", b"x" * 100, {'statusCode': 200})
+    assert store.get("request-0", "correlation") is None  # evicted
+    assert store.get("request-3", "correlation") == (b"x" * 100, {'statusCode': 200})
+    assert store.get("request-3", "other-correlation") is None
+    store.put("large", "correlation", b"x" * store.max_bytes, {'statusCode': 200})
+    assert store.get("large", "correlation") is None
+    store.put("rejected", "correlation", b"{}", {'statusCode': "503"})
+    assert store.get("rejected", "correlation") is None
+    assert store.get_metrics()['too_large'] == 1
+
+
+def test_replies_expire():
+    store = ReplyStore(ttl=0)
+    store.put("request", "correlation", b"{}", {'statusCode': 200})
+    assert store.get("request", "correlation") is None
+
+
+def test_redelivered_messages_get_the_same_reply():
+    worker = AMQPWorker(None)
+    worker.load_extensions()
+    extension = worker.registered_extensions['example1']
+    worker.publish = Mock()
+    message = Mock(properties={'correlation_id': "correlation"})
+    payload = [{'id': "request"}, {}]
+    assert not worker.replay(extension, payload, message)
+    worker.replies.put("request", "correlation", b"{}", {'statusCode': 201})
+    assert worker.replay(extension, payload, message)
+    worker.publish.assert_called_once_with(b"{}", {'statusCode': 201})
+    # duplicate of a request in progress
+    worker.inflight["in-progress"] = Mock(id="request-2")
+    worker.thread_limiter.acquire()
+    message = Mock(properties={'correlation_id': "in-progress"})
+    assert worker.replay(extension, [{'id': "request-2"}, {}], message)
+    assert worker.publish.call_count == 1
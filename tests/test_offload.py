@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the offload of the large bodies."""
+
+import base64
+import binascii
+import json
+import pytest
+from vcdextproxy.offload import Offloader
+
+
+@pytest.fixture(scope="module")
+def offloader():
+    offloader = Offloader(processes=1, min_size=1000)
+    yield offloader
+    offloader.shutdown()
+
+
+def test_inline(offloader):
+    assert offloader.b64encode(b"small") == base64.b64encode(b"small")
+    assert offloader.stats['offloaded'] == 0 and offloader.stats['inline'] == 1
+
+
+def test_offloaded(offloader):
+    for size in (1000, 1001, 1002, 100000):
+        data = bytes(range(256)) * (size // 256) + b"x" * (size % 256)
+        encoded = offloader.b64encode(data)
+        assert encoded == base64.b64encode(data)
+        assert offloader.b64decode(encoded.decode()) == data
+    document = [{'id': "request", 'body': "é" * 1000}, {'org': "urn:vcloud:org:org1"}]
+    assert offloader.json_loads(json.dumps(document)) == document
+    assert offloader.stats['offloaded'] == 9
+
+
+def test_errors(offloader):
+    with pytest.raises(binascii.Error):
+        offloader.b64decode("a" * 1001)
+    with pytest.raises(ValueError):
+        offloader.json_loads("{" * 1000)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the sampling profiler."""
+
+from threading import Event, Thread
+
+from vcdextproxy.profiler import SamplingProfiler, format_collapsed
+
+
+def busy_backend_call(stop):
+    while not stop.is_set():
+        stop.wait(0.001)
+
+
+def test_profile_samples_all_threads(tmp_path):
+    stop = Event()
+    threads = [Thread(target=busy_backend_call, args=(stop,), name=f"rest-worker-{i}") for i in range(3)]
+    for thread in threads:
+        thread.start()
+    profiler = SamplingProfiler(interval=0.001)
+    try:
+        stacks = profiler.profile(0.1)
+    finally:
+        stop.set()
+    assert profiler.samples > 10
+    workers = {stack: count for stack, count in stacks.items() if stack.startswith("rest-worker;")}
+    assert any("busy_backend_call (tests/test_profiler.py:" in stack for stack in workers)
+    # the 3 worker threads are grouped
+    assert sum(workers.values()) >= 3 * profiler.samples - 3
+    # the sampling thread is not profiled
+    assert not any("profile (vcdextproxy/profiler.py" in stack for stack in stacks)
+    line = format_collapsed(stacks).splitlines()[0]
+    stack, count = line.rsplit(" ", 1)
+    assert stacks[stack] == int(count)
+    path = tmp_path / "profile.collapsed"
+    assert profiler.profile_to_file(0.01, str(path))
+    assert path.read_text()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the REST worker."""
+
+import json
+from vcdextproxy import RESTWorker, RestApiExtension
+from vcdextproxy.rest_worker import get_header
+
+
+class FakeMessage:
+    delivery_info = {'routing_key': 'example1'}
+    properties = {'correlation_id': 'test', 'reply_to': 'reply'}
+    headers = {'replyToExchange': 'replies'}
+
+
+def make_worker(headers, settings=None):
+    extension = RestApiExtension('example1')
+    extension.conf = lambda item, default=None: (settings or {}).get(item, default)
+    request = {'id': 'test', 'method': 'POST', 'requestUri': '/api/test', 'headers': headers}
+    context = {'org': 'urn:vcloud:org:org1', 'user': 'urn:vcloud:user:user1', 'rights': ['urn:vcloud:right:r1']}
+    return RESTWorker(extension, None, [request, context], FakeMessage())
+
+
+def test_get_header():
+    headers = {'Accept': "application/json", 'X-VCLOUD-Authorization': "token"}
+    assert get_header(headers, "accept") == "application/json"
+    assert get_header(headers, "x-vcloud-authorization") == "token"
+    assert get_header(headers, "authorization") is None
+
+
+def test_token():
+    worker = make_worker({'x-vcloud-authorization': "token", 'Authorization': "Bearer jwt"})
+    assert (worker.token, worker.is_jwt_token) == ("token", False)
+    worker = make_worker({'Authorization': "Bearer jwt "})
+    assert (worker.token, worker.is_jwt_token) == ("jwt", True)
+    assert make_worker({'Authorization': "Basic xxx"}).token is None
+    assert not hasattr(worker, '__dict__')
+    assert worker.reply_route == ('example1', 'test', 'reply', 'replies')
+
+
+def test_forge_headers():
+    worker = make_worker({'Accept': "application/json", 'accept-encoding': "br"}, {
+        'backend.forward_rights': True,
+        'backend.compression': {'accept': ['gzip']},
+    })
+    assert worker.forge_headers() == {
+        'Accept': "application/json",
+        'Accept-Encoding': "gzip",
+        'org_id': "org1",
+        'user_id': "user1",
+        'user_rights': json.dumps(['urn:vcloud:right:r1']),
+    }
+    # the request headers are not modified
+    assert worker.request_headers == {'Accept': "application/json", 'accept-encoding': "br"}
+
+
+def test_pre_checks_with_the_vcd_context(monkeypatch):
+    replies = []
+    monkeypatch.setattr(RESTWorker, 'reply', lambda self, rsp_body, status_code: replies.append(status_code))
+    settings = {'vcloud.trust_vcd_context': True, 'vcloud.reference_right': "UI Plugins: View"}
+    # the rights index is not loaded: the right IDs are read from the URNs of the context
+    worker = make_worker({}, settings)
+    worker.extension.get_reference_right = lambda: "r1"
+    worker.extension.resolve_reference_right()
+    assert worker.pre_checks()
+    assert replies == []
+    worker = make_worker({}, settings)
+    worker.extension.get_reference_right = lambda: "r2"
+    worker.extension.resolve_reference_right()
+    assert not worker.pre_checks()
+    assert replies == ["403"]
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the retries and hedging of the backend requests."""
+
+import time
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from vcdextproxy.retries import LatencyTracker, RetryBudget, RetryPolicy
+
+
+def log(level, message):
+    pass
+
+
+def responses(*results):
+    """Return a send function answering the results in turn (exceptions are raised)."""
+    results = list(results)
+    calls = []
+
+    def send():
+        calls.append(1)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        if isinstance(result, tuple):  # (delay, status code)
+            time.sleep(result[0])
+            return SimpleNamespace(status_code=result[1])
+        return SimpleNamespace(status_code=result)
+    send.calls = calls
+    return send
+
+
+def test_retries_of_idempotent_requests():
+    policy = RetryPolicy({'max_attempts': 3, 'backoff': 0.001}, budget=RetryBudget())
+    send = responses(requests.exceptions.ConnectionError(), 503, 200)
+    assert policy.call("get", send, log).status_code == 200
+    assert len(send.calls) == 3
+    # attempts exhausted: last error
+    send = responses(requests.exceptions.ConnectionError(), 502, requests.exceptions.Timeout())
+    with pytest.raises(requests.exceptions.Timeout):
+        policy.call("GET", send, log)
+    # non idempotent requests are not retried
+    send = responses(503, 200)
+    assert policy.call("POST", send, log).status_code == 503
+    assert len(send.calls) == 1
+
+
+def test_retry_budget_limits_retries():
+    budget = RetryBudget(ratio=0.0, min_per_second=0.0, max_tokens=2)
+    policy = RetryPolicy({'max_attempts': 10, 'backoff': 0.001}, budget=budget)
+    send = responses(*[503] * 10)
+    assert policy.call("GET", send, log).status_code == 503
+    assert len(send.calls) == 3  # 2 retries allowed by the budget
+    assert budget.stats['denied'] == 1
+    assert not budget.withdraw()
+
+
+def test_backoff_is_bounded():
+    policy = RetryPolicy({'backoff': 0.1, 'max_backoff': 0.3})
+    assert all(0 <= policy.backoff(attempt) <= 0.3 for attempt in range(1, 10))
+
+
+def test_latency_percentile():
+    tracker = LatencyTracker(size=100)
+    for latency in range(200):
+        tracker.add(latency / 1000)
+    assert len(tracker) == 100
+    assert tracker.percentile(95) == pytest.approx(0.195)
+    assert tracker.percentile(0) == pytest.approx(0.1)
+
+
+def test_hedged_request_after_slow_response():
+    policy = RetryPolicy(hedging={'percentile': 95, 'min_samples': 5}, budget=RetryBudget())
+    for _ in range(5):
+        policy.latencies.add(0.01)
+    assert policy.hedge_delay("POST") is None
+    assert policy.hedge_delay("GET") == 0.01
+    send = responses((1.0, 200), (0.0, 201))
+    started = time.monotonic()
+    assert policy.call("GET", send, log).status_code == 201
+    assert time.monotonic() - started < 0.5
+    assert policy.stats == {'retries': 0, 'hedges': 1, 'hedge_wins': 1}
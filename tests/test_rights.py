@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the rights index and the rights of the users."""
+
+from vcdextproxy.rights import RightsIndex, ids_from_urns
+
+
+def test_rights_index(fake_vcd, vcd_conf):
+    index = RightsIndex()
+    assert index.get_id("UI Plugins: View") is None
+    assert index.refresh()
+    assert index.loaded.is_set()
+    assert len(index) == len(fake_vcd.rights)
+    right_id = fake_vcd.right_id("UI Plugins: View")
+    assert index.get_id("UI Plugins: View") == right_id
+    assert index.get_name(right_id) == "UI Plugins: View"
+    assert index.ids_of(["UI Plugins: View", "Unknown right"]) == frozenset([right_id])
+
+
+def test_ids_from_urns():
+    urns = ["urn:vcloud:right:right-id", "urn:vcloud:org:org-id"]
+    assert ids_from_urns(urns) == frozenset(["right-id"])
+
+
+def test_reference_right_resolved_after_a_failed_refresh(fake_vcd, vcd_conf, monkeypatch):
+    from vcdextproxy import RestApiExtension, api_extension, rights
+    index = RightsIndex()
+    monkeypatch.setattr(api_extension, 'rights_index', index)
+    list_rights = rights.list_rights_available_in_vcd
+    monkeypatch.setattr(rights, 'list_rights_available_in_vcd', lambda: 1 / 0)
+    assert not index.refresh()
+    extension = RestApiExtension('example1')
+    extension.resolve_reference_right()
+    assert extension.ref_right_id == api_extension.UNKNOWN_RIGHT_ID
+    monkeypatch.setattr(rights, 'list_rights_available_in_vcd', list_rights)
+    assert index.refresh()
+    assert extension.ref_right_id == fake_vcd.right_id("UI Plugins: View")
+
+
+def test_role_rights_are_not_cached_without_catalog(monkeypatch):
+    import pytest
+    from vcdextproxy import rights
+    monkeypatch.setattr(rights, 'rights_index', RightsIndex())
+    monkeypatch.setattr(rights, 'list_rights_available_in_vcd', lambda: 1 / 0)
+    with pytest.raises(rights.RightsUnavailable):
+        rights.get_role_rights("org-without-catalog", "role")
+    assert ("org-without-catalog", "role") not in rights.get_role_rights.cache
+
+
+def test_concurrent_role_rights_lookups(fake_vcd, vcd_conf, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from vcdextproxy import rights
+    index = RightsIndex()
+    index.refresh()
+    monkeypatch.setattr(rights, 'rights_index', index)
+    rights.get_role_rights.cache_clear()
+    logins = []
+    login_as_system_admin = rights.login_as_system_admin
+    monkeypatch.setattr(rights, 'login_as_system_admin', lambda: logins.append(1) or login_as_system_admin())
+    with ThreadPoolExecutor(8) as executor:
+        results = set(executor.map(
+            lambda _: rights.get_role_rights(fake_vcd.tenant_user()["org_id"], "vApp User"), range(8)
+        ))
+    # a single vCD lookup for the concurrent misses of the role
+    assert len(results) == 1 and len(logins) == 1
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the rate limits and the fair queue."""
+
+from vcdextproxy import scheduler
+from vcdextproxy.scheduler import FairQueue, PriorityRules, RateLimiter, TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=0.001, burst=2)
+    assert bucket.take()
+    assert bucket.take()
+    assert not bucket.take()
+
+
+def test_rate_limiter(monkeypatch):
+    settings = {'global.rate_limits.org': {'rate': 0.001, 'burst': 3}, 'global.rate_limits.user': {'rate': 0.001}}
+    monkeypatch.setattr(scheduler, 'conf', lambda item, default=None: settings.get(item, default))
+    limiter = RateLimiter()
+    assert limiter.allow("org1", "user1") is None
+    assert limiter.allow("org1", "user1") == "user"
+    assert limiter.allow("org1", "user2") is None
+    assert limiter.allow("org1", "user3") is None
+    assert limiter.allow("org1", "user4") == "org"
+    assert limiter.allow("org2", "user5") is None
+
+
+def test_rate_limiter_keeps_busy_buckets(monkeypatch):
+    from cachetools import TTLCache
+    settings = {'global.rate_limits.user': {'rate': 0.0001, 'burst': 1}}
+    monkeypatch.setattr(scheduler, 'conf', lambda item, default=None: settings.get(item, default))
+    limiter = RateLimiter()
+    now = [0]
+    limiter.buckets = TTLCache(maxsize=10, ttl=3600, timer=lambda: now[0])
+    assert limiter.allow("org1", "user1") is None
+    for now[0] in (1800, 3000, 4000, 5000):
+        # the TTL counts the idle time: the bucket of a busy user is not replaced by a full one
+        assert limiter.allow("org1", "user1") == "user"
+
+
+def test_fair_queue():
+    queue = FairQueue(weights={'big': 2})
+    for index in range(6):
+        queue.put('noisy', f"noisy{index}")
+    queue.put('quiet', "quiet0")
+    queue.put('big', "big0")
+    queue.put('big', "big1")
+    queue.put('big', "big2")
+    assert len(queue) == 10
+    order = [queue.get() for _ in range(10)]
+    assert order[:5] == ["noisy0", "quiet0", "big0", "big1", "noisy1"]
+    assert order[5:] == ["big2", "noisy2", "noisy3", "noisy4", "noisy5"]
+    assert queue.get(timeout=0.01) is None
+
+
+def test_priority_lanes():
+    queue = FairQueue(lanes={'interactive': {'share': 3}, 'bulk': {'share': 1, 'max_workers': 1, 'max_queued': 3}})
+    for index in range(4):
+        assert queue.put('org1', f"bulk{index}", 'bulk') == (index < 3)
+        assert queue.put('org1', f"get{index}", 'interactive')
+    # bulk lane is limited to a single running request
+    assert [queue.get() for _ in range(5)] == ["bulk0", "get0", "get1", "get2", "get3"]
+    assert queue.get(timeout=0.01) is None
+    queue.done('bulk')
+    assert queue.get(timeout=0.01) == "bulk1"
+    assert queue.pending() == {'bulk': {'org1': 1}}
+
+
+def test_priority_rules():
+    rules = PriorityRules([
+        {'lane': 'bulk', 'extensions': ['example2'], 'methods': ['post', 'PUT']},
+        {'lane': 'interactive', 'methods': ['GET'], 'uri_pattern': '/api/example1/.*'},
+        {'lane': 'unknown', 'methods': ['DELETE']},
+    ], ['bulk', 'interactive'])
+    assert rules.classify('example2', 'post', '/api/example2/import') == 'bulk'
+    assert rules.classify('example1', 'POST', '/api/example1/import') == 'default'
+    assert rules.classify('example1', 'GET', '/api/example1/items') == 'interactive'
+    assert rules.classify('example2', 'GET', '/api/example2/items') == 'default'
+    assert rules.classify('example2', 'DELETE', '/api/example2/items') == 'default'
+
+
+def test_priority_lanes_without_starvation():
+    queue = FairQueue(lanes={'interactive': {'share': 5}, 'bulk': {'share': 0}})
+    for index in range(100):
+        queue.put('org1', f"get{index}", 'interactive')
+    queue.put('org1', "bulk0", 'bulk')
+    # the minimal share of a lane is 0.1: 1 bulk request every 50 interactive ones here
+    assert "bulk0" in [queue.get() for _ in range(60)]
+
+
+def test_fair_queue_with_invalid_weights():
+    queue = FairQueue(weights={'zero': 0, 'negative': -1})
+    for index in range(3):
+        queue.put('zero', f"zero{index}")
+        queue.put('negative', f"negative{index}")
+        queue.put('other', f"other{index}")
+    # weights are clamped to the minimal share: all the organizations are served
+    assert sorted(queue.get(timeout=1) for _ in range(9)) == sorted(
+        f"{org}{index}" for org in ('zero', 'negative', 'other') for index in range(3)
+    )
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the load shedding."""
+
+from vcdextproxy.shedding import QueueDelayShedder, build_shedder
+
+
+def test_build_shedder():
+    assert build_shedder(None) is None
+    shedder = build_shedder({'target': 0.05})
+    assert (shedder.target, shedder.interval) == (0.05, 1.0)
+
+
+def test_standing_queue():
+    shedder = QueueDelayShedder(target=0.1, interval=1.0)
+    for _ in range(10):
+        assert shedder.admit()
+    # a burst above target shorter than the interval is absorbed
+    assert not shedder.dequeued(0.5, now=100.0)
+    assert not shedder.dequeued(0.5, now=100.5)
+    assert shedder.admit()
+    # above target for a whole interval: the stale requests are dropped...
+    assert shedder.dequeued(0.5, now=101.0)
+    assert shedder.overloaded
+    assert shedder.dequeued(0.5, now=101.1)
+    # ... and the new ones are shed while the expected wait is above target
+    assert not shedder.admit()
+    # the requests served within target keep the overload until the queue drains
+    for now in (101.2, 101.25, 101.3, 101.35, 101.4, 101.45):
+        assert not shedder.dequeued(0.05, now=now)
+    assert shedder.overloaded and shedder.queued == 1
+    assert not shedder.admit()
+    assert not shedder.dequeued(0.05, now=101.5)
+    assert shedder.admit()
+    assert not shedder.overloaded
+    metrics = shedder.get_metrics()
+    assert (metrics['dropped'], metrics['shed'], metrics['overloads']) == (2, 2, 1)
+
+
+def test_empty_queue_ends_overload():
+    shedder = QueueDelayShedder(target=0.1, interval=1.0)
+    shedder.admit()
+    shedder.admit()
+    shedder.dequeued(0.5, now=100.0)
+    shedder.dequeued(0.5, now=101.0)
+    assert shedder.overloaded and shedder.queued == 0
+    assert shedder.admit()
+    assert not shedder.overloaded
+
+
+def test_expected_wait_while_overloaded():
+    shedder = QueueDelayShedder(target=0.1, interval=1.0)
+    for _ in range(5):
+        shedder.admit()
+    shedder.served_interval = 0.04  # 25 requests served per second
+    shedder.overloaded = True
+    # 5 pending requests: 0.2s of expected wait
+    assert not shedder.admit()
+    for now in (100.0, 100.04, 100.08):
+        shedder.dequeued(0.05, now=now)
+    # 2 pending requests: 0.08s of expected wait
+    assert shedder.admit()
+    assert not shedder.admit()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the validation of the users' tokens."""
+
+import pytest
+from vcdextproxy import tokens
+from vcdextproxy.tokens import InvalidToken, TokenValidator
+from vcdextproxy.rights import get_user_rights, rights_index
+from tests.test_vcd_utils import user_token
+
+
+@pytest.fixture
+def validator(fake_vcd, vcd_conf, monkeypatch):
+    settings = dict(vcd_conf)
+    settings['global.vcloud.token_validation.jwt_secret'] = fake_vcd.jwt_secret.decode()
+    monkeypatch.setattr(tokens, 'conf', lambda item, default=None: settings.get(item, default))
+    validator = TokenValidator()
+    validator.configure()
+    return validator
+
+
+def test_validate_remotely(fake_vcd, validator):
+    identity = validator.validate(user_token(fake_vcd))
+    assert identity.source == "remote"
+    assert identity.org_id == "a93c9db9-7471-3192-8d09-a8f7eeda85f9"
+    assert identity.roles
+    with pytest.raises(InvalidToken):
+        validator.validate("not-a-token")
+
+
+def test_validate_cached(fake_vcd, validator):
+    validator.mode = 'cached'
+    token = user_token(fake_vcd)
+    assert validator.validate(token) == validator.validate(token)
+    assert validator.stats['hits'] == 1
+    assert validator.stats['remote'] == 1
+
+
+def test_validate_locally(fake_vcd, validator):
+    validator.mode = 'local'
+    _, access_token = fake_vcd.create_session(fake_vcd.tenant_user())
+    calls = dict(fake_vcd.stats)
+    identity = validator.validate(access_token, True)
+    assert identity.source == "local"
+    assert identity.org_id == "a93c9db9-7471-3192-8d09-a8f7eeda85f9"
+    assert dict(fake_vcd.stats) == calls  # no vCD call
+    with pytest.raises(InvalidToken):
+        validator.validate(access_token[:-4] + "AAAA", True)
+    with pytest.raises(InvalidToken):
+        validator.validate(access_token, True, {'user': "urn:vcloud:user:someone-else"})
+    # without signing material: ask vCD (or trust the claims)
+    validator.jwt_secret = None
+    assert validator.validate(access_token, True).source == "remote"
+    validator.strictness = 'claims'
+    assert validator.validate(access_token, True).source == "local"
+
+
+def test_get_user_rights(fake_vcd, validator):
+    rights_index.refresh()
+    right_id = fake_vcd.right_id("UI Plugins: View")
+    identity = validator.validate(user_token(fake_vcd, "user@tenant1"))
+    assert right_id in get_user_rights(identity.org_id, identity.roles)
+    identity = validator.validate(user_token(fake_vcd, "vappuser@tenant1"))
+    user_rights = get_user_rights(identity.org_id, identity.roles)
+    assert right_id not in user_rights
+    assert len(user_rights) > 0
+
+
+def test_concurrent_configuration(monkeypatch):
+    import threading
+    import time
+    from vcdextproxy.tokens import TokenIdentity
+    settings = {'global.vcloud.token_validation.mode': 'cached'}
+
+    def slow_conf(item, default=None):
+        time.sleep(0.01)  # let the other threads see a partial configuration
+        return settings.get(item, default)
+
+    monkeypatch.setattr(tokens, 'conf', slow_conf)
+    validator = TokenValidator()
+    identity = TokenIdentity("org", "user", [], None, "remote")
+    validator.validate_remotely = lambda token, is_jwt_token: identity
+    errors = []
+
+    def validate():
+        try:
+            assert validator.validate("token") == identity
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=validate) for _ in range(8)]
+    threads[0].start()
+    time.sleep(0.025)  # the first thread is configuring the validator
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert errors == []
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the vCD helpers, against the fake vCD API server."""
+
+from pyvcloud.vcd.client import BasicLoginCredentials, Client
+from pyvcloud.vcd.org import Org
+from vcdextproxy import vcd_utils
+
+
+def user_token(fake_vcd, user="user@tenant1", password="user"):
+    name, org = user.split('@')
+    client = Client(fake_vcd.url, api_version="33.0", verify_ssl_certs=False, log_file="/dev/null")
+    client.set_credentials(BasicLoginCredentials(name, org, password))
+    return client.get_xvcloud_authorization_token()
+
+
+def test_login_as_system_admin(vcd_conf):
+    client = vcd_utils.login_as_system_admin()
+    assert client.is_sysadmin()
+
+
+def test_login_from_token(fake_vcd, vcd_conf):
+    client, session = vcd_utils.login_from_token(user_token(fake_vcd))
+    assert session.get('org') == "tenant1"
+    assert Org(client, resource=client.get_org()).href.endswith("a93c9db9-7471-3192-8d09-a8f7eeda85f9")
+
+
+def test_list_rights_available_in_vcd(fake_vcd, vcd_conf):
+    rights = vcd_utils.list_rights_available_in_vcd()
+    assert len(rights) == len(fake_vcd.rights)
+    assert {right['name'] for right in rights} == set(fake_vcd.rights.values())
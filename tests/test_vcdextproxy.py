@@ -21,3 +21,21 @@ def test_content(response):
     """Sample pytest test function with the pytest fixture as an argument."""
     # from bs4 import BeautifulSoup
     # assert 'GitHub' in BeautifulSoup(response.content).title.string
+
+
+def test_import_is_light():
+    """Importing the proxy reads no configuration and loads neither pyvcloud nor the optional packages."""
+    import os
+    import subprocess
+    import sys
+    env = {key: value for key, value in os.environ.items() if key != 'VCDEXTPROXY_CONFIGURATION_PATH'}
+    code = (
+        "import sys, kombu.compression\n"
+        "dependencies = set(sys.modules)  # kombu loads zstandard when it is installed\n"
+        "from vcdextproxy import AMQPWorker\n"
+        "import vcdextproxy.admin, vcdextproxy.rights, vcdextproxy.tokens, vcdextproxy.vcd_utils\n"
+        "assert 'pyvcloud.vcd.client' not in sys.modules\n"
+        "for name in ('cryptography', 'zstandard'):\n"
+        "    assert name not in sys.modules or name in dependencies, name\n"
+    )
+    subprocess.run([sys.executable, "-c", code], env=env, check=True, timeout=60)
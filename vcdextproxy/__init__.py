@@ -7,17 +7,31 @@ __author__ = """Ludovic Rivallain"""
 __email__ = 'ludovic.rivallain@gmail.com'
 __version__ = '0.1.1'
 
+import importlib
 import logging
 import sys
-if sys.version_info < (3, 6):
-    raise Exception('vcdextproxy requires Python versions 3.6 or later.')
-
-# Import all submodules
-from vcdextproxy.api_extension import RestApiExtension  # noqa: E402, F401
-from vcdextproxy.rest_worker import RESTWorker  # noqa: E402, F401
-from vcdextproxy.amqp_worker import AMQPWorker  # noqa: E402, F401
-from vcdextproxy import configuration  # noqa: E402, F401
-from vcdextproxy import utils  # noqa: E402, F401
+if sys.version_info < (3, 7):
+    raise Exception('vcdextproxy requires Python versions 3.7 or later.')
+
+# Submodules are imported on first use (kombu, requests and pyvcloud are slow to import)
+_lazy_attributes = {
+    'RestApiExtension': 'vcdextproxy.api_extension',
+    'RESTWorker': 'vcdextproxy.rest_worker',
+    'AMQPWorker': 'vcdextproxy.amqp_worker',
+    'configuration': 'vcdextproxy.configuration',
+    'utils': 'vcdextproxy.utils',
+}
+__all__ = list(_lazy_attributes)
+
+
+def __getattr__(name):
+    if name not in _lazy_attributes:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module = importlib.import_module(_lazy_attributes[name])
+    value = module if module.__name__.endswith(f".{name}") else getattr(module, name)
+    globals()[name] = value
+    return value
+
 
 # name the logger for the current module
 logger = logging.getLogger(__name__)
@@ -4,9 +4,12 @@
 import signal
 import sys
 import os
-from kombu import Connection
 from vcdextproxy import AMQPWorker
+from vcdextproxy.amqp_worker import broker_connection
+from vcdextproxy.admin import start_admin_server
 from vcdextproxy.configuration import configure_logger, read_configuration, conf
+from vcdextproxy.offload import get_offloader
+from vcdextproxy.profiler import profile_signal_handler
 from vcdextproxy.utils import signal_handler, vcdextproxy_excepthook, logger
 
 
@@ -29,24 +32,35 @@ def main():
     # start
     logger.info("Starting the vCD Extension Proxy service")
 
-    # bind sigint signal to a signal handler method
+    # bind sigint and sigterm signals to a signal handler method (until the dispatcher can drain)
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    # on-demand profiling of all the threads
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, profile_signal_handler)
 
     # disable tracebacks in kombu
     os.environ['DISABLE_TRACEBACKS'] = "1"
 
+    # processes encoding and decoding the large bodies
+    if get_offloader() is not None:
+        get_offloader().start()
+
     logger.info("Connecting to the RabbitMQ server...")
-    amqp_url = f"amqp://{conf('global.amqp.username')}:{conf('global.amqp.password')}"
-    amqp_url += f"@{conf('global.amqp.host')}:{conf('global.amqp.port')}/{conf('global.amqp.vhost')}"
-    if conf('global.amqp.ssl'):
-        amqp_url += "?ssl=1"
-    logger.debug(f"RabbitMQ server URI: {amqp_url}")
-    with Connection(amqp_url, heartbeat=4) as conn:
+    with broker_connection() as conn:
+        logger.debug(f"RabbitMQ servers: {len(conn.alt)} (first one: {conn.as_uri()})")
         # Start dispatcher service
         logger.info("Dispatcher service creation")
         dispatch = AMQPWorker(conn)
+        signal.signal(signal.SIGINT, dispatch.on_shutdown_signal)
+        signal.signal(signal.SIGTERM, dispatch.on_shutdown_signal)
+        if conf('global.admin.enabled', False):
+            start_admin_server(dispatch)
         logger.debug("Starting the dispatcher service...")
         dispatch.run()
+        # stopped by a signal: finish the requests in progress before closing the connection
+        dispatch.drain(conf('global.drain_timeout', 30))
+    logger.info("Connection closed -> Exiting...")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""Local admin HTTP endpoint exposing the live state of the proxy.
+
+Enabled with ``global.admin.enabled`` (listens on ``global.admin.host``,
+``127.0.0.1`` by default, and ``global.admin.port``). All the views are JSON:
+
+* ``/healthz``: liveness probe (the listener thread is alive).
+* ``/readyz``: readiness probe (broker connected and extensions initialized).
+* ``/state``: the whole state (the following views).
+* ``/extensions``: registered extensions, routing keys and status.
+* ``/inflight``: requests in progress with their age and stage
+  (``?slowest=N`` for the N oldest ones).
+* ``/workers``: worker pool utilization, pending requests, concurrency limits and retries.
+* ``/caches``: cache sizes and hit rates.
+* ``/broker``: broker connection health.
+* ``/profile?seconds=N``: samples all the threads for N seconds (default 10)
+  and returns the collapsed stacks (see ``vcdextproxy.profiler``).
+"""
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import monotonic
+from urllib.parse import parse_qsl, urlsplit
+from vcdextproxy.configuration import conf, get_configuration_item
+from vcdextproxy.profiler import format_collapsed, profiler
+from vcdextproxy.offload import get_offloader
+from vcdextproxy.retries import get_retry_metrics
+from vcdextproxy.rights import get_role_rights, rights_index
+from vcdextproxy.tokens import token_validator
+from vcdextproxy.utils import logger
+
+
+def _cache_info(cached_function):
+    info = cached_function.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'size': info.currsize,
+        'maxsize': info.maxsize,
+        'hits': info.hits,
+        'misses': info.misses,
+        'hit_rate': round(info.hits / lookups, 3) if lookups else None,
+    }
+
+
+class AdminState:
+    """Build the views of the admin endpoint from the running AMQP worker.
+    """
+
+    def __init__(self, amqp_worker):
+        """Initialize the views.
+
+        Args:
+            amqp_worker (vcdextproxy.AMQPWorker): The running AMQP worker.
+        """
+        self.amqp_worker = amqp_worker
+        self.started = monotonic()
+
+    def extensions(self):
+        return [
+            {
+                'name': extension.name,
+                'routing_key': routing_key,
+                'status': extension.status,
+                'reference_right_id': extension.ref_right_id or None,
+            }
+            for routing_key, extension in self.amqp_worker.registered_extensions.items()
+        ]
+
+    def inflight(self, slowest=None):
+        now = monotonic()
+        requests = sorted(
+            (worker.describe(now) for worker in list(self.amqp_worker.inflight.values())),
+            key=lambda request: request['age_s'],
+            reverse=True
+        )
+        return requests[:slowest] if slowest else requests
+
+    def workers(self):
+        scheduler = self.amqp_worker.scheduler
+        if not scheduler:
+            return {'started': False}
+        metrics = scheduler.get_metrics()
+        busy = sum(metrics['running'].values())
+        metrics['started'] = True
+        metrics['busy'] = busy
+        metrics['utilization'] = round(busy / metrics['workers'], 3) if metrics['workers'] else None
+        metrics['admission_available'] = self.amqp_worker.thread_limiter._value
+        metrics['retries'] = get_retry_metrics()
+        offloader = get_offloader()
+        metrics['offload'] = offloader.get_metrics() if offloader else None
+        return metrics
+
+    def caches(self):
+        tokens = dict(token_validator.stats)
+        lookups = tokens['hits'] + tokens['misses']
+        tokens['size'] = len(token_validator._cache) if token_validator._cache is not None else 0
+        tokens['hit_rate'] = round(tokens['hits'] / lookups, 3) if lookups else None
+        return {
+            'configuration': _cache_info(get_configuration_item),
+            'role_rights': _cache_info(get_role_rights),
+            'tokens': tokens,
+            'rights_index': {'size': len(rights_index), 'loaded': rights_index.loaded.is_set()},
+            'replies': self.amqp_worker.replies.get_metrics() if self.amqp_worker.replies is not None else None,
+        }
+
+    def broker(self):
+        return dict(self.amqp_worker.broker_state, requests_managed=self.amqp_worker.nb_requests_managed)
+
+    def alive(self):
+        thread = self.amqp_worker.listener_thread
+        return thread is None or thread.is_alive()
+
+    def ready(self):
+        return self.amqp_worker.broker_state['connected'] and self.amqp_worker.get_readiness()['ready_to_serve']
+
+    def state(self):
+        return {
+            'uptime_s': round(monotonic() - self.started, 1),
+            'extensions': self.extensions(),
+            'readiness': self.amqp_worker.get_readiness(),
+            'inflight': self.inflight(),
+            'workers': self.workers(),
+            'caches': self.caches(),
+            'broker': self.broker(),
+        }
+
+
+class AdminHandler(BaseHTTPRequestHandler):
+    """Serve the admin views (GET only).
+    """
+
+    state = None  # AdminState, set by start_admin_server()
+
+    def log_message(self, format, *args):
+        logger.debug(f"Admin endpoint: {format % args}")
+
+    def send_json(self, status_code, content):
+        body = json.dumps(content, indent=2, default=str).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_profile(self, seconds):
+        if not 0 < seconds <= conf('global.admin.max_profile_seconds', 300):
+            raise ValueError(f"Invalid profile duration: {seconds}")
+        stacks = profiler.profile(seconds)
+        if stacks is None:
+            return self.send_json(409, {'error': "A profile is already in progress"})
+        body = format_collapsed(stacks).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # noqa: N802
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        state = self.state
+        try:
+            if url.path == "/healthz":
+                alive = state.alive()
+                return self.send_json(200 if alive else 503, {'alive': alive})
+            if url.path == "/readyz":
+                ready = state.ready()
+                return self.send_json(200 if ready else 503, {'ready': ready})
+            if url.path == "/inflight":
+                slowest = int(params['slowest']) if 'slowest' in params else None
+                return self.send_json(200, state.inflight(slowest))
+            if url.path == "/profile":
+                return self.send_profile(float(params.get('seconds', 10)))
+            views = {
+                '/': state.state,
+                '/state': state.state,
+                '/extensions': state.extensions,
+                '/workers': state.workers,
+                '/caches': state.caches,
+                '/broker': state.broker,
+            }
+            if url.path not in views:
+                return self.send_json(404, {'error': f"Unknown view: {url.path}", 'views': sorted(views)})
+            return self.send_json(200, views[url.path]())
+        except ValueError as e:
+            return self.send_json(400, {'error': str(e)})
+
+
+def start_admin_server(amqp_worker, host=None, port=None):
+    """Start the admin endpoint in a daemon thread.
+
+    Args:
+        amqp_worker (vcdextproxy.AMQPWorker): The running AMQP worker.
+        host (str): Listening address (default: ``global.admin.host``).
+        port (int): Listening port (default: ``global.admin.port``).
+
+    Returns:
+        http.server.ThreadingHTTPServer: The server.
+    """
+    handler = type('BoundAdminHandler', (AdminHandler,), {'state': AdminState(amqp_worker)})
+    if port is None:
+        port = conf('global.admin.port', 8090)
+    server = ThreadingHTTPServer((host or conf('global.admin.host', '127.0.0.1'), port), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="admin-endpoint", daemon=True).start()
+    logger.info(f"Admin endpoint listening on {server.server_address[0]}:{server.server_address[1]}")
+    return server
@@ -2,16 +2,60 @@
 """The AMQP worker is in charge of dealing with AMQP messages.
 """
 
-import base64
-import json
 from amqp.exceptions import PreconditionFailed
-from kombu import Exchange, Queue
+from kombu import Connection, Exchange, Queue
+from kombu.exceptions import LimitExceeded, OperationalError
 from kombu.mixins import ConsumerMixin
+from kombu.pools import ProducerPool
 from kombu.utils.debug import setup_logging as kombu_setup_logging
-from threading import BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, Thread, current_thread
+from time import monotonic, sleep, time
+from vcdextproxy.capture import CaptureWriter
 from vcdextproxy.configuration import conf
-from vcdextproxy.utils import logger
-from vcdextproxy import RestApiExtension, RESTWorker
+from vcdextproxy.idempotency import ReplyStore
+from vcdextproxy.offload import b64encode, get_offloader, json_loads
+from vcdextproxy.utils import logger, signal_handler
+from vcdextproxy.rights import rights_index
+from vcdextproxy.scheduler import Scheduler, get_max_threads
+from vcdextproxy.api_extension import RestApiExtension
+from vcdextproxy.rest_worker import RESTWorker
+
+
+def get_broker_urls():
+    """Return the kombu URLs of the brokers.
+
+    ``global.amqp.host`` is a host or a list of hosts (``host`` or
+    ``host:port`` items) of the same cluster, used for failover.
+
+    Returns:
+        [str]: The URLs.
+    """
+    hosts = conf('global.amqp.host')
+    if isinstance(hosts, str):
+        hosts = [hosts]
+    urls = []
+    for host in hosts:
+        host, _, port = str(host).partition(':')
+        url = f"amqp://{conf('global.amqp.username')}:{conf('global.amqp.password')}"
+        url += f"@{host}:{port or conf('global.amqp.port')}/{conf('global.amqp.vhost')}"
+        if conf('global.amqp.ssl'):
+            url += "?ssl=1"
+        urls.append(url)
+    return urls
+
+
+def broker_connection():
+    """Create the connection to the brokers, with failover between them.
+
+    Returns:
+        kombu.Connection: The connection (not yet connected).
+    """
+    return Connection(
+        get_broker_urls(),
+        heartbeat=conf('global.amqp.heartbeat', 4),
+        failover_strategy=conf('global.amqp.failover_strategy', 'round-robin')
+    )
 
 
 class AMQPWorker(ConsumerMixin):
@@ -32,46 +76,246 @@ class AMQPWorker(ConsumerMixin):
         # Reduce logging from amqp module
         kombu_setup_logging(loglevel='INFO', loggers=['amqp'])
         self.registered_extensions = {}  # keep extensions
-        # Limit threads number #13
-        self.thread_limiter = BoundedSemaphore(value=conf('global.max_threads', 10))
+        self.registration_thread = None
+        # Limit the number of requests in progress (running or queued) #13
+        max_threads = get_max_threads()
+        self.thread_limiter = BoundedSemaphore(
+            value=max_threads + conf('global.fair_queuing.queue_size', max_threads)
+        )
+        self.scheduler = None
         self.nb_requests_managed = 0
+        self.inflight = {}  # correlation_id -> RESTWorker
+        self.listener_thread = None
+        self.broker_state = {'connected': False, 'consuming_since': None, 'errors': 0, 'last_error': None}
+        self.draining = False
+        self._producers = None
+        self._producers_lock = Lock()  # the pool is created by the first publishing thread
+        self.shards = []  # extra consumers (see ConsumerShard)
+        self.replies = ReplyStore.from_conf()  # recent replies, for the redelivered messages
+        self.capture = CaptureWriter.from_conf()  # received messages, to replay them offline
 
-    def get_consumers(self, Consumer, channel):
-        """Return the consumer objects.
+    def load_extensions(self):
+        """Create the extension objects from the configuration.
 
-        Args:
-            Consumer (kombu..messaging.Consumer): Current consumer object.
-            channel (str): Incoming channel for messages (unused).
+        No vCD call is made here: the vCD related initialization is made
+        in background (see ``start_registration()``).
 
         Returns:
-            [kombu.messaging.Consumer]: A list of consumers with callback to local task.
+            bool: False if the configuration is invalid.
         """
-        consumers = []
         for extension_name in conf('extensions'):
             extension = RestApiExtension(extension_name)
             routing_key = extension.conf('amqp.routing_key')
             if routing_key in self.registered_extensions.keys():
                 # critical case: duplicate routing_key in configuration
                 logger.critical(f"Duplicate routing_key '{routing_key}' for multiple extensions.")
+                return False
+            self.registered_extensions[routing_key] = extension
+        return True
+
+    def start_registration(self):
+        """Start the vCD related initialization of extensions in background.
+
+        The rights catalog is fetched once, then extensions are registered
+        concurrently on vCloud.
+        """
+        self.registration_thread = Thread(
+            target=self.register_extensions,
+            name="vcd-registration",
+            daemon=True
+        )
+        self.registration_thread.start()
+
+    def register_extensions(self):
+        """Fetch the rights catalog and initialize all extensions on vCloud.
+        """
+        extensions = list(self.registered_extensions.values())
+        if any(extension.conf('vcloud.reference_right', False) for extension in extensions):
+            rights_index.refresh()
+            rights_index.start_background_refresh(conf('global.vcloud.cache_timeout', 300))
+        workers = max(1, min(len(extensions), conf('global.vcloud.startup_workers', 8)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vcd-registration") as executor:
+            for extension in extensions:
+                executor.submit(extension.initialize)
+        logger.info(f"vCD initialization of extensions is over: {self.get_readiness()}")
+
+    def get_readiness(self):
+        """Report the progress of the vCD initialization of extensions.
+
+        Returns:
+            dict: Number of extensions per status and a global ``ready`` flag.
+        """
+        readiness = {'pending': 0, 'ready': 0, 'failed': 0}
+        for extension in self.registered_extensions.values():
+            readiness[extension.status] += 1
+        readiness['ready_to_serve'] = readiness['pending'] == 0 and bool(self.registered_extensions)
+        return readiness
+
+    def get_consumers(self, Consumer, channel):
+        """Return the consumer objects.
+
+        Args:
+            Consumer (kombu..messaging.Consumer): Current consumer object.
+            channel (str): Incoming channel for messages (unused).
+
+        Returns:
+            [kombu.messaging.Consumer]: A list of consumers with callback to local task.
+        """
+        if not self.registered_extensions:
+            if not self.load_extensions():
                 return None
-            queue = extension.get_queue()
-            if queue:
-                try:
-                    consumers.append(
-                        Consumer(
-                            queues=[queue],
-                            callbacks=[self.process_task]
-                        )
-                    )
-                except PreconditionFailed:
-                    logger.exception("Precondition error: Verify AMQP settings for {extension.name}")
-                except Exception:
-                    logger.exception("Unmanaged error detected.")
-                self.registered_extensions[routing_key] = extension
-                extension.log('info', f"New extension is registred.")
+            # consumers start right away: registration ends in background
+            self.start_registration()
+            self.scheduler = Scheduler()
+            self.scheduler.start()
+            self.start_shards()
+        consumers = []
+        for extension in self.registered_extensions.values():
+            consumer = self.extension_consumer(Consumer, extension)
+            if consumer:
+                consumers.append(consumer)
+            extension.log('info', f"New extension is registred.")
         logger.info("All extensions are now registred. Listening for incoming messages...")
         return consumers
 
+    def extension_consumer(self, Consumer, extension):
+        """Return a consumer of the queue of an extension.
+
+        Args:
+            Consumer (kombu..messaging.Consumer): Consumer class bound to a channel.
+            extension (vcdextproxy.RestApiExtension): The extension.
+
+        Returns:
+            kombu.messaging.Consumer: The consumer (None on error).
+        """
+        queue = extension.get_queue()
+        if not queue:
+            return None
+        try:
+            return Consumer(
+                queues=[queue],
+                callbacks=[self.process_task],
+                prefetch_count=extension.conf('amqp.prefetch_count', None)
+            )
+        except PreconditionFailed:
+            logger.exception(f"Precondition error: Verify AMQP settings for {extension.name}")
+        except Exception:
+            logger.exception("Unmanaged error detected.")
+        return None
+
+    def start_shards(self):
+        """Start the extra consumers of the extensions (``amqp.consumers``).
+
+        The first consumer of each extension is run by this worker, the
+        others by their own ``ConsumerShard``.
+        """
+        for extension in self.registered_extensions.values():
+            for index in range(1, extension.conf('amqp.consumers', 1)):
+                shard = ConsumerShard(self, extension, index)
+                shard.start()
+                self.shards.append(shard)
+        if self.shards:
+            logger.info(f"{len(self.shards)} extra consumer(s) started")
+
+    def get_producers(self):
+        """Return the pool of producers used to publish the replies.
+
+        Replies are published on their own connections (cloned from the
+        consumer one, with the same brokers), so a slow publication never
+        stalls the consumer loop. Each producer has its own channel.
+
+        Returns:
+            kombu.pools.ProducerPool: The pool.
+        """
+        producers = self._producers
+        if producers is not None:
+            return producers
+        with self._producers_lock:
+            if self._producers is None:
+                size = conf('global.amqp.publish_pool_size', min(get_max_threads(), 8))
+                # no heartbeat: these connections are not drained, publication errors are retried
+                connections = self.connection.clone(heartbeat=0).Pool(limit=size)
+                self._producers = ProducerPool(connections, limit=size)
+            return self._producers
+
+    def close_producers(self):
+        """Close the connections used to publish the replies.
+        """
+        with self._producers_lock:
+            if self._producers is not None:
+                self._producers.connections.force_close_all()
+                self._producers = None
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        """Keep track of the broker connection (kombu hook).
+        """
+        self.listener_thread = current_thread()
+        self.broker_state['connected'] = True
+        self.broker_state['broker'] = connection.as_uri()
+        self.broker_state['consuming_since'] = time()
+
+    def on_connection_error(self, exc, interval):
+        """Keep track of the broker connection errors (kombu hook).
+        """
+        self.broker_state['connected'] = False
+        self.broker_state['errors'] += 1
+        self.broker_state['last_error'] = str(exc)
+        if self.should_stop:
+            raise exc  # stop reconnecting: the consumer loop is leaving
+        logger.warning(f"Broker connection error: {str(exc)}, retry in {interval}s")
+
+    def stop_consuming(self):
+        """Leave the consumer loop (``run()`` returns within a second).
+
+        Messages received meanwhile are sent back to the queue for the other
+        instances of the proxy.
+        """
+        self.draining = True
+        self.should_stop = True
+        for shard in self.shards:
+            shard.should_stop = True
+
+    def drain(self, timeout):
+        """Stop consuming and wait for the end of the requests in progress.
+
+        Requests already received (running or queued) are still processed
+        and their replies published.
+
+        Args:
+            timeout (float): Maximum time to wait (seconds).
+
+        Returns:
+            bool: True if all the requests were replied.
+        """
+        self.stop_consuming()
+        deadline = monotonic() + timeout
+        logger.info(f"Draining: waiting for {len(self.inflight)} request(s) in progress...")
+        while self.inflight and monotonic() < deadline:
+            sleep(0.1)
+        inflight = len(self.inflight)
+        self.close_producers()
+        if self.capture is not None:
+            self.capture.close()
+            logger.info(f"{self.capture.count} message(s) captured in {self.capture.path}")
+        if get_offloader() is not None:
+            get_offloader().shutdown()
+        if inflight:
+            logger.warning(
+                f"Draining: {inflight} request(s) still in progress after {timeout}s: "
+                f"{', '.join(str(worker.id) for worker in list(self.inflight.values()))}"
+            )
+            return False
+        logger.info("Draining: all the requests in progress were replied")
+        return True
+
+    def on_shutdown_signal(self, signum, frame):
+        """Start draining on SIGINT/SIGTERM (a second signal exits at once).
+        """
+        if self.draining:
+            signal_handler(signum, frame)
+        logger.info(f"Signal {signum} caught -> Draining (send it again to exit now)...")
+        self.stop_consuming()
+
     def process_task(self, body, message):
         """Process a single message on receive.
 
@@ -79,6 +323,13 @@ class AMQPWorker(ConsumerMixin):
             body (str): JSON message body as a string.
             message (str): JSON message metadata as a string.
         """
+        if self.draining:
+            logger.debug("Listener: Draining: message sent back to the queue")
+            message.requeue()
+            return
+        if self.capture is not None:
+            self.capture.write(body, message)
+        received = monotonic()  # the wait for the admission window is part of the queuing delay
         self.thread_limiter.acquire()
         logger.trivia(f"Available threads to manage the request: {self.thread_limiter._value}")
         try:
@@ -96,26 +347,58 @@ class AMQPWorker(ConsumerMixin):
         # Parsing JSON
         try:
             extension.log('debug', "Listener: Loading body as a JSON content...")
-            json_payload = json.loads(body)
+            json_payload = json_loads(body)
             extension.log('debug', "Listener: Body of message was successfully load as JSON.")
         except ValueError:
             extension.log('warning', f"Listener: Invalid JSON data received: rejecting the message\n{body}")
             return
+        if self.replay(extension, json_payload, message):
+            return
         # Getting the correct worker
-        extension.log('debug', "Listener: Processing request message in a new thread...")
-        # Limit threads number #13
+        extension.log('debug', "Listener: Queuing the request for the workers...")
         try:
-            thread = RESTWorker(
+            worker = RESTWorker(
                 extension=extension,
                 message_worker=self,
                 data=json_payload,
-                message=message
+                message=message,
+                received=received
             )
-            thread.start()
+            self.inflight[message.properties.get('correlation_id')] = worker
+            self.scheduler.submit(worker)
         except Exception as e:
             extension.log('error', f"Listener: Task raised exception: {str(e)}", exc_info=1)
+            self.inflight.pop(message.properties.get('correlation_id'), None)
             self.thread_limiter.release()
 
+    def replay(self, extension, json_payload, message):
+        """Answer a message already received (redelivered by the broker).
+
+        Args:
+            extension (vcdextproxy.RestApiExtension): The extension.
+            json_payload (list): The message content.
+            message (kombu.message.Message): The message.
+
+        Returns:
+            bool: True if the message is a duplicate (already answered or in progress).
+        """
+        try:
+            request_id = json_payload[0]['id']
+        except (KeyError, IndexError, TypeError):
+            return False
+        correlation_id = message.properties.get('correlation_id')
+        in_progress = self.inflight.get(correlation_id)
+        if in_progress is not None and in_progress.id == request_id:
+            extension.log('warning', f"Listener: Request {request_id} is already in progress: duplicate ignored")
+            self.thread_limiter.release()
+            return True
+        reply = self.replies.get(request_id, correlation_id) if self.replies is not None else None
+        if reply is None:
+            return False
+        extension.log('info', f"Listener: Request {request_id} was already replied: sending the same reply")
+        self.publish(*reply)
+        return True
+
     def publish(self, data, properties):
         """Publish a message through the current connection.
 
@@ -123,6 +406,9 @@ class AMQPWorker(ConsumerMixin):
             data (str): JSON message body as a string.
             properties (str): JSON message metadata as a string.
         """
+        self.inflight.pop(properties.get('correlation_id'), None)
+        if self.replies is not None:
+            self.replies.put(properties.get('id'), properties.get('correlation_id'), data, properties)
         routing_key = properties.get('routing_key')
         if not routing_key:
             logger.error(f"Publisher: Missing original routing_key in the reply message properties")
@@ -149,33 +435,102 @@ class AMQPWorker(ConsumerMixin):
             routing_key=properties.get('reply_to'),
             no_declare=True
         )
-        if properties.get("encode", True):
-            rsp_body = (base64.b64encode(data.encode('utf-8'))).decode()
-        else:
-            rsp_body = (base64.b64encode(data)).decode()  # raw data
-        rsp_msg = {
-            'id': properties.get('id', None),
-            'headers': {
-                'Content-Type': properties.get(
-                    "Content-Type", "application/*+json;version=31.0"  # default
-                ),
-                'Content-Length': len(data)
-            },
-            'statusCode': properties.get("statusCode", 200),
-            'body': rsp_body
-        }
+        rsp_msg = self.format_reply(data, properties)
         try:
-            self.connection.Producer().publish(
-                rsp_msg,
-                correlation_id=properties.get('correlation_id'),
-                routing_key=rqueue.routing_key,
-                exchange=rqueue.exchange,
-                retry=True,
-                expiration=10000  # 10 seconds
-            )
+            with self.get_producers().acquire(block=True, timeout=conf('global.amqp.publish_timeout', 10)) as producer:
+                producer.publish(
+                    rsp_msg,
+                    correlation_id=properties.get('correlation_id'),
+                    routing_key=rqueue.routing_key,
+                    exchange=rqueue.exchange,
+                    retry=True,  # reconnect (to the next broker) on connection errors
+                    retry_policy={
+                        'max_retries': conf('global.amqp.publish_retries', 3),
+                        'interval_start': 0,
+                        'interval_step': 1,
+                        'interval_max': 2,
+                    },
+                    expiration=10000  # 10 seconds
+                )
             extension.log('info', "Publisher: Response sent to MQ")
         except ConnectionResetError:
             extension.log('error', "Publisher: ConnectionResetError: message may be not sent...")
+        except (LimitExceeded, OperationalError) as e:
+            extension.log('error', f"Publisher: Cannot publish the reply: {str(e)}")
         finally:
             self.thread_limiter.release()
         self.nb_requests_managed += 1
+
+    @staticmethod
+    def format_reply(data, properties):
+        """Build the reply message expected by vCD.
+
+        Args:
+            data (str): Body of the reply.
+            properties (dict): Reply properties.
+
+        Returns:
+            dict: The reply message content.
+        """
+        if properties.get("encode", True):
+            rsp_body = b64encode(data.encode('utf-8')).decode()
+        else:
+            rsp_body = b64encode(data).decode()  # raw data (encoded by the offload pool when large)
+        headers = {
+            'Content-Type': properties.get(
+                "Content-Type", "application/*+json;version=31.0"  # default
+            ),
+            'Content-Length': len(data)
+        }
+        if properties.get("Content-Encoding"):
+            headers['Content-Encoding'] = properties["Content-Encoding"]
+        return {
+            'id': properties.get('id', None),
+            'headers': headers,
+            'statusCode': properties.get("statusCode", 200),
+            'body': rsp_body
+        }
+
+
+class ConsumerShard(ConsumerMixin):
+    """Extra consumer of the queue of an extension.
+
+    A shard has its own connection, channel, prefetch and drain loop (run in
+    its own thread), so the intake of an extension is not serialized through
+    the consumer loop of the ``AMQPWorker``. Messages are processed by
+    ``AMQPWorker.process_task()``.
+    """
+
+    def __init__(self, amqp_worker, extension, index):
+        """Create a shard (see ``start()``).
+
+        Args:
+            amqp_worker (AMQPWorker): The worker processing the messages.
+            extension (vcdextproxy.RestApiExtension): The extension.
+            index (int): Index of the consumer for the extension.
+        """
+        self.amqp_worker = amqp_worker
+        self.connection = amqp_worker.connection
+        self.extension = extension
+        self.index = index
+        self.thread = None
+
+    def start(self):
+        """Run the consumer loop in a daemon thread.
+        """
+        self.thread = Thread(
+            target=self.run,
+            name=f"amqp-consumer-{self.extension.name}-{self.index}",
+            daemon=True
+        )
+        self.thread.start()
+
+    def get_consumers(self, Consumer, channel):
+        consumer = self.amqp_worker.extension_consumer(Consumer, self.extension)
+        return [consumer] if consumer else []
+
+    def on_connection_error(self, exc, interval):
+        if self.should_stop:
+            raise exc  # stop reconnecting: the consumer loop is leaving
+        self.extension.log('warning', f"Consumer {self.index}: broker connection error: {str(exc)}, "
+                                      f"retry in {interval}s")
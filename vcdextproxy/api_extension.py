@@ -3,12 +3,21 @@
 """
 from kombu import Exchange, Queue
 import json
-import sys
+from collections import namedtuple
+from threading import Event, Lock
+import requests
 from requests.auth import HTTPBasicAuth
+from vcdextproxy.backends import Backend
 from vcdextproxy.configuration import conf
 from vcdextproxy.utils import logger
-from vcdextproxy.vcd_utils import list_rights_available_in_vcd, login_as_system_admin
-from pyvcloud.vcd.api_extension import APIExtension
+from vcdextproxy.rights import rights_index
+from vcdextproxy.vcd_utils import login_as_system_admin
+
+HeadersTemplate = namedtuple('HeadersTemplate', ['headers', 'replaced', 'forward_rights'])
+"""namedtuple: Headers added to the backend requests, lower case names of the request headers they replace,
+and whether the vCD rights are forwarded (``user_rights`` header)."""
+UNKNOWN_RIGHT_ID = "xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx"
+"""str: ID of a reference right missing from the rights catalog (no user has it)."""
 
 
 class RestApiExtension:
@@ -23,8 +32,28 @@ class RestApiExtension:
         """
         self.name = extension_name
         self.conf_path = f'extensions.{extension_name}'
-        self.ref_right_id = self.get_reference_right()
-        self.initialize_on_vcloud()
+        self._ref_right_id = None
+        self._ref_right_version = None  # version of the rights index used to resolve the reference right
+        # vCD related initialization is done later (see initialize())
+        self.status = "pending"
+        self.ready = Event()
+        self._headers_template = None
+        self._backend = None
+        self._backend_lock = Lock()
+
+    def initialize(self):
+        """Resolve the reference right and register the extension on vCloud.
+        """
+        self.log('debug', "Starting the vCD related initialization.")
+        try:
+            self.resolve_reference_right()
+            self.initialize_on_vcloud()
+            self.status = "ready"
+        except Exception as e:
+            self.log('error', f"Initialization on vCloud failed: {str(e)}")
+            self.status = "failed"
+        finally:
+            self.ready.set()
 
     def log(self, level, message, *args, **kwargs):
         """Log a information about this extension by adding a prefix
@@ -50,7 +79,7 @@ class RestApiExtension:
         Returns:
             str: URL to use on the backend server.
         """
-        full_req_path = self.conf(f"backend.endpoint")
+        full_req_path = self.get_backend().base_url
         # Change the requested URI before sending to backend #14
         if self.conf(f"backend.uri_replace", False):
             pattern = self.conf(f"backend.uri_replace.pattern", "")
@@ -70,6 +99,41 @@ class RestApiExtension:
         """
         return conf(f"{self.conf_path}.{item}", default)
 
+    def get_backend(self):
+        """Return the connections to the backend (created on first use).
+
+        Returns:
+            vcdextproxy.backends.Backend: The backend.
+        """
+        if self._backend is None:
+            with self._backend_lock:
+                if self._backend is None:
+                    self._backend = Backend.from_extension(self)
+                    self.log('debug', f"Backend transport: {self._backend.transport}")
+        return self._backend
+
+    def get_headers_template(self):
+        """Return the headers template of the backend requests (built once).
+
+        Returns:
+            HeadersTemplate: The template.
+        """
+        if self._headers_template is None:
+            headers = {}
+            settings = self.conf('backend.compression', None)
+            if settings:
+                # only accept the encodings that can be decoded here
+                decodable = requests.utils.DEFAULT_ACCEPT_ENCODING.split(", ")
+                accepted = [encoding for encoding in settings.get('accept', ['gzip']) if encoding in decodable]
+                headers['Accept-Encoding'] = ", ".join(accepted) or "identity"
+            forward_rights = bool(self.conf('backend.forward_rights', False))
+            if forward_rights:
+                self.log('debug', "Including vCD rights as new header `user_rights`")
+            self._headers_template = HeadersTemplate(
+                headers, frozenset(name.lower() for name in headers), forward_rights
+            )
+        return self._headers_template
+
     def get_extension_auth(self):
         """Get the auth object if requested by extension.
 
@@ -107,22 +171,40 @@ class RestApiExtension:
         self.log('debug', f"Adding a new process task as callback for incoming messages")
         return queue
 
+    @property
+    def ref_right_id(self):
+        """str: ID of the reference right (False if none is configured).
+
+        A right missing from the rights catalog is resolved again after each refresh of the rights index.
+        """
+        if self._ref_right_id == UNKNOWN_RIGHT_ID and self._ref_right_version != rights_index.version:
+            self.resolve_reference_right()
+        return self._ref_right_id
+
+    def resolve_reference_right(self):
+        """Resolve the ID of the reference right from the rights index.
+        """
+        self._ref_right_version = rights_index.version
+        self._ref_right_id = self.get_reference_right()
+
     def get_reference_right(self):
         """Get the ID of the reference right set in the configuration
+
+        The ID is resolved through the process-wide rights index.
         """
         if not self.conf('vcloud.reference_right', False):
             return False
         else:
-            for instance_right in list_rights_available_in_vcd(self.name):
-                if instance_right['name'] == self.conf('vcloud.reference_right'):
-                    return instance_right['href'].split('/')[-1]
+            right_id = rights_index.get_id(self.conf('vcloud.reference_right'))
+            if right_id:
+                return right_id
             # If not already found: error
             self.log(
                 'error',
                 f"Invalid reference right `{self.conf('vcloud.reference_right')}` configured for the extension."
             )
             # Return a fake ID to force errors when checking user's rights
-            return "xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx"
+            return UNKNOWN_RIGHT_ID
 
     def initialize_on_vcloud(self):
         """Check and/register the extension on vCloud.
@@ -135,6 +217,9 @@ class RestApiExtension:
         ):
             self.log('warning', 'Missing items in configuration to make the initialization check-up. Ignoring.')
             return
+        # pyvcloud is only loaded by the vCD initialization (in background)
+        from pyvcloud.vcd.api_extension import APIExtension
+        from pyvcloud.vcd.exceptions import MissingRecordException, MultipleRecordsException
         client = login_as_system_admin()
         ext_manager = APIExtension(client)
         try:
@@ -146,8 +231,8 @@ class RestApiExtension:
             self.log('warning', "This extension is not (yet) declared on vCloud.")
             current_ext_on_vcd = None
         except MultipleRecordsException:
-            self.log('error', "Multiple extensions found with same name and namespace")
-            sys.exit(-1)
+            self.log('critical', "Multiple extensions found with same name and namespace")
+            raise
         # Force a fresh redeploy of the full extension (Warning: be carrefull, ID will change !)
         if current_ext_on_vcd and self.conf('vcloud.api_extension.force_redeploy', False):
             ext_manager.delete_extension(
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""Transports of the backend requests.
+
+``backend.endpoint`` of an extension can be:
+
+* ``http://host:port`` or ``https://host:port``: HTTP/1.1 over TCP.
+* ``unix:///path/to/socket``: HTTP/1.1 over a Unix domain socket (backend
+  co-located with the proxy, like a sidecar).
+* ``h2://host:port`` (TLS) or ``h2c://host:port`` (clear text, prior
+  knowledge): HTTP/2, the concurrent requests are multiplexed on a few
+  connections. Needs the optional ``httpx`` package
+  (``pip install vcdextproxy[http2]``).
+
+Each extension keeps a pool of persistent connections
+(``backend.pool_size``, ``global.max_threads`` by default).
+"""
+import socket
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3 import HTTPConnectionPool
+from urllib3.connection import HTTPConnection
+from vcdextproxy.scheduler import get_max_threads
+
+METHODS = frozenset(['get', 'head', 'post', 'put', 'patch', 'delete', 'options'])
+"""frozenset: HTTP methods which can be forwarded to a backend."""
+HOP_BY_HOP_HEADERS = frozenset(['connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade'])
+
+
+def import_httpx():
+    """Import the optional HTTP/2 client (only loaded by the HTTP/2 backends).
+
+    Raises:
+        RuntimeError: ``httpx`` is not installed.
+    """
+    try:
+        import httpx
+    except ImportError:
+        raise RuntimeError("HTTP/2 backends need the httpx package: pip install vcdextproxy[http2]")
+    return httpx
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """HTTP connection over a Unix domain socket.
+    """
+
+    def __init__(self, *args, socket_path=None, **kwargs):
+        self.socket_path = socket_path
+        super().__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    """Pool of the connections to a Unix domain socket.
+    """
+    ConnectionCls = UnixHTTPConnection
+
+    def __init__(self, socket_path, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.socket_path = socket_path
+        self.conn_kw['socket_path'] = socket_path
+
+
+class UnixAdapter(HTTPAdapter):
+    """Send the requests to a Unix domain socket (whatever the host of the URL).
+    """
+
+    def __init__(self, socket_path, pool_maxsize=10):
+        self.socket_path = socket_path
+        self.pool = UnixHTTPConnectionPool(socket_path, maxsize=pool_maxsize)
+        super().__init__(pool_maxsize=pool_maxsize)
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.pool
+
+    def get_connection(self, url, proxies=None):  # requests < 2.32
+        return self.pool
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        super().close()
+        self.pool.close()
+
+
+class HTTP2Adapter(BaseAdapter):
+    """Send the requests with an HTTP/2 client (``httpx``).
+
+    The responses are converted to ``requests.Response`` objects and the
+    ``httpx`` errors to the matching ``requests`` exceptions.
+    """
+
+    def __init__(self, tls=True, verify=True, max_connections=10):
+        """Create the HTTP/2 client.
+
+        Args:
+            tls (bool): HTTP/2 over TLS (``False``: clear text with prior knowledge).
+            verify (bool): Verify the certificate of the backend.
+            max_connections (int): Maximum number of connections.
+        """
+        super().__init__()
+        self.httpx = httpx = import_httpx()
+        self.client = httpx.Client(
+            http1=tls,  # clear text HTTP/2 is only possible with prior knowledge
+            http2=True,
+            verify=verify,
+            limits=httpx.Limits(max_connections=max_connections),
+        )
+
+    def get_timeout(self, timeout):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return self.httpx.Timeout(read, connect=connect)
+        return self.httpx.Timeout(timeout)
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        headers = [(key, value) for key, value in request.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS]
+        try:
+            rsp = self.client.request(
+                request.method, request.url, headers=headers, content=request.body, timeout=self.get_timeout(timeout)
+            )
+        except self.httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e, request=request)
+        except self.httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+        response = requests.Response()
+        response.status_code = rsp.status_code
+        response.headers = CaseInsensitiveDict(rsp.headers.multi_items())
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.reason = rsp.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response._content = rsp.content  # decoded as requests does
+        return response
+
+    def close(self):
+        self.client.close()
+
+
+class Backend:
+    """Connections of an extension to its backend.
+    """
+
+    def __init__(self, endpoint, pool_size=10, verify=True):
+        """Prepare the transport matching the endpoint.
+
+        Args:
+            endpoint (str): The ``backend.endpoint`` setting.
+            pool_size (int): Maximum number of connections.
+            verify (bool): Verify the certificate of the backend (HTTPS and h2 endpoints).
+
+        Raises:
+            RuntimeError: The HTTP/2 client is not installed.
+        """
+        scheme = urlsplit(endpoint).scheme.lower()
+        self.session = requests.Session()
+        # backend cookies must not leak from a user to another
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        if scheme == "unix":
+            self.transport = "unix"
+            self.base_url = "http://localhost"
+            self.session.mount(self.base_url, UnixAdapter(urlsplit(endpoint).path, pool_maxsize=pool_size))
+        elif scheme in ("h2", "h2c"):
+            self.transport = "http2"
+            self.base_url = ("https" if scheme == "h2" else "http") + endpoint[len(scheme):]
+            self.session.mount(self.base_url, HTTP2Adapter(scheme == "h2", verify, max_connections=pool_size))
+        else:
+            self.transport = "http/1.1"
+            self.base_url = endpoint
+            self.session.mount(self.base_url, HTTPAdapter(pool_maxsize=pool_size))
+
+    @classmethod
+    def from_extension(cls, extension):
+        """Create the backend of an extension (``backend.endpoint``, ``pool_size`` and ``ssl_verify``).
+        """
+        return cls(
+            extension.conf('backend.endpoint'),
+            extension.conf('backend.pool_size', get_max_threads()),
+            extension.conf('backend.ssl_verify', True)
+        )
+
+    def get_sender(self, method):
+        """Return the session function sending a request with the method.
+
+        Raises:
+            AttributeError: Unsupported method.
+        """
+        if method not in METHODS:
+            raise AttributeError(method)
+        return getattr(self.session, method)
+
+    def close(self):
+        self.session.close()
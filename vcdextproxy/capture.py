@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Capture of the received messages, to replay real traffic offline.
+
+With ``global.capture.enabled``, each message received by the proxy is
+appended to ``global.capture.path`` as a JSON line (gzip compressed when the
+path ends with ``.gz``)::
+
+    {"t": <reception time>, "exchange": ..., "routing_key": ..., "correlation_id": ..., "body": ...}
+
+The authentication tokens of the requests are redacted by default
+(``global.capture.redact_tokens``). Captures are replayed by
+``python -m benchmarks replay``.
+"""
+import gzip
+import json
+from threading import Lock
+from time import monotonic, time
+from vcdextproxy.configuration import conf
+
+REDACTED_HEADERS = frozenset(['x-vcloud-authorization', 'authorization', 'cookie'])
+REDACTED = "redacted"
+
+
+def redact_tokens(body):
+    """Remove the authentication headers of a vCD message.
+
+    Args:
+        body (str): JSON content of the message.
+
+    Returns:
+        str: The content without the tokens (unchanged if it is not a vCD message).
+    """
+    try:
+        content = json.loads(body)
+        headers = content[0]['headers']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return body
+    for key in headers:
+        if key.lower() in REDACTED_HEADERS:
+            headers[key] = REDACTED
+    return json.dumps(content)
+
+
+def open_capture(path, mode):
+    """Open a capture file (gzip compressed if the path ends with ``.gz``).
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class CaptureWriter:
+    """Append the received messages to a capture file.
+    """
+
+    def __init__(self, path, redact=True, flush_interval=1.0):
+        """Open the capture file (in append mode).
+
+        Args:
+            path (str): Path of the file.
+            redact (bool): Redact the authentication tokens.
+            flush_interval (float): Maximum time (seconds) between two writes to the disk.
+        """
+        self.path = path
+        self.redact = redact
+        self.flush_interval = flush_interval
+        self.count = 0
+        self._fd = open_capture(path, 'a')
+        self._flushed = monotonic()
+        self._lock = Lock()
+
+    @classmethod
+    def from_conf(cls):
+        """Create the writer from ``global.capture`` (None if disabled).
+        """
+        if not conf('global.capture.enabled', False):
+            return None
+        return cls(conf('global.capture.path'), conf('global.capture.redact_tokens', True))
+
+    def write(self, body, message):
+        """Append a message.
+
+        Args:
+            body (str): JSON content of the message.
+            message (kombu.message.Message): The message.
+        """
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        record = json.dumps({
+            't': round(time(), 6),
+            'exchange': message.delivery_info.get('exchange'),
+            'routing_key': message.delivery_info.get('routing_key'),
+            'correlation_id': message.properties.get('correlation_id'),
+            'body': redact_tokens(body) if self.redact else body,
+        }, separators=(',', ':'))
+        with self._lock:
+            self._fd.write(record + "\n")
+            self.count += 1
+            if monotonic() - self._flushed >= self.flush_interval:
+                self._fd.flush()
+                self._flushed = monotonic()
+
+    def close(self):
+        with self._lock:
+            self._fd.close()
+
+
+def read_capture(path):
+    """Iterate over the records of a capture file.
+
+    Yields:
+        dict: The records (see ``CaptureWriter.write()``).
+    """
+    with open_capture(path, 'r') as fd:
+        try:
+            for line in fd:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, ValueError):  # truncated by a crash of the proxy
+            return
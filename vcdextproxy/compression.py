@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Compression helpers for the backend traffic and the replies to vCD.
+
+``gzip`` is always available, ``zstd`` needs the optional ``zstandard``
+package (``pip install vcdextproxy[zstd]``).
+"""
+import gzip
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def import_zstandard():
+    """Import the optional zstd codec on first use (None if not installed).
+    """
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def _zstd_compress(data, level):
+    return import_zstandard().ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data):
+    return import_zstandard().ZstdDecompressor().decompressobj().decompress(data)
+
+
+CODECS = {
+    'gzip': (lambda data, level: gzip.compress(data, compresslevel=level), gzip.decompress),
+    'zstd': (_zstd_compress, _zstd_decompress),
+}
+"""dict: encoding -> (compress(data, level), decompress(data)) functions."""
+OPTIONAL_CODECS = {'zstd': import_zstandard}
+"""dict: encoding -> loader of its optional package (None if not installed)."""
+
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+
+
+def available_encodings(encodings):
+    """Filter the encodings supported by this installation.
+
+    Args:
+        encodings ([str]): Requested encodings.
+
+    Returns:
+        [str]: The available ones (same order).
+    """
+    return [
+        encoding for encoding in encodings
+        if encoding in CODECS and (encoding not in OPTIONAL_CODECS or OPTIONAL_CODECS[encoding]() is not None)
+    ]
+
+
+def accepted_encodings(accept_encoding):
+    """Parse an ``Accept-Encoding`` header.
+
+    Returns:
+        set: The accepted encodings (``q=0`` excluded).
+    """
+    accepted = set()
+    for part in (accept_encoding or "").split(','):
+        encoding, _, params = part.partition(';')
+        encoding = encoding.strip().lower()
+        name, _, value = params.strip().partition('=')
+        try:
+            if name.strip() == 'q' and float(value) <= 0:
+                continue
+        except ValueError:
+            continue
+        if encoding:
+            accepted.add(encoding)
+    return accepted
+
+
+def negotiate(accept_encoding, encodings):
+    """Choose an encoding accepted by the client.
+
+    Args:
+        accept_encoding (str): ``Accept-Encoding`` header of the client.
+        encodings ([str]): Encodings allowed by the configuration (by preference).
+
+    Returns:
+        str: The encoding or None.
+    """
+    accepted = accepted_encodings(accept_encoding)
+    for encoding in available_encodings(encodings):
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+
+def compress(data, encoding, level=None):
+    """Compress data.
+
+    Args:
+        data (bytes): The data.
+        encoding (str): ``gzip`` or ``zstd``.
+        level (int): Compression level (default for the encoding if None).
+
+    Returns:
+        bytes: The compressed data.
+    """
+    return CODECS[encoding][0](data, level if level is not None else DEFAULT_LEVELS[encoding])
+
+
+def decompress(data, encoding):
+    """Decompress data.
+
+    Returns:
+        bytes: The decompressed data.
+    """
+    return CODECS[encoding][1](data)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""Concurrency limits of the extensions, adapted to the observed backend latency.
+
+Settings (``extensions.<name>.backend.concurrency``):
+
+* ``algorithm``: ``fixed`` (default), ``aimd`` or ``gradient``.
+* ``min``, ``max`` and ``initial``: bounds and initial value of the limit.
+* ``aimd``: ``latency_threshold`` (seconds) and ``backoff`` ratio.
+* ``gradient``: ``tolerance`` (accepted ratio between the current and the
+  no-load latency) and ``smoothing``.
+
+The limiters are not thread-safe: they are used under the lock of the
+scheduler queue.
+"""
+import math
+
+
+class FixedLimit:
+    """Static concurrency limit.
+    """
+
+    name = "fixed"
+
+    def __init__(self, initial=10, min=1, max=None):
+        """Create a limiter.
+
+        Args:
+            initial (int): Initial limit.
+            min (int): Minimal limit.
+            max (int): Maximal limit.
+        """
+        self.min = min
+        self.max = max or initial
+        self._set(float(initial))
+        self.inflight = 0
+        self.samples = 0
+        self.errors = 0
+
+    @property
+    def limit(self):
+        """int: Current concurrency limit."""
+        return int(self._limit)
+
+    def available(self):
+        """Tell if a new request can be started.
+        """
+        return self.inflight < self.limit
+
+    def started(self):
+        """A request is started.
+        """
+        self.inflight += 1
+
+    def finished(self, latency=None, error=False):
+        """A request is over.
+
+        Args:
+            latency (float): Backend latency in seconds (None: no backend call).
+            error (bool): The backend failed (5xx, 429, timeout, connection error).
+        """
+        inflight = self.inflight
+        self.inflight -= 1
+        if latency is None:
+            return
+        self.samples += 1
+        if error:
+            self.errors += 1
+        self.update(latency, error, inflight)
+
+    def update(self, latency, error, inflight):
+        """Adapt the limit after a backend call.
+        """
+
+    def _set(self, limit):
+        self._limit = min(self.max, max(self.min, limit))
+
+    def get_metrics(self):
+        """Return the state of the limiter.
+        """
+        return {
+            'algorithm': self.name,
+            'limit': self.limit,
+            'inflight': self.inflight,
+            'samples': self.samples,
+            'errors': self.errors,
+        }
+
+
+class AIMDLimit(FixedLimit):
+    """Additive increase (+1 per limit of successful calls), multiplicative decrease.
+    """
+
+    name = "aimd"
+
+    def __init__(self, initial=10, min=1, max=100, latency_threshold=None, backoff=0.9):
+        """Create a limiter.
+
+        Args:
+            latency_threshold (float): Latency (seconds) considered as an overload (None: errors only).
+            backoff (float): Ratio applied to the limit on overload.
+        """
+        FixedLimit.__init__(self, initial, min, max)
+        self.latency_threshold = latency_threshold
+        self.backoff = backoff
+
+    def update(self, latency, error, inflight):
+        if error or (self.latency_threshold and latency > self.latency_threshold):
+            self._set(self._limit * self.backoff)
+        elif inflight * 2 >= self._limit:  # only grow when the limit is really used
+            self._set(self._limit + 1 / self._limit)
+
+
+class GradientLimit(FixedLimit):
+    """Limit following the ratio between the no-load latency and the current one.
+
+    The no-load latency is the minimal latency of a window of samples. It is
+    periodically measured again with the limit lowered to its minimum for a
+    window (the queue of the backend is drained), else it would follow the
+    latency of a loaded backend. When the latency is stable, the limit grows
+    by a ``sqrt(limit)`` queue allowance.
+    """
+
+    name = "gradient"
+
+    def __init__(self, initial=10, min=1, max=100, tolerance=2.0, smoothing=0.2, window=50, probe_every=20):
+        """Create a limiter.
+
+        Args:
+            tolerance (float): Accepted ratio between the current latency and the no-load one.
+            smoothing (float): Weight of a new limit estimation.
+            window (int): Number of samples of a window.
+            probe_every (int): Number of windows between two measures of the no-load latency.
+        """
+        FixedLimit.__init__(self, initial, min, max)
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.window = window
+        self.probe_every = probe_every
+        self.noload_latency = None
+        self._window_min = None
+        self._window_samples = 0
+        self._windows = 0
+        self._probe_limit = None  # limit to restore after a probe
+
+    def update(self, latency, error, inflight):
+        self._window_samples += 1
+        if self._window_min is None or latency < self._window_min:
+            self._window_min = latency
+        if self._window_samples >= self.window:
+            self.end_window()
+        if self._probe_limit is not None:
+            return  # probing the no-load latency
+        if error:
+            self._set(self._limit * 0.9)
+            return
+        if self.noload_latency is None or latency < self.noload_latency:
+            self.noload_latency = latency
+        gradient = max(0.5, min(1.0, self.tolerance * self.noload_latency / max(latency, 1e-6)))
+        new_limit = self._limit * gradient
+        if inflight * 2 >= self._limit:  # only grow when the limit is really used
+            new_limit += math.sqrt(self._limit)
+        self._set(self._limit * (1 - self.smoothing) + new_limit * self.smoothing)
+
+    def end_window(self):
+        """Update the no-load latency at the end of a window and start the probes.
+        """
+        if self._probe_limit is not None:
+            # end of a probe: the minimum of the window is the no-load latency
+            self.noload_latency = self._window_min
+            self._set(self._probe_limit)
+            self._probe_limit = None
+        else:
+            self._windows += 1
+            if self._windows >= self.probe_every:
+                self._windows = 0
+                self._probe_limit = self._limit
+                self._set(self.min)
+        self._window_min = None
+        self._window_samples = 0
+
+    def get_metrics(self):
+        metrics = FixedLimit.get_metrics(self)
+        metrics['noload_latency'] = self.noload_latency
+        metrics['probing'] = self._probe_limit is not None
+        return metrics
+
+
+ALGORITHMS = {limiter.name: limiter for limiter in (FixedLimit, AIMDLimit, GradientLimit)}
+
+
+def build_limiter(settings, default_limit):
+    """Build the concurrency limiter of an extension.
+
+    Args:
+        settings (dict): The ``backend.concurrency`` settings (may be None).
+        default_limit (int): Limit used without settings (and default maximum).
+
+    Raises:
+        ValueError: Unknown algorithm.
+
+    Returns:
+        FixedLimit: The limiter.
+    """
+    settings = dict(settings or {})
+    algorithm = settings.pop('algorithm', 'fixed')
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unknown concurrency algorithm: {algorithm}")
+    settings.setdefault('max', default_limit)
+    settings.setdefault('initial', settings['max'] if algorithm == 'fixed' else min(10, settings['max']))
+    return ALGORITHMS[algorithm](**settings)
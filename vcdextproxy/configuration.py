@@ -6,8 +6,6 @@ import logging.config
 import os
 import sys
 import json
-import yaml
-import urllib3
 from cachetools import cached, TTLCache
 from vcdextproxy.utils import logger
 
@@ -17,13 +15,14 @@ env_setting_conf = "VCDEXTPROXY_CONFIGURATION_PATH"
 config_cache_expire = 300
 
 
-@cached(TTLCache(maxsize=1000, ttl=config_cache_expire))  # Set in cache for X secondes
+@cached({})  # read once: the first call is the initialization step
 def read_configuration():
     """Test environment settings and import config.
 
-    Return value is cached to be available quickly and avoid a lot
-        of reads + yaml loading.
+    The file is read once, by the explicit initialization of the proxy
+    (see ``__main__``) or on the first ``conf()`` call, never on import.
     """
+    import yaml
     # import configuration from ENV settings
     conf_path = os.environ.get(env_setting_conf)
     if not conf_path:
@@ -48,7 +47,7 @@ def read_configuration():
 
 
 MANDATORY = object()  # new unique object
-@cached(TTLCache(maxsize=1000, ttl=config_cache_expire))  # Set in cache for X secondes
+@cached(TTLCache(maxsize=1000, ttl=config_cache_expire), info=True)  # Set in cache for X secondes
 def get_configuration_item(configuration_item, default=MANDATORY):
     """Get a configuration setting.
 
@@ -102,6 +101,7 @@ def configure_logger():
         logging.config.dictConfig(json.load(fd))
     # reduce log level for some modules
     logging.captureWarnings(True)
+    import urllib3
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
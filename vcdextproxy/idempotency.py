@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Recent replies, to answer the redelivered messages without running them again.
+
+RabbitMQ redelivers a message when its acknowledgment is lost (connection
+drop...). The reply of a request is kept for a while (``global.idempotency``)
+with the vCD request ``id`` and the ``correlation_id`` of the message as key:
+a redelivered message gets the same reply at once, and a non-idempotent
+request is not sent twice to the backend.
+"""
+from threading import Lock
+from cachetools import TTLCache
+from vcdextproxy.configuration import conf
+
+ENTRY_OVERHEAD = 512  # bytes accounted for the key and the properties of a reply
+
+
+class ReplyStore:
+    """Bounded (count, bytes and age) store of the recent replies.
+    """
+
+    def __init__(self, ttl=60, max_bytes=16 * 1024 * 1024, uncached_status_codes=(429, 503)):
+        """Create an empty store.
+
+        Args:
+            ttl (float): Time to keep a reply (seconds).
+            max_bytes (int): Memory bound of the stored replies (older ones are evicted).
+            uncached_status_codes ([int]): Transient rejections, not stored (the request is run again).
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.uncached_status_codes = frozenset(int(status) for status in uncached_status_codes)
+        self._replies = TTLCache(maxsize=max_bytes, ttl=ttl, getsizeof=self.size_of)
+        self._lock = Lock()
+        self.stats = {'hits': 0, 'stored': 0, 'too_large': 0}
+
+    @classmethod
+    def from_conf(cls):
+        """Create the store from ``global.idempotency`` (None if disabled).
+        """
+        if not conf('global.idempotency.enabled', True):
+            return None
+        return cls(
+            conf('global.idempotency.ttl', 60),
+            conf('global.idempotency.max_bytes', 16 * 1024 * 1024),
+            conf('global.idempotency.uncached_status_codes', (429, 503))
+        )
+
+    @staticmethod
+    def size_of(reply):
+        return len(reply[0]) + ENTRY_OVERHEAD
+
+    @staticmethod
+    def key(request_id, correlation_id):
+        return (request_id, correlation_id)
+
+    def get(self, request_id, correlation_id):
+        """Return a stored reply.
+
+        Returns:
+            (bytes, dict): Body and properties of the reply (None if unknown).
+        """
+        with self._lock:
+            reply = self._replies.get(self.key(request_id, correlation_id))
+            if reply is not None:
+                self.stats['hits'] += 1
+            return reply
+
+    def put(self, request_id, correlation_id, data, properties):
+        """Store a reply.
+
+        Args:
+            request_id (str): ID of the vCD request.
+            correlation_id (str): Correlation ID of the message.
+            data (bytes): Body of the reply (as published).
+            properties (dict): Properties of the reply.
+        """
+        if request_id is None or correlation_id is None:
+            return
+        if int(properties.get('statusCode', 200)) in self.uncached_status_codes:
+            return
+        with self._lock:
+            try:
+                self._replies[self.key(request_id, correlation_id)] = (data, properties)
+                self.stats['stored'] += 1
+            except ValueError:  # larger than the whole store
+                self.stats['too_large'] += 1
+
+    def get_metrics(self):
+        """Return the size and the counters of the store.
+        """
+        with self._lock:
+            return dict(self.stats, size=len(self._replies), bytes=self._replies.currsize, max_bytes=self.max_bytes)
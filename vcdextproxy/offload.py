@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""Offload of the encoding and decoding of large bodies to other processes.
+
+The base64 and JSON codecs hold the GIL: while a large body is encoded or
+decoded, all the other threads (consumer loops, small requests...) wait.
+With ``global.offload.enabled``, bodies of at least ``global.offload.min_size``
+bytes are processed by a pool of processes (``global.offload.processes``):
+
+* the JSON parsing of the received messages,
+* the base64 decoding of the request bodies,
+* the base64 encoding of the replies.
+
+The data is exchanged through shared memory buffers (Python 3.8 or later,
+pickled otherwise). Smaller bodies stay in the calling thread.
+"""
+import base64
+import binascii
+import json
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from threading import Lock
+from vcdextproxy.configuration import conf
+from vcdextproxy.utils import logger
+
+try:  # Python >= 3.8
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:  # pragma: no cover
+    SharedMemory = None
+
+
+def _attach(name, size):
+    """Return a shared memory block and a view of its first ``size`` bytes (in a pool process).
+    """
+    shm = SharedMemory(name)
+    return shm, shm.buf[:size]
+
+
+def _shm_b64encode(in_name, size, out_name):
+    shm_in, data = _attach(in_name, size)
+    try:
+        encoded = binascii.b2a_base64(data, newline=False)
+    finally:
+        data.release()
+        shm_in.close()
+    shm_out, out = _attach(out_name, len(encoded))
+    try:
+        out[:] = encoded
+    finally:
+        out.release()
+        shm_out.close()
+    return len(encoded)
+
+
+def _shm_b64decode(in_name, size, out_name):
+    shm_in, data = _attach(in_name, size)
+    try:
+        decoded = binascii.a2b_base64(data)
+    finally:
+        data.release()
+        shm_in.close()
+    shm_out, out = _attach(out_name, len(decoded))
+    try:
+        out[:] = decoded
+    finally:
+        out.release()
+        shm_out.close()
+    return len(decoded)
+
+
+def _shm_json_loads(in_name, size):
+    shm_in, data = _attach(in_name, size)
+    try:
+        return json.loads(bytes(data))
+    finally:
+        data.release()
+        shm_in.close()
+
+
+def _noop():
+    return None
+
+
+class Offloader:
+    """Run the codecs of the large bodies in a pool of processes.
+    """
+
+    def __init__(self, processes=2, min_size=256 * 1024):
+        """Create an offloader (the processes are started on first use, see ``start()``).
+
+        Args:
+            processes (int): Number of processes.
+            min_size (int): Smallest body offloaded (bytes).
+        """
+        self.processes = processes
+        self.min_size = min_size
+        self.stats = {'offloaded': 0, 'offloaded_bytes': 0, 'inline': 0, 'failures': 0}
+        self._executor = None
+        self._lock = Lock()
+
+    @classmethod
+    def from_conf(cls):
+        """Create the offloader from ``global.offload`` (None if disabled).
+        """
+        if not conf('global.offload.enabled', False):
+            return None
+        return cls(conf('global.offload.processes', 2), conf('global.offload.min_size', 256 * 1024))
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawned processes: forking a multi-threaded process is not safe
+                self._executor = ProcessPoolExecutor(self.processes, mp_context=get_context('spawn'))
+            return self._executor
+
+    def start(self):
+        """Start the processes of the pool (instead of at the first large body).
+        """
+        executor = self.executor()
+        for future in [executor.submit(_noop) for _ in range(self.processes)]:
+            future.result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def offloaded(self, data):
+        """Tell whether a body is large enough to be offloaded (and count it).
+        """
+        if len(data) < self.min_size:
+            self.stats['inline'] += 1
+            return False
+        self.stats['offloaded'] += 1
+        self.stats['offloaded_bytes'] += len(data)
+        return True
+
+    def run(self, func, data, out_size=None):
+        """Run a codec in the pool, through shared memory buffers.
+
+        Args:
+            func (callable): ``func(in_name, size[, out_name])`` run in a pool process.
+            data (bytes): Input of the codec.
+            out_size (int): Size of the output buffer (None: the result is returned by ``func``).
+
+        Raises:
+            concurrent.futures.process.BrokenProcessPool: A pool process died.
+        """
+        shm_in = SharedMemory(create=True, size=max(1, len(data)))
+        shm_out = SharedMemory(create=True, size=max(1, out_size)) if out_size is not None else None
+        try:
+            shm_in.buf[:len(data)] = data
+            if shm_out is None:
+                return self.executor().submit(func, shm_in.name, len(data)).result()
+            length = self.executor().submit(func, shm_in.name, len(data), shm_out.name).result()
+            return bytes(shm_out.buf[:length])
+        finally:
+            for shm in (shm_in, shm_out):
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+
+    def call(self, inline, func, data, out_size=None):
+        """Run a codec in the pool (``inline(data)`` in this thread if the pool is broken).
+        """
+        try:
+            if SharedMemory is None:
+                return self.executor().submit(inline, data).result()
+            return self.run(func, data, out_size)
+        except BrokenProcessPool:
+            self.stats['failures'] += 1
+            logger.error("Offload: a pool process died: restarting the pool")
+            with self._lock:
+                self._executor = None
+            return inline(data)
+
+    def b64encode(self, data):
+        """Encode in base64 (``base64.b64encode``).
+        """
+        if not self.offloaded(data):
+            return base64.b64encode(data)
+        return self.call(base64.b64encode, _shm_b64encode, data, 4 * ((len(data) + 2) // 3))
+
+    def b64decode(self, data):
+        """Decode base64 data (``base64.b64decode``).
+        """
+        if not self.offloaded(data):
+            return base64.b64decode(data)
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        return self.call(base64.b64decode, _shm_b64decode, data, 3 * (len(data) // 4) + 3)
+
+    def json_loads(self, data):
+        """Parse a JSON document (``json.loads``).
+        """
+        if not self.offloaded(data):
+            return json.loads(data)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return self.call(json.loads, _shm_json_loads, data)
+
+    def get_metrics(self):
+        return dict(self.stats, processes=self.processes, min_size=self.min_size)
+
+
+_offloader = []
+_offloader_lock = Lock()
+
+
+def get_offloader():
+    """Return the process-wide offloader (None if disabled).
+    """
+    with _offloader_lock:
+        if not _offloader:
+            _offloader.append(Offloader.from_conf())
+        return _offloader[0]
+
+
+def b64encode(data):
+    """Encode in base64, in the offload pool for large bodies.
+    """
+    offloader = get_offloader()
+    return offloader.b64encode(data) if offloader else base64.b64encode(data)
+
+
+def b64decode(data):
+    """Decode base64 data, in the offload pool for large bodies.
+    """
+    offloader = get_offloader()
+    return offloader.b64decode(data) if offloader else base64.b64decode(data)
+
+
+def json_loads(data):
+    """Parse a JSON document, in the offload pool for large documents.
+    """
+    offloader = get_offloader()
+    return offloader.json_loads(data) if offloader else json.loads(data)
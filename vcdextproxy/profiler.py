@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""On-demand sampling profiler for production troubleshooting.
+
+The stacks of all the threads (kombu consumer loop, REST workers...) are
+sampled for a while and written in the collapsed format of the flamegraph
+tools (``<thread>;<frame>;<frame> <count>`` lines)::
+
+    $ flamegraph.pl vcdextproxy-20200101-120000.collapsed > profile.svg
+
+A profile is started with the ``SIGUSR1`` signal (written in
+``global.profiler.directory``) or with the ``/profile?seconds=N`` view of the
+admin endpoint. No sampling thread runs when no profile is requested.
+"""
+import os
+import re
+import sys
+import tempfile
+from collections import Counter
+from threading import Lock, Thread, current_thread, enumerate as enumerate_threads
+from time import monotonic, sleep, strftime
+from vcdextproxy.configuration import conf
+from vcdextproxy.utils import logger
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    path = code.co_filename.split(os.sep)
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame):
+    """Return the frames of a stack, outermost first.
+
+    Args:
+        frame (frame): The innermost frame.
+
+    Returns:
+        [str]: Frame labels.
+    """
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+class SamplingProfiler:
+    """Sample the stacks of all the threads at a fixed interval.
+    """
+
+    def __init__(self, interval=0.005, group_threads=True):
+        """Create a profiler.
+
+        Args:
+            interval (float): Time between two samples (seconds).
+            group_threads (bool): Merge the threads of a pool (``rest-worker-1``, ``rest-worker-2``...).
+        """
+        self.interval = interval
+        self.group_threads = group_threads
+        self.stacks = Counter()
+        self.samples = 0
+        self._lock = Lock()
+
+    @property
+    def running(self):
+        """bool: A profile is in progress."""
+        return self._lock.locked()
+
+    def thread_name(self, name):
+        if self.group_threads:
+            return re.sub(r"[-_]?\d+$", "", name) or name
+        return name
+
+    def sample(self, ignored=()):
+        """Record the current stack of each thread.
+
+        Args:
+            ignored (set): Identifiers of the threads to skip.
+        """
+        names = {thread.ident: thread.name for thread in enumerate_threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident in ignored:
+                continue
+            name = self.thread_name(names.get(ident, f"thread-{ident}"))
+            self.stacks[";".join([name] + collapse_stack(frame))] += 1
+        self.samples += 1
+
+    def profile(self, duration):
+        """Sample the threads for a while (blocking).
+
+        Args:
+            duration (float): Profile duration (seconds).
+
+        Returns:
+            collections.Counter: Number of samples by collapsed stack (None if a profile is in progress).
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            self.stacks = Counter()
+            self.samples = 0
+            ignored = {current_thread().ident}
+            deadline = monotonic() + duration
+            while monotonic() < deadline:
+                self.sample(ignored)
+                sleep(self.interval)
+            return self.stacks
+        finally:
+            self._lock.release()
+
+    def profile_to_file(self, duration, path):
+        """Sample the threads for a while and write the collapsed stacks.
+
+        Returns:
+            bool: The profile was written (False if a profile is in progress).
+        """
+        logger.info(f"Profiling all threads for {duration}s...")
+        stacks = self.profile(duration)
+        if stacks is None:
+            logger.warning("A profile is already in progress")
+            return False
+        with open(path, 'w') as fd:
+            fd.write(format_collapsed(stacks))
+        logger.info(f"Profile written ({self.samples} samples): {path}")
+        return True
+
+    def start(self, duration, path):
+        """Run ``profile_to_file()`` in a background thread.
+
+        Returns:
+            bool: The profile was started (False if a profile is in progress).
+        """
+        if self.running:
+            logger.warning("A profile is already in progress")
+            return False
+        Thread(target=self.profile_to_file, args=(duration, path), name="profiler", daemon=True).start()
+        return True
+
+
+def format_collapsed(stacks):
+    """Format stacks in the collapsed format (most sampled first).
+
+    Args:
+        stacks (collections.Counter): Number of samples by collapsed stack.
+
+    Returns:
+        str: ``<stack> <count>`` lines.
+    """
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+profiler = SamplingProfiler()
+
+
+def profile_signal_handler(signal, frame):
+    """Start a profile in the background (``SIGUSR1``).
+    """
+    directory = conf('global.profiler.directory', tempfile.gettempdir())
+    path = os.path.join(directory, f"vcdextproxy-{strftime('%Y%m%d-%H%M%S')}.collapsed")
+    profiler.interval = conf('global.profiler.interval', profiler.interval)
+    profiler.start(conf('global.profiler.duration', 30), path)
@@ -2,76 +2,224 @@
 """The REST worker is in charge of dealing with REST API backends.
 """
 
-import base64
 import json
 import requests
-from threading import Thread
+from time import monotonic
+from vcdextproxy.compression import available_encodings, compress, negotiate
 from vcdextproxy.configuration import conf
-from vcdextproxy.vcd_utils import login_from_token, get_user_rights
-from pyvcloud.vcd.org import Org
+from vcdextproxy.offload import b64decode
+from vcdextproxy.retries import get_retry_policy
+from vcdextproxy.rights import RightsUnavailable, get_user_rights, ids_from_urns
+from vcdextproxy.tokens import InvalidToken, validate_token
 
 
-class RESTWorker(Thread):
+def get_header(headers, name):
+    """Return a header of a vCD request (case-insensitive).
 
-    def __init__(self, extension, message_worker, data, message):
-        Thread.__init__(self)
+    vCD sends the headers with their usual spelling: the direct lookups
+    only fall back to a scan of the headers for unusual ones.
+
+    Args:
+        headers (dict): Headers of the request.
+        name (str): Name of the header (lower case).
+
+    Returns:
+        str: The value (None if missing).
+    """
+    value = headers.get(name)
+    if value is None:
+        value = headers.get(name.title())
+    if value is None:
+        for key, header_value in headers.items():
+            if key.lower() == name:
+                return header_value
+    return value
+
+
+class RESTWorker:
+    """Handle a single request: pre-checks, call to the backend and reply.
+
+    Workers are run by the threads of the scheduler (see ``vcdextproxy.scheduler``).
+    A worker only keeps what the forwarding and the reply need: thousands
+    of them can be queued at once.
+    """
+
+    __slots__ = (
+        'extension', 'message_worker', 'id', 'method', 'uri', 'query_string', 'body', 'request_headers',
+        'vcd_data', 'org_id', 'user_id', 'token', 'is_jwt_token', 'reply_route', 'replied', 'received',
+        'stage', 'lane', 'backend_latency', 'backend_error',
+    )
+
+    def __init__(self, extension, message_worker, data, message, received=None):
         self.extension = extension
         # enable to publish response from the worker
         self.message_worker = message_worker
         # split request content from vcd context data
-        self.req_data = data[0]
-        self.vcd_data = data[1]
-        # message metadata
-        self.amqp_message = message
-        # get message ID
-        self.id = self.req_data['id']
-        self.headers = self.forge_headers()
+        req_data, self.vcd_data = data[0], data[1]
+        self.id = req_data['id']
+        self.method = req_data.get('method', 'get').lower()
+        self.uri = req_data.get('requestUri', "")
+        self.query_string = req_data.get('queryString')
+        self.body = req_data.get('body', '')  # base64 encoded (decoded by run())
+        self.request_headers = req_data.get('headers', {})
+        # parse information from vcd request metadata. Sent as request headers #10
+        self.org_id = self.vcd_data.get('org', '').split("urn:vcloud:org:")[1]
+        self.user_id = self.vcd_data.get('user', '').split("urn:vcloud:user:")[1]
+        # message metadata needed by the reply
+        self.reply_route = (
+            message.delivery_info['routing_key'],
+            message.properties['correlation_id'],
+            message.properties['reply_to'],
+            message.headers['replyToExchange'],
+        )
+        self.replied = False
+        # progress of the request (see describe())
+        self.received = received or monotonic()  # reception of the message
+        self.stage = "queued"
+        self.lane = None  # priority lane (set by the scheduler)
+        # observed backend latency and failure (for the concurrency limiter)
+        self.backend_latency = None
+        self.backend_error = False
         # get the current auth token
-        self.token = None
-        for header_key, header_value in self.headers.items():
-            if header_key.lower() == "x-vcloud-authorization":  # or header_key.lower() == "authorization":
-                self.token = header_value
+        self.token = get_header(self.request_headers, "x-vcloud-authorization")
+        self.is_jwt_token = False
+        if self.token is None:
+            authorization = get_header(self.request_headers, "authorization")
+            if authorization and authorization.lower().startswith("bearer "):
+                self.token = authorization[7:].strip()
+                self.is_jwt_token = True
 
     def forge_headers(self):
         """Returns all the headers for requests to backend
 
+        The headers are built from the request ones and the headers template
+        of the extension (see ``RestApiExtension.get_headers_template()``).
+
         Returns:
             dict: The headers dictionnary
         """
-        headers = dict(self.req_data.get('headers', {}))
-        # parse information from vcd request metadata. Add them to request headers #10
-        headers['org_id'] = self.vcd_data.get('org', '').split("urn:vcloud:org:")[1]
-        headers['user_id'] = self.vcd_data.get('user', '').split("urn:vcloud:user:")[1]
-        self.extension.log('trivia', "Headers (without rights): " + json.dumps(headers, indent=2))
-        if self.extension.conf('backend.forward_rights', False):
-            self.extension.log('debug', "Including vCD rights as new header `user_rights`")
+        template = self.extension.get_headers_template()
+        headers = dict(self.request_headers)
+        if template.replaced:
+            for key in [key for key in headers if key.lower() in template.replaced]:
+                del headers[key]
+        headers.update(template.headers)
+        headers['org_id'] = self.org_id
+        headers['user_id'] = self.user_id
+        if template.forward_rights:
             headers['user_rights'] = json.dumps(self.vcd_data.get('rights'))
         return headers
 
     def pre_checks(self):
         """Run some pre-checks like checking rights.
+
+        With the ``vcloud.trust_vcd_context`` policy, the organization and the
+        rights sent by vCD in the message context are used as is: no token
+        validation and no vCD call.
         """
-        client, session = login_from_token(self.token)
-        current_org = Org(client, resource=client.get_org())
-        if not self.headers.get('org_id') in current_org.href:
-            err_msg = f"The current user is logged in requested organization: {org_id}"
+        if self.extension.conf('vcloud.trust_vcd_context', False) and 'rights' in self.vcd_data:
+            # org_id header comes from the vCD context: the membership is granted by vCD
+            self.extension.log('trivia', "Using the rights of the vCD context")
+            if self.extension.ref_right_id:
+                user_rights = ids_from_urns(self.vcd_data['rights'])
+                if self.extension.ref_right_id not in user_rights:
+                    return self.forbidden_right()
+            return True
+        try:
+            identity = validate_token(self.token, self.is_jwt_token, self.vcd_data)
+        except InvalidToken as e:
+            self.extension.log('error', f"Invalid token: {str(e)}")
+            self.reply({"unauthorized": str(e)}, "401")
+            return False
+        self.extension.log('trivia', f"Token validated ({identity.source})")
+        if identity.org_id != self.org_id:
+            err_msg = f"The current user is not logged in requested organization: {self.org_id}"
             self.extension.log('error', err_msg)
             self.reply({"forbidden": err_msg}, "403")
             return False
         if self.extension.ref_right_id:
-            if self.extension.ref_right_id not in get_user_rights(client, session):
-                err_msg = "The current user does not have the requested right:"
-                err_msg += f" {self.extension.conf('vcloud.reference_right')}"
-                self.extension.log('error', err_msg)
-                self.reply({"forbidden": err_msg}, "403")
+            try:
+                user_rights = get_user_rights(identity.org_id, identity.roles)
+            except RightsUnavailable as e:
+                self.extension.log('error', str(e))
+                self.reply({"Error": "Rights are not available yet, please retry later"}, 503)
                 return False
+            if self.extension.ref_right_id not in user_rights:
+                return self.forbidden_right()
         return True
 
+    def forbidden_right(self):
+        """Reply that the user does not have the reference right.
+
+        Returns:
+            bool: False (pre-checks failed).
+        """
+        err_msg = "The current user does not have the requested right:"
+        err_msg += f" {self.extension.conf('vcloud.reference_right')}"
+        self.extension.log('error', err_msg)
+        self.reply({"forbidden": err_msg}, "403")
+        return False
+
+    def describe(self, now=None):
+        """Describe the progress of the request (for the admin endpoint).
+
+        Returns:
+            dict: Request details, age and stage.
+        """
+        return {
+            'id': self.id,
+            'extension': self.extension.name,
+            'method': self.method.upper(),
+            'uri': self.uri,
+            'org_id': self.org_id,
+            'user_id': self.user_id,
+            'lane': self.lane,
+            'stage': self.stage,
+            'age_s': round((now or monotonic()) - self.received, 3),
+        }
+
+    def backend_request(self, body):
+        """Return the headers and the body to send to the backend.
+
+        With ``backend.compression``, compressed responses are accepted
+        (and transparently decoded) and large request bodies are compressed.
+
+        Args:
+            body (bytes): Body of the request.
+
+        Returns:
+            (dict, bytes): Headers and body.
+        """
+        headers = self.forge_headers()
+        settings = self.extension.conf('backend.compression', None)
+        if not settings:
+            return headers, body
+        encoding = settings.get('request_encoding')
+        if encoding and body and len(body) >= settings.get('min_size', 1024) and available_encodings([encoding]):
+            body = compress(body, encoding, settings.get('level'))
+            headers['Content-Encoding'] = encoding
+        return headers, body
+
+    def reply_encoding(self, rsp_body):
+        """Choose the encoding of a reply (``vcloud.reply_compression``).
+
+        Args:
+            rsp_body (bytes): Body of the reply.
+
+        Returns:
+            str: The encoding or None to send the reply as is.
+        """
+        settings = self.extension.conf('vcloud.reply_compression', None)
+        if not settings or len(rsp_body) < settings.get('min_size', 1024):
+            return None
+        accept_encoding = get_header(self.request_headers, "accept-encoding")
+        return negotiate(accept_encoding, settings.get('encodings', ['gzip']))
+
     def reply(self, rsp_body, status_code):
         """Send reply to the request
 
         Args:
-            rsp_body (str): body of the answer as string
+            rsp_body (str): body of the answer (str, bytes or dict)
             status_code (int): HTTP response code
         """
         # prepare reply properties
@@ -79,60 +227,85 @@ class RESTWorker(Thread):
         # if body is a dict, then stringify it
         if isinstance(rsp_body, dict):
             rsp_body = json.dumps(rsp_body)
+        if isinstance(rsp_body, str):
+            rsp_body = rsp_body.encode('utf-8')
+        routing_key, correlation_id, reply_to, reply_exchange = self.reply_route
         resp_prop = {
-            "routing_key": self.amqp_message.delivery_info['routing_key'],  # for mapping in amqp/publisher
+            "routing_key": routing_key,  # for mapping in amqp/publisher
             "id": self.id,
-            "accept": self.headers.get('Accept', None),
-            "correlation_id": self.amqp_message.properties['correlation_id'],
-            "reply_to": self.amqp_message.properties['reply_to'],
-            "replyToExchange": self.amqp_message.headers['replyToExchange'],
-            "statusCode": status_code
+            "accept": self.request_headers.get('Accept', None),
+            "correlation_id": correlation_id,
+            "reply_to": reply_to,
+            "replyToExchange": reply_exchange,
+            "statusCode": status_code,
+            "encode": False  # already bytes
         }
+        encoding = self.reply_encoding(rsp_body)
+        if encoding:
+            size = len(rsp_body)
+            rsp_body = compress(rsp_body, encoding, self.extension.conf('vcloud.reply_compression.level', None))
+            resp_prop["Content-Encoding"] = encoding
+            self.extension.log('debug', f"Reply compressed with {encoding}: {size} -> {len(rsp_body)} bytes")
         # Send reply
+        self.stage = "replying"
+        self.replied = True
         self.message_worker.publish(rsp_body, resp_prop)
 
     def run(self):
         """Handle all messages received on the RabbitMQ Exchange.
         """
         # decode request body
-        body = base64.b64decode(self.req_data.get('body', ''))
+        body = b64decode(self.body)  # in the offload pool when large
+        self.body = None  # only keep the decoded body
+        # wait for the end of the vCD initialization of the extension
+        self.stage = "waiting_extension"
+        if not self.extension.ready.wait(conf('global.vcloud.startup_timeout', 30)):
+            self.extension.log('warning', "Extension is not yet initialized on vCloud")
+            self.reply({"Error": "Extension is starting, please retry later"}, 503)
+            return
         # search the current auth token in headers
+        self.stage = "pre_checks"
         if not self.pre_checks():
             return  # already replyed
         # search the appropriate requests attr
         try:
-            method = self.req_data.get('method', 'get').lower()
+            method = self.method
             self.extension.log('trivia', f"Locking for method: {method}")
-            # Get the requests function based on the requested method
-            forward_request = getattr(
-                requests,
-                method
-            )
+            # Get the session function based on the requested method
+            forward_request = self.extension.get_backend().get_sender(method)
         except AttributeError:
             self.extension.log('error', f"The method {method} is not supported.")
             rsp_body = {"Error": f"The method {method} is not supported."}
             status_code = 405
             self.reply(rsp_body, status_code)
+            return
         except Exception as e:
             self.extension.log('error', f"Unmanaged error raised: {str(e)}")
             raise e  # raise other errors as usual
         # forward the requests to the backend
+        started = None
         try:
-            uri = self.extension.get_url(
-                self.req_data.get('requestUri', ""),
-                self.req_data.get('queryString')
-            )
+            uri = self.extension.get_url(self.uri, self.query_string)
             self.extension.log('info', f"Forwarding request {method.upper()} - {uri}")
-            r = forward_request(
-                uri,
-                data=body,
-                auth=self.extension.get_extension_auth(),
-                headers=self.headers,
-                verify=self.extension.conf('backend.ssl_verify', True),
-                timeout=self.extension.conf('backend.timeout', 300)  # by default 5 minutes timeout
-            )
-            rsp_body = r.text
+            headers, body = self.backend_request(body)
+            started = monotonic()
+            self.stage = "backend"
+
+            def send():
+                return forward_request(
+                    uri,
+                    data=body,
+                    auth=self.extension.get_extension_auth(),
+                    headers=headers,
+                    verify=self.extension.conf('backend.ssl_verify', True),
+                    timeout=self.extension.conf('backend.timeout', 300)  # by default 5 minutes timeout
+                )
+            policy = get_retry_policy(self.extension)
+            r = policy.call(method, send, self.extension.log) if policy else send()
+            self.backend_latency = monotonic() - started
+            rsp_body = r.content  # decoded bytes: no round trip through str
             status_code = r.status_code
+            self.backend_error = status_code >= 500 or status_code == 429
         except requests.exceptions.Timeout:
             self.extension.log('warning', "Timeout from extension backend server")
             rsp_body = {"Error": "Timeout from extension backend server"}
@@ -153,5 +326,8 @@ class RESTWorker(Thread):
             self.extension.log('error', f"Unmanaged error raised: {str(e)}", exc_info=1)
             rsp_body = {"Error": "Unmanaged error raised"}
             status_code = 500
+        if started is not None and self.backend_latency is None:  # the backend call failed
+            self.backend_latency = monotonic() - started
+            self.backend_error = True
         self.reply(rsp_body, status_code)
         return
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""Retries and hedging of the backend requests.
+
+Settings of an extension:
+
+* ``backend.retries``: ``max_attempts`` (1: no retry), ``methods`` (the
+  idempotent ones by default), ``status_codes`` retried as the connection
+  errors and timeouts, ``backoff`` and ``max_backoff`` (seconds) of the
+  exponential backoff with full jitter.
+* ``backend.hedging``: ``methods`` (``GET`` and ``HEAD`` by default),
+  ``percentile`` of the recent backend latencies after which a second
+  request is sent (the first answer wins), ``min_delay`` and ``max_delay``.
+
+Retries and hedged requests are taken from a process-wide budget
+(``global.retries.budget``): ``ratio`` of the requests, plus
+``min_per_second``. When the backend fails, retries cannot multiply its load.
+"""
+import random
+from bisect import insort
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import Lock, RLock
+from time import monotonic, sleep
+import requests
+from vcdextproxy.configuration import conf
+from vcdextproxy.scheduler import get_max_threads
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+RETRYABLE_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+class RetryBudget:
+    """Share of the requests which can be retried (or hedged).
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=1.0, max_tokens=None):
+        """Create a budget.
+
+        Args:
+            ratio (float): Retries allowed per request.
+            min_per_second (float): Retries allowed per second in any case.
+            max_tokens (float): Maximum number of retries saved (default: 10 seconds of ``min_per_second``,
+                at least 10).
+        """
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens or max(10.0, 10 * min_per_second)
+        self.tokens = self.max_tokens
+        self.updated = monotonic()
+        self.stats = {'requests': 0, 'retries': 0, 'denied': 0}
+        self._lock = Lock()
+
+    @classmethod
+    def from_conf(cls):
+        """Create the budget from ``global.retries.budget``.
+        """
+        return cls(
+            conf('global.retries.budget.ratio', 0.1),
+            conf('global.retries.budget.min_per_second', 1.0)
+        )
+
+    def _refill(self, tokens):
+        now = monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + tokens + (now - self.updated) * self.min_per_second)
+        self.updated = now
+
+    def deposit(self):
+        """A request is sent.
+        """
+        with self._lock:
+            self._refill(self.ratio)
+            self.stats['requests'] += 1
+
+    def withdraw(self):
+        """Ask for a retry.
+
+        Returns:
+            bool: True if the retry is allowed.
+        """
+        with self._lock:
+            self._refill(0)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.stats['retries'] += 1
+                return True
+            self.stats['denied'] += 1
+            return False
+
+
+class LatencyTracker:
+    """Recent latencies of a backend.
+    """
+
+    def __init__(self, size=200):
+        self._recent = deque(maxlen=size)
+        self._sorted = []
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._recent)
+
+    def add(self, latency):
+        with self._lock:
+            if len(self._recent) == self._recent.maxlen:
+                self._sorted.remove(self._recent[0])
+            self._recent.append(latency)
+            insort(self._sorted, latency)
+
+    def percentile(self, pct):
+        """Return a percentile of the recent latencies (None without samples).
+        """
+        with self._lock:
+            if not self._sorted:
+                return None
+            return self._sorted[min(len(self._sorted) - 1, int(len(self._sorted) * pct / 100))]
+
+
+class RetryPolicy:
+    """Retries and hedging of the requests of an extension.
+    """
+
+    def __init__(self, retries=None, hedging=None, budget=None):
+        """Create a policy.
+
+        Args:
+            retries (dict): The ``backend.retries`` settings.
+            hedging (dict): The ``backend.hedging`` settings.
+            budget (RetryBudget): Budget of the retries and hedged requests.
+        """
+        retries = retries or {}
+        self.max_attempts = retries.get('max_attempts', 1)
+        self.methods = frozenset(m.upper() for m in retries.get('methods', IDEMPOTENT_METHODS))
+        self.status_codes = frozenset(retries.get('status_codes', (502, 503, 504)))
+        self.backoff_base = retries.get('backoff', 0.05)
+        self.backoff_max = retries.get('max_backoff', 1.0)
+        self.hedging = hedging or None
+        if self.hedging:
+            self.hedge_methods = frozenset(m.upper() for m in self.hedging.get('methods', ('GET', 'HEAD')))
+        self.budget = budget or get_retry_budget()
+        self.latencies = LatencyTracker()
+        self.stats = {'retries': 0, 'hedges': 0, 'hedge_wins': 0}
+
+    def backoff(self, attempt):
+        """Return the delay before a retry (exponential backoff, full jitter).
+
+        Args:
+            attempt (int): Number of the failed attempt (from 1).
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def hedge_delay(self, method):
+        """Return the delay before a hedged request (None: no hedging).
+        """
+        if not self.hedging or method not in self.hedge_methods:
+            return None
+        if len(self.latencies) < self.hedging.get('min_samples', 20):
+            return None
+        delay = self.latencies.percentile(self.hedging.get('percentile', 95))
+        return min(self.hedging.get('max_delay', 10.0), max(self.hedging.get('min_delay', 0.01), delay))
+
+    def call(self, method, send, log):
+        """Send a request to the backend with the retries and hedging of the policy.
+
+        Args:
+            method (str): HTTP method of the request.
+            send (callable): Sends the request and returns the ``requests.Response``.
+            log (callable): Log function (``extension.log``).
+
+        Raises:
+            requests.exceptions.RequestException: The last error when no attempt succeeded.
+
+        Returns:
+            requests.Response: The first successful response (or the last one).
+        """
+        method = method.upper()
+        self.budget.deposit()
+        hedge_delay = self.hedge_delay(method)
+        attempt = 0
+        while True:
+            attempt += 1
+            error = response = None
+            started = monotonic()
+            try:
+                response = self.hedged(send, hedge_delay, log) if hedge_delay else send()
+            except RETRYABLE_EXCEPTIONS as e:
+                error = e
+            else:
+                self.latencies.add(monotonic() - started)
+                if response.status_code not in self.status_codes:
+                    return response
+            if attempt >= self.max_attempts or method not in self.methods or not self.budget.withdraw():
+                if error is not None:
+                    raise error
+                return response
+            self.stats['retries'] += 1
+            delay = self.backoff(attempt)
+            reason = type(error).__name__ if error is not None else f"HTTP {response.status_code}"
+            log('warning', f"Backend attempt {attempt} failed ({reason}): retry in {delay:.3f}s")
+            sleep(delay)
+
+    def hedged(self, send, delay, log):
+        """Send a request and a second one if the first is still running after ``delay``.
+
+        Returns:
+            requests.Response: The first response.
+        """
+        primary = hedging_executor().submit(send)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self.budget.withdraw():
+            return primary.result()
+        self.stats['hedges'] += 1
+        log('debug', f"No backend response after {delay:.3f}s: sending a hedged request")
+        futures = [primary, hedging_executor().submit(send)]
+        while True:
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    if future is not primary:
+                        self.stats['hedge_wins'] += 1
+                    return future.result()
+            futures = list(pending)
+
+    def get_metrics(self):
+        return dict(self.stats, p95_latency=self.latencies.percentile(95))
+
+
+_policies = {}
+_policies_lock = RLock()
+_executor = []
+_budget = []
+
+
+def get_retry_budget():
+    """Return the process-wide budget of the retries and hedged requests.
+    """
+    with _policies_lock:
+        if not _budget:
+            _budget.append(RetryBudget.from_conf())
+        return _budget[0]
+
+
+def hedging_executor():
+    """Return the threads running the hedged requests (``global.retries.hedging_workers``).
+    """
+    with _policies_lock:
+        if not _executor:
+            _executor.append(ThreadPoolExecutor(
+                max_workers=conf('global.retries.hedging_workers', 2 * get_max_threads()),
+                thread_name_prefix="backend-hedging"
+            ))
+        return _executor[0]
+
+
+def get_retry_policy(extension):
+    """Return the retry policy of an extension (None without retries nor hedging).
+    """
+    with _policies_lock:
+        if extension.name not in _policies:
+            retries = extension.conf('backend.retries', None)
+            hedging = extension.conf('backend.hedging', None)
+            _policies[extension.name] = RetryPolicy(retries, hedging) if retries or hedging else None
+        return _policies[extension.name]
+
+
+def get_retry_metrics():
+    """Return the state of the retry budget and of the retry policies.
+    """
+    with _policies_lock:
+        policies = {name: policy.get_metrics() for name, policy in _policies.items() if policy}
+    budget = get_retry_budget()
+    return {'budget': dict(budget.stats, tokens=round(budget.tokens, 1)), 'extensions': policies}
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""Index of the rights available in vCloud Director and rights of the users.
+"""
+from threading import Condition, Event, Lock, Thread
+from time import sleep
+from cachetools import cached, TLRUCache
+from vcdextproxy.configuration import conf
+from vcdextproxy.utils import logger
+from vcdextproxy.vcd_utils import list_rights_available_in_vcd, login_as_system_admin
+
+
+RIGHT_URN_PREFIX = "urn:vcloud:right:"
+
+
+class RightsUnavailable(Exception):
+    """The rights catalog of vCD is not loaded yet.
+    """
+
+
+class RightsIndex:
+    """Process-wide index of the rights catalog (name <-> ID).
+
+    The catalog is fetched once and then refreshed in background: lookups
+    never wait for vCD.
+    """
+
+    def __init__(self):
+        """Initialize an empty index.
+        """
+        self.by_name = {}
+        self.by_id = {}
+        self.loaded = Event()
+        self.version = 0  # incremented by each successful refresh
+        self.refresh_thread = None
+        self._lock = Lock()
+
+    def refresh(self):
+        """Fetch the rights catalog from vCD and rebuild the index.
+
+        Returns:
+            bool: True if the index was rebuilt.
+        """
+        try:
+            catalog = list_rights_available_in_vcd()
+        except Exception as e:
+            logger.error(f"Cannot list the rights available in vCD: {str(e)}")
+            return False
+        by_name = {}
+        for right in catalog:
+            by_name[right['name']] = right['href'].split('/')[-1]
+        with self._lock:
+            # replace whole dicts: readers always see a consistent index
+            self.by_name = by_name
+            self.by_id = {right_id: name for name, right_id in by_name.items()}
+            self.version += 1
+        self.loaded.set()
+        logger.debug(f"Rights index refreshed: {len(by_name)} rights available in vCD.")
+        return True
+
+    def start_background_refresh(self, interval):
+        """Refresh the index every ``interval`` seconds in a daemon thread.
+        """
+        if self.refresh_thread:
+            return
+        self.refresh_thread = Thread(
+            target=self._refresh_loop,
+            args=(interval,),
+            name="rights-index",
+            daemon=True
+        )
+        self.refresh_thread.start()
+
+    def _refresh_loop(self, interval):
+        while True:
+            sleep(interval)
+            self.refresh()
+
+    def get_id(self, name):
+        """Return the ID of a right from its name (or None).
+        """
+        return self.by_name.get(name)
+
+    def get_name(self, right_id):
+        """Return the name of a right from its ID (or None).
+        """
+        return self.by_id.get(right_id)
+
+    def ids_of(self, names):
+        """Return the IDs of the known rights in a list of names.
+
+        Returns:
+            frozenset: Rights IDs.
+        """
+        by_name = self.by_name
+        return frozenset(by_name[name] for name in names if name in by_name)
+
+    def __len__(self):
+        return len(self.by_name)
+
+
+rights_index = RightsIndex()
+"""RightsIndex: The process-wide rights index."""
+
+
+def ids_from_urns(urns):
+    """Return the IDs of the rights in a list of URNs (as in the vCD context of the messages).
+
+    The IDs are part of the URNs: the rights index is not needed.
+
+    Returns:
+        frozenset: Rights IDs.
+    """
+    prefix = len(RIGHT_URN_PREFIX)
+    return frozenset(urn[prefix:] for urn in urns if urn.startswith(RIGHT_URN_PREFIX))
+
+
+def get_user_rights(org_id, roles):
+    """Lists rights of a user from its roles.
+
+    Args:
+        org_id (str): ID of the user's organization
+        roles (iterable): Names of the user's roles
+
+    Raises:
+        RightsUnavailable: The rights catalog of vCD is not loaded yet.
+
+    Returns:
+        frozenset: Rights IDs
+    """
+    rights = frozenset()
+    for role_name in roles:
+        rights |= get_role_rights(org_id, role_name)
+    return rights
+
+
+def _role_rights_expiry(key, value, now):
+    return now + conf("global.vcloud.cache_timeout", 300)  # read on first use, not on import
+
+
+# called by all the worker threads: concurrent misses of a role wait for a single vCD lookup
+@cached(TLRUCache(maxsize=1000, ttu=_role_rights_expiry), condition=Condition(), info=True)
+def get_role_rights(org_id, role_name):
+    """Lists rights of a role in an organization.
+
+    Args:
+        org_id (str): ID of the organization
+        role_name (str): Name of the role
+
+    Raises:
+        RightsUnavailable: The rights catalog cannot be fetched (not cached: the next call tries again).
+
+    Returns:
+        frozenset: Rights IDs
+    """
+    if not rights_index.loaded.is_set() and not rights_index.refresh():
+        raise RightsUnavailable("The rights catalog of vCD is not available")
+    from pyvcloud.vcd.org import Org
+    from pyvcloud.vcd.role import Role
+    # Start a sys admin session
+    admin_client = login_as_system_admin()
+    # Get admin object from the user's org
+    admin_org = Org(admin_client, href=f"{admin_client.get_api_uri()}/org/{org_id}")
+    # Get admin object from role
+    admin_role = Role(
+        admin_client,
+        resource=admin_org.get_role_resource(role_name))
+    # Rights of the role are listed by name
+    return rights_index.ids_of(right.get('name') for right in admin_role.list_rights())
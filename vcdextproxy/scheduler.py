@@ -0,0 +1,546 @@
+#!/usr/bin/env python
+"""Scheduling of the requests: rate limits and fair sharing of the workers.
+
+Requests are accepted by the AMQP listener, checked against per-organization
+and per-user token buckets, then queued in a priority lane (by extension,
+method and URI) and per organization. A fixed pool of worker threads serves
+the lanes, then the organizations of a lane, with a deficit round robin: each
+one gets a share of the workers proportional to its weight, whatever its
+number of pending requests. The requests of an extension whose queue is
+standing are shed (see ``vcdextproxy.shedding``).
+"""
+import re
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import monotonic
+from cachetools import TTLCache
+from vcdextproxy.concurrency import build_limiter
+from vcdextproxy.configuration import conf
+from vcdextproxy.shedding import build_shedder
+from vcdextproxy.utils import logger
+
+
+DEFAULT_LANE = "default"
+MIN_SHARE = 0.1  # every lane, organization or group is served: no starvation
+
+
+class TokenBucket:
+    """Token bucket: ``rate`` tokens per second, up to ``burst`` tokens.
+    """
+
+    def __init__(self, rate, burst):
+        """Create a full bucket.
+
+        Args:
+            rate (float): Tokens added per second.
+            burst (float): Maximum number of tokens.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def available(self):
+        """Refill the bucket and tell if a token is available.
+        """
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens >= 1
+
+    def take(self):
+        """Take a token if one is available.
+
+        Returns:
+            bool: True if the token was taken.
+        """
+        if self.available():
+            self.tokens -= 1
+            return True
+        return False
+
+
+class RateLimiter:
+    """Per-organization and per-user rate limits.
+
+    Limits are read from ``global.rate_limits.org`` and
+    ``global.rate_limits.user`` (``rate`` per second and ``burst``). A missing
+    scope is not limited.
+    """
+
+    def __init__(self):
+        """Initialize the buckets from the configuration.
+        """
+        self.limits = {}
+        for scope in ('org', 'user'):
+            limit = conf(f'global.rate_limits.{scope}', None)
+            if limit:
+                rate = float(limit['rate'])
+                self.limits[scope] = (rate, max(1.0, float(limit.get('burst', rate))))
+        # buckets idle for an hour are forgotten (they would be full again anyway):
+        # each access inserts the bucket again to restart its TTL
+        self.buckets = TTLCache(maxsize=conf('global.rate_limits.max_keys', 100000), ttl=3600)
+        self._lock = Lock()
+
+    def allow(self, org_id, user_id):
+        """Check the rate limits of a request.
+
+        Returns:
+            str: The exceeded scope (``org`` or ``user``) or None if allowed.
+        """
+        with self._lock:
+            buckets = []
+            for scope, key in (('org', org_id), ('user', user_id)):
+                if scope not in self.limits:
+                    continue
+                bucket = self.buckets.get((scope, key)) or TokenBucket(*self.limits[scope])
+                self.buckets[(scope, key)] = bucket
+                if not bucket.available():
+                    return scope
+                buckets.append(bucket)
+            # tokens are only taken when all the limits allow the request
+            for bucket in buckets:
+                bucket.take()
+        return None
+
+
+class DeficitRoundRobin:
+    """Queues per key served with a weighted deficit round robin (not thread-safe).
+
+    The queues of the keys are built by ``factory``: a ``DeficitRoundRobin``
+    can be nested as a queue (entries are then ``(key, item)`` tuples).
+    """
+
+    def __init__(self, weights=None, default_weight=1, factory=deque):
+        """Create an empty round robin.
+
+        Args:
+            weights (dict): Weight per key (at least ``MIN_SHARE``).
+            default_weight (float): Weight of the other keys.
+            factory (callable): Builds the queue of a new key.
+        """
+        # a weight <= 0 would never let its key be served (endless pop())
+        self.weights = {key: max(MIN_SHARE, float(weight)) for key, weight in (weights or {}).items()}
+        self.default_weight = max(MIN_SHARE, float(default_weight))
+        self.factory = factory
+        self._queues = {}  # key -> queue of items
+        self._active = deque()  # keys with pending items (round robin)
+        self._deficit = {}
+        self._size = 0
+
+    def put(self, key, item):
+        """Queue an item for a key.
+        """
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = self.factory()
+            self._active.append(key)
+            self._deficit[key] = 0
+        queue.append(item)
+        self._size += 1
+
+    def pop(self, eligible=None, inner=None):
+        """Pop the next item to serve.
+
+        Args:
+            eligible (callable): Only serve the keys accepted by this predicate.
+            inner (callable): Predicate given to the nested round robin (the
+                item is then the ``(key, item)`` tuple of the nested one).
+
+        Raises:
+            IndexError: No (eligible) item.
+
+        Returns:
+            (any, any): The key and the item.
+        """
+        skipped = 0
+        while True:
+            if skipped >= len(self._active):
+                raise IndexError("No eligible item to serve")
+            key = self._active[0]
+            if eligible and not eligible(key):
+                self._active.rotate(-1)
+                skipped += 1
+                continue
+            if self._deficit[key] < 1:
+                self._deficit[key] += self.weights.get(key, self.default_weight)
+                if self._deficit[key] < 1:
+                    self._active.rotate(-1)
+                    continue
+            queue = self._queues[key]
+            item = queue.pop(inner) if inner else queue.popleft()
+            self._size -= 1
+            self._deficit[key] -= 1
+            if not queue:
+                self._active.popleft()
+                del self._queues[key]
+                del self._deficit[key]
+            elif self._deficit[key] < 1:
+                self._active.rotate(-1)
+            return key, item
+
+    def append(self, entry):
+        """Queue a ``(key, item)`` entry (nested usage).
+        """
+        self.put(*entry)
+
+    def popleft(self):
+        """Pop the next item to serve (nested usage).
+        """
+        return self.pop()[1]
+
+    def keys(self):
+        """Return the keys with pending items.
+        """
+        return self._queues.keys()
+
+    def has_eligible(self, eligible):
+        """Tell if a key with pending items is accepted by a predicate.
+        """
+        return any(eligible(key) for key in self._queues)
+
+    def queue(self, key):
+        """Return the queue of a key (or None).
+        """
+        return self._queues.get(key)
+
+    def pending(self):
+        """Return the number of queued items per key.
+        """
+        return {key: len(queue) for key, queue in self._queues.items()}
+
+    def __len__(self):
+        return self._size
+
+
+def _any(key):
+    return True
+
+
+class FairQueue:
+    """Priority lanes of per-group (extension) and per-organization queues.
+
+    Lanes are served with a weighted round robin on their ``share``: a busy
+    lane with a low share still gets its part of the workers (no starvation).
+    A lane can also be limited to ``max_workers`` running requests, so that
+    slow requests cannot hold all the workers, and to ``max_queued`` pending
+    requests, so that a saturated lane cannot fill the admission window of
+    the proxy. Inside a lane, groups then organizations are served in turn.
+    A group with a concurrency limiter (see ``vcdextproxy.concurrency``) is
+    only served below its limit.
+    """
+
+    def __init__(self, weights=None, lanes=None):
+        """Create an empty queue.
+
+        Args:
+            weights (dict): Weight per organization.
+            lanes (dict): Settings (``share``, ``max_workers`` and ``max_queued``) per lane name.
+        """
+        for org_id, weight in (weights or {}).items():
+            if float(weight) < MIN_SHARE:
+                logger.warning(f"Weight {weight} of organization {org_id} is too low: using {MIN_SHARE}")
+        lanes = dict(lanes or {})
+        lanes.setdefault(DEFAULT_LANE, {})
+        self.shares = {name: max(MIN_SHARE, float(lane.get('share', 1))) for name, lane in lanes.items()}
+        self.limits = {name: lane['max_workers'] for name, lane in lanes.items() if lane.get('max_workers')}
+        self.max_queued = {name: lane['max_queued'] for name, lane in lanes.items() if lane.get('max_queued')}
+        self.running = {name: 0 for name in lanes}
+        self.limiters = {}  # group -> concurrency limiter
+        self._lanes = DeficitRoundRobin(
+            self.shares,
+            factory=lambda: DeficitRoundRobin(factory=lambda: DeficitRoundRobin(weights))
+        )
+        self._cond = Condition()
+
+    def set_limiter(self, group, limiter):
+        """Set the concurrency limiter of a group.
+        """
+        with self._cond:
+            self.limiters[group] = limiter
+            self._cond.notify_all()
+
+    def put(self, key, item, lane=DEFAULT_LANE, group=None):
+        """Queue an item for a key (organization) of a group (extension) in a lane.
+
+        Returns:
+            bool: False if the lane is full (item not queued).
+        """
+        with self._cond:
+            if lane in self.max_queued:
+                queue = self._lanes.queue(lane)
+                if queue is not None and len(queue) >= self.max_queued[lane]:
+                    return False
+            self._lanes.put(lane, (group, (key, item)))
+            self._cond.notify()
+            return True
+
+    def _group_eligible(self, group):
+        limiter = self.limiters.get(group)
+        return limiter is None or limiter.available()
+
+    def _eligible(self, lane):
+        if lane in self.limits and self.running[lane] >= self.limits[lane]:
+            return False
+        return not self.limiters or self._lanes.queue(lane).has_eligible(self._group_eligible)
+
+    def _ready(self):
+        if not self.limits and not self.limiters:
+            return len(self._lanes)
+        return any(self._eligible(lane) for lane in self._lanes.keys())
+
+    def get(self, timeout=None):
+        """Get the next item to serve (blocking).
+
+        ``done()`` must be called with the lane and the group of the item
+        once it is served.
+
+        Returns:
+            any: The item or None on timeout.
+        """
+        with self._cond:
+            if not self._cond.wait_for(self._ready, timeout):
+                return None
+            limited = self.limits or self.limiters
+            lane, (group, item) = self._lanes.pop(
+                self._eligible if limited else None,
+                self._group_eligible if self.limiters else _any
+            )
+            self.running[lane] += 1
+            if group in self.limiters:
+                self.limiters[group].started()
+            return item
+
+    def done(self, lane, group=None, latency=None, error=False):
+        """Release the worker used by an item.
+
+        Args:
+            lane (str): Lane of the item.
+            group (str): Group of the item.
+            latency (float): Backend latency (seconds) for the concurrency limiter.
+            error (bool): The backend failed.
+        """
+        with self._cond:
+            self.running[lane] -= 1
+            if group in self.limiters:
+                self.limiters[group].finished(latency, error)
+            if lane in self.limits or self.limiters:
+                self._cond.notify()
+
+    def pending(self):
+        """Return the number of queued items per lane and organization.
+        """
+        with self._cond:
+            pending = {}
+            for lane in self._lanes.keys():
+                groups = self._lanes.queue(lane)
+                counts = pending[lane] = {}
+                for group in groups.keys():
+                    for key, count in groups.queue(group).pending().items():
+                        counts[key] = counts.get(key, 0) + count
+            return pending
+
+    def __len__(self):
+        return len(self._lanes)
+
+
+class PriorityRules:
+    """Classify the requests in priority lanes.
+
+    Rules (``global.priorities.rules``) are checked in order, the first
+    matching rule gives the lane. A rule matches on ``extensions`` (names),
+    ``methods`` and ``uri_pattern`` (regular expression on the request URI):
+    a missing criterion matches all requests.
+    """
+
+    def __init__(self, rules, lanes):
+        """Compile the rules.
+
+        Args:
+            rules ([dict]): The rules.
+            lanes (iterable): Names of the known lanes.
+        """
+        self.rules = []
+        for rule in rules or []:
+            lane = rule.get('lane', DEFAULT_LANE)
+            if lane not in lanes and lane != DEFAULT_LANE:
+                logger.error(f"Unknown priority lane `{lane}` in rules: using the default lane.")
+                lane = DEFAULT_LANE
+            self.rules.append((
+                frozenset(rule['extensions']) if rule.get('extensions') else None,
+                frozenset(m.upper() for m in rule['methods']) if rule.get('methods') else None,
+                re.compile(rule['uri_pattern']) if rule.get('uri_pattern') else None,
+                lane
+            ))
+
+    def classify(self, extension_name, method, uri):
+        """Return the lane of a request.
+        """
+        method = method.upper()
+        for extensions, methods, uri_pattern, lane in self.rules:
+            if extensions is not None and extension_name not in extensions:
+                continue
+            if methods is not None and method not in methods:
+                continue
+            if uri_pattern is not None and not uri_pattern.match(uri):
+                continue
+            return lane
+        return DEFAULT_LANE
+
+
+class WorkerPool:
+    """Fixed pool of threads running the queued REST workers.
+    """
+
+    def __init__(self, size, queue, shedders=None):
+        """Create the pool (threads are started by ``start()``).
+
+        Args:
+            size (int): Number of threads.
+            queue (FairQueue): Queue of ``RESTWorker`` objects.
+            shedders (dict): Load shedder per extension name (fed with the sojourn times).
+        """
+        self.size = size
+        self.queue = queue
+        self.shedders = shedders if shedders is not None else {}
+        self.threads = []
+
+    def start(self):
+        """Start the worker threads.
+        """
+        for index in range(self.size):
+            thread = Thread(target=self._serve, name=f"rest-worker-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _serve(self):
+        while True:
+            worker = self.queue.get()
+            if worker is None:
+                continue
+            shedder = self.shedders.get(worker.extension.name)
+            try:
+                if shedder is not None and shedder.dequeued(monotonic() - worker.received):
+                    worker.extension.log('debug', "Request queued for too long: shedding it")
+                    worker.reply({"Error": "The extension is overloaded, please retry later"}, 503)
+                else:
+                    worker.run()
+            except Exception as e:
+                worker.extension.log('error', f"Unmanaged error raised: {str(e)}")
+                if not worker.replied:
+                    worker.reply({"Error": "Unmanaged error raised"}, 500)
+            finally:
+                self.queue.done(worker.lane, worker.extension.name, worker.backend_latency, worker.backend_error)
+
+
+def get_max_threads():
+    """Return the number of worker threads (``global.max_threads``).
+    """
+    max_threads = conf('global.max_threads', None)
+    if max_threads is None:
+        max_threads = conf('global.max_thread', None)
+        if max_threads is not None:
+            logger.warning("The `global.max_thread` setting is deprecated: use `global.max_threads`.")
+    return max_threads or 10
+
+
+class Scheduler:
+    """Rate limits, priority lanes, fair queue and worker pool of the proxy.
+    """
+
+    def __init__(self):
+        """Create the scheduler from the configuration (see ``start()``).
+        """
+        self.rate_limiter = RateLimiter()
+        lanes = conf('global.priorities.lanes', None) or {}
+        self.rules = PriorityRules(conf('global.priorities.rules', None), lanes)
+        self.queue = FairQueue(conf('global.fair_queuing.org_weights', None) or {}, lanes)
+        self.shedders = {}  # extension name -> QueueDelayShedder
+        self.pool = WorkerPool(get_max_threads(), self.queue, self.shedders)
+        self.extensions = set()  # extensions with known concurrency and shedding settings
+        self._lock = Lock()  # requests are submitted by several consumer threads
+
+    def start(self):
+        """Start the worker threads.
+        """
+        self.pool.start()
+        logger.debug(f"Scheduler started with {self.pool.size} workers.")
+
+    def add_extension(self, extension):
+        """Set the concurrency limiter and the load shedder of an extension.
+
+        See the ``backend.concurrency`` and ``backend.shedding`` settings.
+        """
+        with self._lock:
+            if extension.name in self.extensions:
+                return
+            settings = extension.conf('backend.concurrency', None)
+            if settings:
+                try:
+                    limiter = build_limiter(settings, self.pool.size)
+                except (TypeError, ValueError) as e:
+                    extension.log('error', f"Invalid concurrency settings: {str(e)}")
+                else:
+                    extension.log('debug', f"Concurrency limit: {limiter.name} (initial limit: {limiter.limit})")
+                    self.queue.set_limiter(extension.name, limiter)
+            try:
+                shedder = build_shedder(extension.conf('backend.shedding', None), extension.log)
+            except (AttributeError, TypeError, ValueError) as e:
+                extension.log('error', f"Invalid shedding settings: {str(e)}")
+            else:
+                if shedder is not None:
+                    extension.log('debug', f"Load shedding above {shedder.target}s of queuing delay")
+                    self.shedders[extension.name] = shedder
+            self.extensions.add(extension.name)
+
+    def get_metrics(self):
+        """Return the state of the scheduler.
+
+        Returns:
+            dict: Pending requests, running requests per lane, concurrency limits and load shedding.
+        """
+        with self.queue._cond:
+            limits = {name: limiter.get_metrics() for name, limiter in self.queue.limiters.items()}
+            running = dict(self.queue.running)
+        return {
+            'workers': self.pool.size,
+            'pending': self.queue.pending(),
+            'running': running,
+            'concurrency': limits,
+            'shedding': {name: shedder.get_metrics() for name, shedder in list(self.shedders.items())},
+        }
+
+    def submit(self, worker):
+        """Check the rate limits of a request and queue it.
+
+        Args:
+            worker (vcdextproxy.RESTWorker): The request to run.
+
+        Returns:
+            bool: False if the request was rejected (already replied).
+        """
+        org_id = worker.org_id
+        exceeded = self.rate_limiter.allow(org_id, worker.user_id)
+        if exceeded:
+            worker.extension.log('warning', f"Rate limit exceeded for the {exceeded}: rejecting the request")
+            worker.reply({"Error": f"Too many requests for this {exceeded}"}, 429)
+            return False
+        worker.lane = self.rules.classify(
+            worker.extension.name,
+            worker.method,
+            worker.uri
+        )
+        if worker.extension.name not in self.extensions:
+            self.add_extension(worker.extension)
+        shedder = self.shedders.get(worker.extension.name)
+        if shedder is not None and not shedder.admit():
+            worker.extension.log('debug', "Queuing delay above target: shedding the request")
+            worker.reply({"Error": "The extension is overloaded, please retry later"}, 503)
+            return False
+        if not self.queue.put(org_id, worker, worker.lane, worker.extension.name):
+            if shedder is not None:
+                shedder.dequeued()
+            worker.extension.log('warning', f"Priority lane `{worker.lane}` is full: rejecting the request")
+            worker.reply({"Error": "Too many pending requests, please retry later"}, 503)
+            return False
+        return True
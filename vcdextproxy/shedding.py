@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Load shedding of the extensions, driven by the queuing delay (CoDel).
+
+The sojourn time of a request is the time between its reception and the
+start of its processing by a worker. When the sojourn times stay above
+``target`` for a whole ``interval``, a standing queue has formed and the
+extension is overloaded until its queue drains:
+
+* the queued requests which waited more than ``target`` are rejected (HTTP
+  503) instead of being served late,
+* the new requests are rejected at once while the expected wait of the queue
+  (pending requests times the recent time between two served requests) is
+  above ``target``.
+
+The accepted requests keep a low latency. A short burst (shorter than
+``interval``) is absorbed by the queue.
+
+Settings (``extensions.<name>.backend.shedding``): ``target`` and
+``interval`` (seconds).
+"""
+from threading import Lock
+from time import monotonic
+
+
+class QueueDelayShedder:
+    """Reject the requests of an extension while its queue is standing.
+    """
+
+    def __init__(self, target=0.1, interval=1.0, log=None):
+        """Create a shedder.
+
+        Args:
+            target (float): Acceptable sojourn time (seconds).
+            interval (float): Time the sojourn times must stay above ``target`` to start shedding (seconds).
+            log (callable): Log function (``extension.log``).
+        """
+        self.target = target
+        self.interval = interval
+        self.log = log
+        self.overloaded = False
+        self.queued = 0
+        self.first_above = None  # end of the interval above target (None: below target)
+        self.last_sojourn = None
+        self.served_interval = None  # moving average of the time between two served requests
+        self.last_served = None
+        self.stats = {'admitted': 0, 'shed': 0, 'dropped': 0, 'overloads': 0}
+        self._lock = Lock()
+
+    def _log(self, level, msg):
+        if self.log is not None:
+            self.log(level, msg)
+
+    def expected_wait(self):
+        """Return the expected sojourn time of a new request (seconds).
+        """
+        return self.queued * (self.served_interval or 0.0)
+
+    def admit(self):
+        """Tell whether a new request can be queued (``dequeued()`` must then be called once).
+
+        Returns:
+            bool: False if the request must be rejected.
+        """
+        with self._lock:
+            if not self.queued:  # the queue is empty: nothing is standing
+                if self.overloaded:
+                    self._log('info', "Queue drained: end of the load shedding")
+                self.overloaded = False
+                self.first_above = None
+            elif self.overloaded and self.expected_wait() >= self.target:
+                self.stats['shed'] += 1
+                return False
+            self.queued += 1
+            self.stats['admitted'] += 1
+            return True
+
+    def dequeued(self, sojourn=None, now=None):
+        """A request leaves the queue.
+
+        Args:
+            sojourn (float): Its sojourn time (None: it was not queued).
+
+        Returns:
+            bool: True if the request waited for too long and must be rejected.
+        """
+        now = now or monotonic()
+        with self._lock:
+            self.queued -= 1
+            if sojourn is None:
+                return False
+            self.last_sojourn = sojourn
+            if sojourn >= self.target:
+                if self.first_above is None:
+                    self.first_above = now + self.interval
+                elif now >= self.first_above and not self.overloaded:
+                    self.overloaded = True
+                    self.stats['overloads'] += 1
+                    self._log('warning', f"Requests wait more than {self.target}s for a worker: shedding the load")
+                if self.overloaded:
+                    self.stats['dropped'] += 1
+                    return True
+            else:
+                self.first_above = None
+            if self.last_served is not None:
+                elapsed = now - self.last_served
+                self.served_interval = elapsed if self.served_interval is None else \
+                    0.9 * self.served_interval + 0.1 * elapsed
+            self.last_served = now
+            return False
+
+    def get_metrics(self):
+        """Return the state of the shedder.
+        """
+        with self._lock:
+            return dict(
+                self.stats,
+                target=self.target,
+                interval=self.interval,
+                overloaded=self.overloaded,
+                queued=self.queued,
+                last_sojourn=round(self.last_sojourn, 4) if self.last_sojourn is not None else None,
+            )
+
+
+def build_shedder(settings, log=None):
+    """Build the shedder of an extension.
+
+    Args:
+        settings (dict): The ``backend.shedding`` settings (None: no shedding).
+        log (callable): Log function (``extension.log``).
+
+    Returns:
+        QueueDelayShedder: The shedder (None without settings).
+    """
+    if not settings:
+        return None
+    if settings is True:
+        settings = {}
+    return QueueDelayShedder(float(settings.get('target', 0.1)), float(settings.get('interval', 1.0)), log)
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+"""Validation of the users' tokens with a local cache and JWT introspection.
+
+Validation modes (``global.vcloud.token_validation.mode``):
+
+* ``remote``: each token is validated by vCD (a session is rehydrated).
+* ``cached``: results of the remote validation are cached per token.
+* ``local``: bearer JWTs are validated locally (signature, expiry, org and
+  user claims). Other tokens use the ``cached`` mode.
+
+In ``local`` mode, the strictness (``global.vcloud.token_validation.strictness``)
+defines what happens when the signature cannot be checked locally (no signing
+material or unsupported algorithm):
+
+* ``signature``: fall back to the remote validation.
+* ``claims``: trust the claims (the message was already authenticated by vCD).
+"""
+import base64
+import hashlib
+import hmac
+import json
+import time
+from collections import namedtuple
+from functools import lru_cache
+from threading import Lock
+from cachetools import TTLCache
+from vcdextproxy.configuration import conf
+from vcdextproxy.utils import logger
+from vcdextproxy.vcd_utils import login_from_token
+
+
+TokenIdentity = namedtuple('TokenIdentity', ['org_id', 'user_id', 'roles', 'expires', 'source'])
+"""namedtuple: Identity behind a validated token (``expires`` is a timestamp or None)."""
+
+
+@lru_cache(maxsize=None)
+def import_cryptography():
+    """Import the optional RS256 primitives on first use.
+
+    Returns:
+        (module, module, module): ``hashes``, ``serialization`` and ``padding`` (None if not installed).
+    """
+    try:
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import padding
+    except ImportError:
+        return None
+    return hashes, serialization, padding
+
+
+class InvalidToken(Exception):
+    """The token is rejected (bad signature, expired or not matching the request).
+    """
+
+
+def decode_jwt(token):
+    """Split and decode a JWT without any verification.
+
+    Args:
+        token (str): The JWT.
+
+    Raises:
+        ValueError: Not a JWT.
+
+    Returns:
+        (dict, dict, bytes, bytes): header, claims, signing input and signature.
+    """
+    def b64decode(segment):
+        return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+    parts = token.split('.')
+    if len(parts) != 3:
+        raise ValueError("Not a JWT")
+    header = json.loads(b64decode(parts[0]))
+    claims = json.loads(b64decode(parts[1]))
+    return header, claims, f"{parts[0]}.{parts[1]}".encode(), b64decode(parts[2])
+
+
+def _urn_id(urn):
+    return (urn or '').split(':')[-1] or None
+
+
+class TokenValidator:
+    """Validate tokens and cache the results.
+    """
+
+    def __init__(self):
+        """Initialize the validator (settings are read on first use).
+        """
+        self._lock = Lock()
+        self._cache = None
+        self._public_key = None
+        self.mode = None
+        self.strictness = None
+        self.jwt_secret = None
+        self.stats = {'hits': 0, 'misses': 0, 'local': 0, 'remote': 0}
+
+    def configure(self):
+        """Read the settings and load the signing material (once, thread-safe).
+
+        ``mode`` is set last: a validator with a mode is fully configured.
+        """
+        with self._lock:
+            if self.mode is not None:
+                return
+            self.strictness = conf('global.vcloud.token_validation.strictness', 'signature')
+            secret = conf('global.vcloud.token_validation.jwt_secret', None)
+            self.jwt_secret = secret.encode() if secret else None
+            key_file = conf('global.vcloud.token_validation.jwt_public_key_file', None)
+            if key_file:
+                crypto = import_cryptography()
+                if crypto is None:
+                    logger.warning("The cryptography package is required to check RS256 tokens locally.")
+                else:
+                    with open(key_file, 'rb') as fd:
+                        self._public_key = crypto[1].load_pem_public_key(fd.read())
+            self._cache = TTLCache(
+                maxsize=conf('global.vcloud.token_validation.cache_size', 10000),
+                ttl=conf('global.vcloud.cache_timeout', 300)
+            )
+            self.mode = conf('global.vcloud.token_validation.mode', 'remote')
+
+    def validate(self, token, is_jwt_token=False, vcd_data=None):
+        """Validate a token.
+
+        Args:
+            token (str): The token.
+            is_jwt_token (bool): The token is a bearer JWT.
+            vcd_data (dict): vCD context of the request (org and user URNs).
+
+        Raises:
+            InvalidToken: The token is rejected.
+
+        Returns:
+            TokenIdentity: Identity of the token owner.
+        """
+        if self.mode is None:
+            self.configure()
+        if not token:
+            raise InvalidToken("Missing token")
+        if self.mode == 'local' and is_jwt_token:
+            identity = self.validate_locally(token, vcd_data or {})
+            if identity:
+                return identity
+        if self.mode == 'remote':
+            return self.validate_remotely(token, is_jwt_token)
+        key = hashlib.sha256(token.encode()).hexdigest()
+        with self._lock:
+            identity = self._cache.get(key)
+        if identity and (identity.expires is None or identity.expires > time.time()):
+            self.stats['hits'] += 1
+            return identity
+        self.stats['misses'] += 1
+        identity = self.validate_remotely(token, is_jwt_token)
+        with self._lock:
+            self._cache[key] = identity
+        return identity
+
+    def validate_locally(self, token, vcd_data):
+        """Validate a JWT with the local signing material.
+
+        The organization is checked by the caller (as for the remote validation).
+
+        Returns:
+            TokenIdentity: Identity of the token owner or None to fall back
+                to the remote validation.
+        """
+        try:
+            header, claims, signing_input, signature = decode_jwt(token)
+        except ValueError:
+            return None
+        verified = self.verify_signature(header.get('alg'), signing_input, signature)
+        if verified is False:
+            raise InvalidToken("Invalid token signature")
+        if verified is None and self.strictness != 'claims':
+            return None  # cannot check the signature: ask vCD
+        if claims.get('exp') and claims['exp'] < time.time():
+            raise InvalidToken("Expired token")
+        identity = TokenIdentity(
+            org_id=_urn_id(claims.get('org')),
+            user_id=_urn_id(claims.get('user')),
+            roles=tuple(claims.get('roles', ())),
+            expires=claims.get('exp'),
+            source='local'
+        )
+        if vcd_data.get('user') and identity.user_id != _urn_id(vcd_data['user']):
+            raise InvalidToken("Token user does not match the request")
+        self.stats['local'] += 1
+        return identity
+
+    def verify_signature(self, algorithm, signing_input, signature):
+        """Check a JWT signature.
+
+        Returns:
+            bool: True/False, or None if it cannot be checked locally.
+        """
+        if algorithm == 'HS256' and self.jwt_secret:
+            expected = hmac.new(self.jwt_secret, signing_input, hashlib.sha256).digest()
+            return hmac.compare_digest(expected, signature)
+        if algorithm == 'RS256' and self._public_key:
+            hashes, _, padding = import_cryptography()
+            try:
+                self._public_key.verify(signature, signing_input, padding.PKCS1v15(), hashes.SHA256())
+                return True
+            except Exception:
+                return False
+        return None
+
+    def validate_remotely(self, token, is_jwt_token=False):
+        """Validate a token by rehydrating a vCD session.
+
+        Returns:
+            TokenIdentity: Identity of the token owner.
+        """
+        from pyvcloud.vcd.client import EntityType, RelationType, find_link
+        self.stats['remote'] += 1
+        try:
+            client, session = login_from_token(token, is_jwt_token)
+        except Exception as e:
+            raise InvalidToken(f"Token rejected by vCD: {str(e)}")
+        # The session links to the user's organization: no need for an extra request
+        org_link = find_link(session, RelationType.DOWN, EntityType.ORG.value, False)
+        org_href = org_link.href if org_link else client.get_org().get('href')
+        expires = None
+        if is_jwt_token:
+            try:
+                expires = decode_jwt(token)[1].get('exp')
+            except ValueError:
+                pass
+        return TokenIdentity(
+            org_id=org_href.split('/')[-1],
+            user_id=_urn_id(session.get('userId')),
+            roles=tuple(role.strip() for role in (session.get('roles') or '').split(',') if role.strip()),
+            expires=expires,
+            source='remote'
+        )
+
+
+token_validator = TokenValidator()
+"""TokenValidator: The process-wide token validator."""
+
+validate_token = token_validator.validate
+"""function: Alias to ``token_validator.validate()``."""
@@ -23,7 +23,9 @@ def vcdextproxy_excepthook(type, value, tb):
 
 def signal_handler(signal, frame):
     """Handle a Keyboard Interrupt to leave rabbitMQ connection.
+
+    Exit at once: ``AMQPWorker.on_shutdown_signal()`` drains first.
     """
     sys.stdout.write('\b\b\r')  # hide the ^C
-    logger.info("SIGINT signal catched -> Exiting...")
+    logger.info(f"Signal {signal} catched -> Exiting...")
     sys.exit(0)